@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from noisemapper.models import Profile, Recording
+from noisemapper.models import Profile, Recording, RecordingGroupTotals, ExcludedPeriod
 
 admin.site.register(Profile)
 admin.site.register(Recording)
+admin.site.register(RecordingGroupTotals)
+admin.site.register(ExcludedPeriod)
@@ -0,0 +1,158 @@
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from typing import Callable
+
+from django.conf import settings
+from django.http.request import HttpRequest
+from django.http.response import HttpResponse
+
+__all__ = ('Admission', 'AdmissionController', 'admission_controller', 'admission_control')
+
+
+Admission = namedtuple('Admission', ('slot', 'status', 'retry_after'))
+
+
+class AdmissionController(object):
+    """
+    Decides which upload requests are handled, so an upload storm (e.g. many phones reconnecting at once) can't
+    take all the uWSGI workers from the map endpoints. The state is in an SQLite file
+    (``settings.ADMISSION_PATH``), so it is shared by all the uWSGI processes, like the response cache.
+
+    - Every device has a token bucket: it holds up to ``settings.ADMISSION_DEVICE_BURST`` tokens, and gets
+      ``settings.ADMISSION_DEVICE_RATE`` new ones per second. Each request takes a token; a device without one
+      gets ``429 Too Many Requests``, until its next token arrives.
+    - At most ``settings.ADMISSION_MAX_IN_FLIGHT`` uploads are handled at once; above that, requests get
+      ``503 Service Unavailable``. Each admitted request holds a slot until :meth:`release`. The slots of requests
+      that never released them are freed when their process is gone (e.g. the worker was killed), or else
+      after ``settings.ADMISSION_SLOT_TIMEOUT``.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # One connection per thread and file; the path is read every time, so tests can override it
+        path = settings.ADMISSION_PATH
+        connections = self._local.__dict__.setdefault('connections', {})
+        if path not in connections:
+            # Not waiting long for the lock: the request is admitted without a check if it's not available
+            connection = sqlite3.connect(path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Nothing in it has to survive a power loss
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket ('
+                               'device_name TEXT PRIMARY KEY, tokens REAL, updated_at REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS slot ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER, acquired_at REAL)')
+            connections[path] = connection
+        return connections[path]
+
+    def admit(self, device_name: str) -> Admission:
+        """
+        Takes a slot and a token of the device, if both are available. The returned admission has the slot,
+        or the status code to reject the request with, and the number of seconds after which it may be retried.
+        """
+        now = time.time()
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM slot WHERE acquired_at < ?', (now - settings.ADMISSION_SLOT_TIMEOUT, ))
+            in_flight = connection.execute('SELECT COUNT(*) FROM slot').fetchone()[0]
+            if in_flight >= settings.ADMISSION_MAX_IN_FLIGHT:
+                in_flight -= self._free_abandoned_slots(connection)
+            if in_flight >= settings.ADMISSION_MAX_IN_FLIGHT:
+                connection.execute('COMMIT')
+                # Randomized, so the devices turned away together don't all come back at once
+                retry_after = settings.ADMISSION_RETRY_AFTER
+                return Admission(None, 503, random.randint(retry_after, 2 * retry_after))
+
+            rate, burst = settings.ADMISSION_DEVICE_RATE, settings.ADMISSION_DEVICE_BURST
+            row = connection.execute('SELECT tokens, updated_at FROM bucket WHERE device_name = ?',
+                                     (device_name, )).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            if tokens < 1:
+                connection.execute('COMMIT')
+                return Admission(None, 429, int(math.ceil((1 - tokens) / rate)))
+
+            connection.execute('INSERT OR REPLACE INTO bucket VALUES (?, ?, ?)', (device_name, tokens - 1, now))
+            slot = connection.execute('INSERT INTO slot (pid, acquired_at) VALUES (?, ?)',
+                                      (os.getpid(), now)).lastrowid
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return Admission(slot, 200, 0)
+
+    @staticmethod
+    def _free_abandoned_slots(connection: sqlite3.Connection) -> int:
+        """
+        Deletes the slots held by processes that don't exist anymore, and returns their number.
+        """
+        abandoned = [(slot, ) for slot, pid in connection.execute('SELECT id, pid FROM slot') if not _is_running(pid)]
+        connection.executemany('DELETE FROM slot WHERE id = ?', abandoned)
+        return len(abandoned)
+
+    def release(self, slot: int) -> None:
+        self._get_connection().execute('DELETE FROM slot WHERE id = ?', (slot, ))
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        # Signal 0 only checks that the process exists
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to another user
+        return True
+    return True
+
+
+admission_controller = AdmissionController()
+
+
+def admission_control(key_func: Callable[[HttpRequest], str]):
+    """
+    Decorator for the upload views: handles the request only if :data:`admission_controller` admits it,
+    with the device identified by ``key_func``, otherwise responds with ``429`` or ``503`` and a ``Retry-After``.
+    Put it below ``api_protect``, so unauthorized requests don't use up the tokens of a device.
+
+    If the state of the admission control can't be read or written (e.g. it stays locked), the request is handled
+    anyway: ``api_protect`` would turn the error into a ``401``, and the uploads matter more than the limits.
+    """
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            if not settings.ADMISSION_CONTROL_ENABLED:
+                return view_func(request, *args, **kwargs)
+
+            try:
+                admission = admission_controller.admit(key_func(request))
+            except sqlite3.Error:
+                logging.exception("Couldn't check the admission of a request to %s, handling it" % request.path_info)
+                return view_func(request, *args, **kwargs)
+
+            if admission.slot is None:
+                response = HttpResponse(status=admission.status, content="Try again later")
+                response['Retry-After'] = str(admission.retry_after)
+                return response
+            try:
+                return view_func(request, *args, **kwargs)
+            finally:
+                try:
+                    admission_controller.release(admission.slot)
+                except sqlite3.Error:
+                    # The request is done by now; the slot expires (see `AdmissionController`)
+                    logging.exception("Couldn't release admission slot %d" % admission.slot)
+
+        return _wrapped_view
+
+    return decorator
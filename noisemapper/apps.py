@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class NoisemapperConfig(AppConfig):
     name = 'noisemapper'
     verbose_name = 'NoiseMapper'
+
+    def ready(self):
+        from noisemapper.sqlite import configure_connection
+        connection_created.connect(configure_connection)
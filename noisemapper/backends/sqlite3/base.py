@@ -0,0 +1,15 @@
+from django.db.backends.sqlite3 import base
+
+from noisemapper.instrumentation import InstrumentedCursorWrapper, InstrumentedCursorDebugWrapper
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    Django's SQLite backend, with the queries of each request counted and timed (see :class:`RequestStats`).
+    """
+
+    def make_cursor(self, cursor):
+        return InstrumentedCursorWrapper(cursor, self)
+
+    def make_debug_cursor(self, cursor):
+        return InstrumentedCursorDebugWrapper(cursor, self)
@@ -0,0 +1,219 @@
+import datetime as dt
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from json import loads, dumps
+from typing import Dict, Iterable, List, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from noisemapper.metrics import metrics
+from noisemapper.models.archive import ArchivedMonth
+from noisemapper.models.clusters import RecordingCluster
+from noisemapper.models.ingest import IngestCheckpoint
+from noisemapper.models.recording import Recording, RecordingGroupTotals, MIC_SOURCE_CHOICES, GEOHASH_PRECISION
+from noisemapper.models.tiles import MapTile
+from noisemapper.response_cache import response_cache
+from noisemapper.utils import sjs, geohash_encode
+
+__all__ = ('create_recording', 'save_new_recordings', 'get_saved_uuids', 'IngestQueue', 'ingest_queue')
+
+
+# Number of records checked for duplicates and inserted at once
+UPLOAD_CHUNK_SIZE = 500
+
+
+def create_recording(json_data: dict, device_name: str) -> Recording:
+    """
+    An (unsaved) recording from a record in the format the app uploads. Raises KeyError, TypeError or ValueError
+    if the record is invalid.
+    """
+    location = json_data['state']['location']
+
+    recording = Recording()
+    recording.device_name = device_name
+
+    if 'uuid' in json_data:
+        recording.uuid = json_data['uuid']
+
+    recording.timestamp = dt.datetime.strptime(json_data['timestamp'], '%Y-%m-%d %H:%M:%S')
+
+    process_result = json_data['processResult']
+    recording.process_result = dumps(process_result, default=sjs)
+    recording.measurement_avg = process_result.get('avg', None)
+    recording.measurement_max = process_result.get('max', None)
+
+    device_state = json_data['state']
+    recording.device_state = dumps(device_state, default=sjs)
+    recording.mic_source = device_state.get('micSource', MIC_SOURCE_CHOICES[0][0]).lower()
+    recording.proximity = device_state.get('proximityText') or ''
+
+    recording.lat = float(location['lat'])
+    recording.lon = float(location['lon'])
+    recording.geohash = geohash_encode(recording.lat, recording.lon, GEOHASH_PRECISION)
+    return recording
+
+
+def save_new_recordings(recordings: List[Recording], seen_uuids: Set[str]) -> int:
+    """
+    Inserts the recordings that are not in the database yet. Clients re-send the whole batch if they
+    didn't get our response, so the ones whose uuid is already known (or in ``seen_uuids``) are skipped.
+    """
+    seen_uuids.update(get_saved_uuids(recordings))
+
+    new_recordings = []
+    for recording in recordings:
+        if recording.uuid and recording.uuid in seen_uuids:
+            logging.info("Skipping already uploaded recording %s" % recording.uuid)
+            continue
+        if recording.uuid:
+            seen_uuids.add(recording.uuid)
+        new_recordings.append(recording)
+
+    _bulk_create_recordings(new_recordings)
+    _recordings_added(new_recordings)
+    metrics.inc('noisemapper_recordings_saved_total', len(new_recordings))
+    return len(new_recordings)
+
+
+def get_saved_uuids(recordings: List[Recording]) -> Set[str]:
+    """
+    The uuids of the ``recordings`` that are saved already, in the main database or in the archive.
+    """
+    return set(_get_pks_by_uuid([r.uuid for r in recordings if r.uuid])) | ArchivedMonth.get_archived_uuids(recordings)
+
+
+def _bulk_create_recordings(recordings: List[Recording]) -> None:
+    """
+    Inserts the recordings, and sets their primary keys. ``bulk_create`` doesn't set them on SQLite, so they are
+    looked up by the (just checked to be new) uuids, and the recordings without one are saved one by one.
+    """
+    with_uuid = [r for r in recordings if r.uuid]
+    Recording.objects.bulk_create(with_uuid)
+    pks = _get_pks_by_uuid([r.uuid for r in with_uuid])
+    for recording in with_uuid:
+        recording.pk = pks[recording.uuid]
+
+    for recording in recordings:
+        if not recording.uuid:
+            recording.save()
+
+
+def _recordings_added(recordings: List[Recording]) -> None:
+    """
+    Updates everything derived from the recordings, after new ones were saved.
+    The cached responses are only invalidated once the recordings are committed: a response computed in between
+    would be cached from the old data (see ``ResponseCache.get_generation``).
+    """
+    RecordingGroupTotals.add_recordings(recordings)
+    RecordingCluster.add_recordings(recordings)
+    points = [(r.lat, r.lon) for r in recordings]
+    transaction.on_commit(lambda: _invalidate_responses(points))
+
+
+def _invalidate_responses(points: List[Tuple[float, float]]) -> None:
+    # The cache first: a tile computed from the old data is only kept if the generation hasn't changed since
+    # (see `api_get_tile`), so it has to change before the tile is deleted
+    response_cache.clear()
+    MapTile.invalidate(points)
+
+
+def _get_pks_by_uuid(uuids: List[str]) -> Dict[str, int]:
+    pks = {}
+    # Stay below SQLite's limit on the number of query parameters
+    for i in range(0, len(uuids), UPLOAD_CHUNK_SIZE):
+        chunk = uuids[i:i + UPLOAD_CHUNK_SIZE]
+        pks.update(Recording.objects.filter(uuid__in=chunk).values_list('uuid', 'pk'))
+    return pks
+
+
+class IngestQueue(object):
+    """
+    A durable queue of uploaded records, in its own SQLite file (``settings.INGEST_QUEUE_PATH``), so the upload
+    endpoints only have to append to it, and never wait for the write lock of the main database.
+    :meth:`drain` (run by the ``drain_ingest_queue`` command) saves the queued records in large transactions.
+
+    A record is only removed from the queue after it was saved. The last saved item is recorded in the main
+    database, with the recordings (see :class:`IngestCheckpoint`), so if draining is interrupted in between,
+    the items that were saved already are removed by the next drain, instead of being saved again.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # One connection per thread and file; the path is read every time, so tests can override it
+        path = settings.INGEST_QUEUE_PATH
+        connections = self._local.__dict__.setdefault('connections', {})
+        if path not in connections:
+            connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Every acknowledged upload has to survive a power loss
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute('CREATE TABLE IF NOT EXISTS item ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, device_name TEXT, record TEXT, '
+                               'received_at REAL)')
+            # Identifies the queue in `IngestCheckpoint`, as the ids of the items start over in a new file
+            connection.execute('CREATE TABLE IF NOT EXISTS queue (id TEXT)')
+            connection.execute('INSERT INTO queue SELECT ? WHERE NOT EXISTS (SELECT * FROM queue)',
+                               (str(uuid.uuid4()), ))
+            connections[path] = connection
+        return connections[path]
+
+    def put(self, device_name: str, records: Iterable[dict]) -> None:
+        """
+        Appends the records (without their snippets), all or none of them.
+        """
+        now = time.time()
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT INTO item (device_name, record, received_at) VALUES (?, ?, ?)',
+                                   ((device_name, dumps(record, default=sjs), now) for record in records))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+    def __len__(self) -> int:
+        return self._get_connection().execute('SELECT COUNT(*) FROM item').fetchone()[0]
+
+    def drain(self, max_items: int) -> Tuple[int, int]:
+        """
+        Saves (at most ``max_items`` of) the oldest queued records in one transaction, and removes them from
+        the queue. Returns the number of records taken from the queue, and the number of new recordings saved.
+        """
+        connection = self._get_connection()
+        queue_id = connection.execute('SELECT id FROM queue').fetchone()[0]
+        checkpoint = IngestCheckpoint.objects.filter(queue_id=queue_id).values_list('last_item_id', flat=True).first()
+        if checkpoint is not None:
+            # Saved by a drain that was interrupted before it removed them
+            connection.execute('DELETE FROM item WHERE id <= ?', (checkpoint, ))
+
+        items = connection.execute('SELECT id, device_name, record FROM item ORDER BY id LIMIT ?',
+                                   (max_items, )).fetchall()
+        if not items:
+            return 0, 0
+
+        recordings = []
+        for item_id, device_name, record in items:
+            try:
+                recordings.append(create_recording(loads(record), device_name))
+            except (KeyError, TypeError, ValueError):
+                logging.exception("Dropping queued record %d, it can't be saved" % item_id)
+
+        saved_count = 0
+        with transaction.atomic():
+            seen_uuids = set()
+            for i in range(0, len(recordings), UPLOAD_CHUNK_SIZE):
+                saved_count += save_new_recordings(recordings[i:i + UPLOAD_CHUNK_SIZE], seen_uuids)
+            IngestCheckpoint.objects.update_or_create(queue_id=queue_id, defaults=dict(last_item_id=items[-1][0]))
+
+        connection.execute('DELETE FROM item WHERE id <= ?', (items[-1][0], ))
+        return len(items), saved_count
+
+
+ingest_queue = IngestQueue()
@@ -0,0 +1,127 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+
+__all__ = ('RequestStats', 'start_request_stats', 'get_request_stats', 'timing',
+           'InstrumentedCursorWrapper', 'InstrumentedCursorDebugWrapper')
+
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """
+    What the current request of a thread spent its time on: the number of its SQL queries, the time they took
+    (including fetching their results), the number of rows fetched, and the time of each instrumented section
+    (see :func:`timing`), in seconds.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.sql_rows = 0
+        self.timings = {}
+
+    def add_timing(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def get_elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+
+def start_request_stats() -> RequestStats:
+    """
+    Starts collecting the statistics of a new request in this thread.
+    They are collected until the next request starts, so a streamed response body is still counted.
+    """
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def get_request_stats() -> Optional[RequestStats]:
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def timing(name: str) -> Iterator[None]:
+    """
+    Adds the time spent in the block to the ``name`` timing of the current request, if any.
+    """
+    stats = get_request_stats()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_timing(name, time.perf_counter() - start)
+
+
+@contextmanager
+def _sql_timing(is_query: bool) -> Iterator[None]:
+    stats = get_request_stats()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.sql_time += time.perf_counter() - start
+        if is_query:
+            stats.sql_count += 1
+
+
+def _count_rows(count: int) -> None:
+    stats = get_request_stats()
+    if stats is not None:
+        stats.sql_rows += count
+
+
+class InstrumentedCursorWrapper(CursorWrapper):
+    """
+    Counts and times the queries, and counts the fetched rows, for :class:`RequestStats`.
+    SQLite computes the results while they are fetched, so fetching counts as query time.
+    """
+
+    def execute(self, sql, params=None):
+        with _sql_timing(is_query=True):
+            return super(InstrumentedCursorWrapper, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        with _sql_timing(is_query=True):
+            return super(InstrumentedCursorWrapper, self).executemany(sql, param_list)
+
+    def fetchone(self):
+        with _sql_timing(is_query=False), self.db.wrap_database_errors:
+            row = self.cursor.fetchone()
+        _count_rows(0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args):
+        with _sql_timing(is_query=False), self.db.wrap_database_errors:
+            rows = self.cursor.fetchmany(*args)
+        _count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        with _sql_timing(is_query=False), self.db.wrap_database_errors:
+            rows = self.cursor.fetchall()
+        _count_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in super(InstrumentedCursorWrapper, self).__iter__():
+            _count_rows(1)
+            yield row
+
+
+class InstrumentedCursorDebugWrapper(InstrumentedCursorWrapper, CursorDebugWrapper):
+    """
+    Same as :class:`InstrumentedCursorWrapper`, for when the queries are logged too (``DEBUG = True``).
+    """
@@ -0,0 +1,120 @@
+import base64
+import datetime as dt
+import os
+import random
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from typing import List
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.test.client import Client
+from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+
+from noisemapper.ingest import create_recording
+from noisemapper.metrics import metrics
+from noisemapper.models import Recording, RecordingCluster, RecordingGroupTotals
+from noisemapper.snippet_storage import snippet_path
+
+# Number of recordings generated and inserted at once by `populate_database`
+POPULATE_CHUNK_SIZE = 1000
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+@contextmanager
+def test_database(on_disk=False):
+    """
+    Runs the block against throwaway copies of the databases (like the test runner does), an empty
+    response cache, ingest queue, metrics registry and admission state, so benchmarks never touch the real ones.
+    The databases are in memory, unless ``on_disk`` is set, e.g. so several processes can use them.
+    """
+    setup_test_environment()
+    old_test_names = {alias: connections[alias].settings_dict['TEST']['NAME'] for alias in connections}
+    old_names = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            for alias in connections:
+                connection = connections[alias]
+                if on_disk:
+                    connection.settings_dict['TEST']['NAME'] = os.path.join(temp_dir, '%s.sqlite3' % alias)
+                old_names[alias] = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            with override_settings(RESPONSE_CACHE_PATH=os.path.join(temp_dir, 'response_cache.sqlite3'),
+                                   INGEST_QUEUE_PATH=os.path.join(temp_dir, 'ingest_queue.sqlite3'),
+                                   METRICS_PATH=os.path.join(temp_dir, 'metrics.sqlite3'),
+                                   ADMISSION_PATH=os.path.join(temp_dir, 'admission.sqlite3')):
+                try:
+                    yield
+                finally:
+                    # Into the throwaway file, so nothing counted in the block is written to the real one later
+                    metrics.flush()
+        finally:
+            for alias, old_name in old_names.items():
+                connections[alias].creation.destroy_test_db(old_name, verbosity=0)
+                connections[alias].settings_dict['TEST']['NAME'] = old_test_names[alias]
+            teardown_test_environment()
+
+
+def make_api_client() -> Client:
+    return Client(
+        HTTP_X_NOISEMAPPER_API_AUTH=base64.b64encode(settings.API_SECRET.encode('utf-8')).decode('ascii'),
+        HTTP_X_NOISEMAPPER_API_DEVICE_NAME=base64.b64encode(b'benchmark').decode('ascii'),
+    )
+
+
+def make_processed_record(rnd: random.Random, snippet_size=0, spread=0.1) -> dict:
+    """
+    A record in the format the app uploads, see ``create_recording``, from an area of ``spread`` degrees
+    of longitude (and half as many of latitude) in Oslo.
+    """
+    timestamp = dt.datetime(2017, 3, 1) + dt.timedelta(seconds=rnd.randrange(90 * 24 * 3600))
+    record = {
+        'uuid': str(uuid.UUID(int=rnd.getrandbits(128))),
+        'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'processResult': {'avg': rnd.uniform(30, 70), 'max': rnd.uniform(70, 100)},
+        'state': {
+            'location': {'lat': 59.94 + rnd.uniform(-spread / 2, spread / 2),
+                         'lon': 10.72 + rnd.uniform(-spread, spread)},
+            'proximityText': rnd.choice(['NEAR', 'FAR']),
+            'micSource': rnd.choice(['INTERNAL', 'HEADSET']),
+        },
+    }
+    if snippet_size:
+        record['file'] = base64.b64encode(bytes(rnd.getrandbits(8) for _ in range(snippet_size))).decode('ascii')
+    return record
+
+
+def populate_database(rnd: random.Random, count: int, devices=1, spread=0.1, snippet_size=0) -> List[str]:
+    """
+    Fills the (throwaway) database with ``count`` recordings like :func:`make_processed_record`'s, of ``devices``
+    devices in turn, and rebuilds what is derived from them. The same ``rnd`` seed gives the same recordings.
+    If ``snippet_size`` is set, the recordings of the first device get a snippet file of that many bytes.
+    Returns the names of the devices.
+    """
+    device_names = ['benchmark-%d' % i for i in range(devices)]
+    snippet = bytes(rnd.getrandbits(8) for _ in range(snippet_size))
+
+    with transaction.atomic():
+        for start in range(0, count, POPULATE_CHUNK_SIZE):
+            recordings = [create_recording(make_processed_record(rnd, spread=spread), device_names[i % devices])
+                          for i in range(start, min(start + POPULATE_CHUNK_SIZE, count))]
+            Recording.objects.bulk_create(recordings)
+
+            if snippet_size:
+                for recording in recordings:
+                    if recording.device_name != device_names[0]:
+                        continue
+                    path = snippet_path(recording.uuid)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as fh:
+                        fh.write(snippet)
+
+        RecordingGroupTotals.rebuild()
+        RecordingCluster.rebuild()
+    return device_names
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from noisemapper.models import Recording
+from noisemapper.models.recording import GEOHASH_PRECISION
+from noisemapper.response_cache import response_cache
+from noisemapper.utils import geohash_encode
+
+
+class Command(BaseCommand):
+    help = 'Fills Recording.geohash from the location, for recordings uploaded before the column existed, ' \
+           'in the main and in the archive database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        for database in (DEFAULT_DB_ALIAS, settings.RECORDING_ARCHIVE_DATABASE):
+            updated = _backfill(database, options['chunk_size'])
+            self.stdout.write('Filled the geohash of %d recordings in the %s database' % (updated, database))
+
+        # Cached cell-aggregated map responses left these recordings out
+        response_cache.clear()
+
+
+def _backfill(database: str, chunk_size: int) -> int:
+    connection = connections[database]
+    sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+        connection.ops.quote_name(Recording._meta.db_table),
+        connection.ops.quote_name(Recording._meta.get_field('geohash').column),
+        connection.ops.quote_name(Recording._meta.pk.column),
+    )
+    queryset = Recording.objects.using(database).filter(geohash=None).exclude(lat=None).exclude(lon=None)
+
+    updated = 0
+    while True:
+        with transaction.atomic(using=database):
+            rows = list(queryset.order_by('pk').values_list('pk', 'lat', 'lon')[:chunk_size])
+            if not rows:
+                break
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, [(geohash_encode(lat, lon, GEOHASH_PRECISION), pk)
+                                         for pk, lat, lon in rows])
+        updated += len(rows)
+    return updated
@@ -0,0 +1,56 @@
+import json
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from noisemapper.models import Recording
+from noisemapper.response_cache import response_cache
+
+
+class Command(BaseCommand):
+    help = 'Fills Recording.proximity from the proximityText of the stored device_state, ' \
+           'for recordings uploaded before the column existed, in the main and in the archive database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for database in (DEFAULT_DB_ALIAS, settings.RECORDING_ARCHIVE_DATABASE):
+            updated = _backfill(database, options['chunk_size'])
+            self.stdout.write('Filled the proximity of %d recordings in the %s database' % (updated, database))
+
+        # Cached map responses contain the proximity
+        response_cache.clear()
+
+
+def _backfill(database: str, chunk_size: int) -> int:
+    """
+    Fills the proximity one chunk at a time: the chunk is read completely before it's updated, so no query is open
+    on the table while it changes. The recordings without a proximityText stay empty, and the next chunk starts
+    after them.
+    """
+    queryset = Recording.objects.using(database).filter(proximity='').exclude(device_state=None)
+
+    updated = 0
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'device_state')[:chunk_size])
+        if not rows:
+            return updated
+        last_pk = rows[-1][0]
+
+        pks_by_proximity = {}
+        for pk, device_state in rows:
+            try:
+                proximity = json.loads(device_state).get('proximityText') or ''
+            except (ValueError, AttributeError):
+                logging.exception("Couldn't parse the device state of recording %d" % pk)
+                continue
+            if proximity:
+                pks_by_proximity.setdefault(proximity, []).append(pk)
+
+        with transaction.atomic(using=database):
+            for proximity, pks in pks_by_proximity.items():
+                updated += Recording.objects.using(database).filter(pk__in=pks).update(proximity=proximity)
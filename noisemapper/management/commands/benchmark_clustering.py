@@ -0,0 +1,84 @@
+import decimal as dec
+import random
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand, CommandError
+
+from noisemapper.management.commands._benchmark_utils import timed
+from noisemapper.parallel_clustering import ParallelClusterer
+from noisemapper.utils import cluster_data, grid_cluster_data, distance, GeoWeightedMiddle
+
+
+class Command(BaseCommand):
+    help = 'Compares the linear-scan and the grid based clustering on synthetic recordings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--points', type=int, default=10000)
+        parser.add_argument('--resolution', default='50', help='In meters, like the resolution parameter of the map API')
+        parser.add_argument('--spread', type=float, default=0.1, help='Size of the area, in degrees')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--skip-old', action='store_true', help="Don't run the (slow) linear-scan clustering")
+        parser.add_argument('--processes', type=int, default=0,
+                            help='Also run the parallel clustering with this many processes')
+
+    def handle(self, *args, **options):
+        resolution = dec.Decimal(options['resolution'])
+        data = _make_synthetic_data(options['points'], options['spread'], options['seed'])
+
+        def aggregator_factory():
+            return GeoWeightedMiddle(extractor=(lambda r: (r.lat, r.lon, r.measurement_avg)))
+
+        new_time, new_result = timed(lambda: grid_cluster_data(
+            data,
+            key_func=(lambda r: (r.lat, r.lon)),
+            resolution=resolution,
+            aggregator_factory=aggregator_factory,
+        ))
+        self.stdout.write('grid:   %d points -> %d clusters in %.3f s' % (len(data), len(new_result), new_time))
+
+        if options['processes'] > 1:
+            clusterer = ParallelClusterer(processes=options['processes'], min_rows=0)
+            try:
+                # Starts the processes, so that isn't measured
+                clusterer.group(data[:clusterer.processes], key_func=(lambda r: (r.lat, r.lon)), resolution=resolution)
+                parallel_time, parallel_result = timed(lambda: clusterer.cluster(
+                    data,
+                    key_func=(lambda r: (r.lat, r.lon)),
+                    value_func=(lambda r: (r.lat, r.lon, r.measurement_avg)),
+                    resolution=resolution,
+                    aggregator_class=GeoWeightedMiddle,
+                ))
+            finally:
+                clusterer.shutdown()
+            differing = sum(1 for key, value in parallel_result.items() if new_result.get(key) != value)
+            self.stdout.write('parallel: %d points -> %d clusters in %.3f s, %d clusters differ from grid (edges)'
+                              % (len(data), len(parallel_result), parallel_time, differing))
+
+        if options['skip_old']:
+            return
+
+        old_time, old_result = timed(lambda: cluster_data(
+            data,
+            key_func=(lambda r: (r.lat, r.lon)),
+            is_same_func=(lambda a, b: distance(a, b) < resolution),
+            aggregator_factory=aggregator_factory,
+        ))
+        self.stdout.write('linear: %d points -> %d clusters in %.3f s' % (len(data), len(old_result), old_time))
+
+        if list(old_result.items()) != list(new_result.items()):
+            raise CommandError('The two clusterings differ!')
+        self.stdout.write('Results are identical, speedup: %.1fx' % (old_time / new_time if new_time else float('inf')))
+
+
+def _make_synthetic_data(count, spread, seed):
+    rnd = random.Random(seed)
+    center_lat, center_lon = 59.94, 10.72  # Oslo
+    return [
+        SimpleNamespace(
+            lat=center_lat + rnd.uniform(-spread / 2, spread / 2),
+            lon=center_lon + rnd.uniform(-spread, spread),
+            measurement_avg=rnd.uniform(30, 90),
+        )
+        for _ in range(count)
+    ]
+
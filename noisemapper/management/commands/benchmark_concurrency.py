@@ -0,0 +1,110 @@
+import multiprocessing
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from noisemapper.ingest import create_recording, save_new_recordings
+from noisemapper.management.commands._benchmark_utils import timed, test_database, make_processed_record
+
+# SQLite's own defaults, to compare with
+DEFAULT_PRAGMAS = [
+    ('journal_mode', 'DELETE'),
+    ('synchronous', 'FULL'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Measures the latency of map reads in one process, while another one saves batches of recordings ' \
+           '(like drain_ingest_queue does), with the default and with the tuned SQLite settings (SQLITE_PRAGMAS), ' \
+           'on a throwaway database file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=10, help='In seconds, per setting')
+        parser.add_argument('--readers', type=int, default=1, help='Number of reading processes')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of recordings saved per transaction')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        for name, pragmas in (('default', DEFAULT_PRAGMAS), ('tuned', settings.SQLITE_PRAGMAS)):
+            with override_settings(SQLITE_PRAGMAS=pragmas), test_database(on_disk=True):
+                read_latencies, write_latencies = self._run(options)
+
+            read_latencies.sort()
+            written = len(write_latencies) * options['batch_size']
+            self.stdout.write(
+                '%-7s  reads: %5d, p50 %.4f s, p99 %.4f s, max %.4f s   writes: %6.1f records/s'
+                % (name, len(read_latencies), _percentile(read_latencies, 50), _percentile(read_latencies, 99),
+                   read_latencies[-1] if read_latencies else float('nan'), written / options['duration'])
+            )
+
+    def _run(self, options):
+        rnd = random.Random(options['seed'])
+
+        # The readers only look at these, so their work doesn't grow while the writer adds recordings
+        with transaction.atomic():
+            save_new_recordings([create_recording(make_processed_record(rnd), 'benchmark-reader')
+                                 for _ in range(500)], set())
+        User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+        client = Client()
+        client.login(username='benchmark', password='benchmark')
+
+        # SQLite connections must not be used across fork()
+        connections.close_all()
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        deadline = time.perf_counter() + options['duration']
+        processes = [context.Process(target=_write, args=(rnd.random(), options['batch_size'], deadline, results))]
+        processes += [context.Process(target=_read, args=(client, deadline, results))
+                      for _ in range(options['readers'])]
+        for process in processes:
+            process.start()
+
+        read_latencies, write_latencies = [], []
+        for _ in processes:
+            kind, latencies = results.get()
+            (read_latencies if kind == 'read' else write_latencies).extend(latencies)
+        for process in processes:
+            process.join()
+        return read_latencies, write_latencies
+
+
+def _write(seed: float, batch_size: int, deadline: float, results: multiprocessing.Queue) -> None:
+    rnd = random.Random(seed)
+    latencies = []
+    while time.perf_counter() < deadline:
+        recordings = [create_recording(make_processed_record(rnd), 'benchmark') for _ in range(batch_size)]
+
+        def save():
+            with transaction.atomic():
+                save_new_recordings(recordings, set())
+
+        latencies.append(timed(save)[0])
+    results.put(('write', latencies))
+
+
+def _read(client: Client, deadline: float, results: multiprocessing.Queue) -> None:
+    latencies = []
+    while time.perf_counter() < deadline:
+        query = dict(deviceNames='benchmark-reader', micSources='internal|headset', is_cropping='false',
+                     # Different every time, so the response is never served from the response cache
+                     resolution='%.6f' % (100 + len(latencies) / 1e4), maxOrAvg='measurement_avg')
+
+        def read():
+            response = client.get('/api/get_actual_data/', query)
+            return b''.join(response.streaming_content) if response.streaming else response.content
+
+        latencies.append(timed(read)[0])
+    results.put(('read', latencies))
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[(len(sorted_values) * percent - 1) // 100]
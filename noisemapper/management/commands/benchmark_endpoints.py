@@ -0,0 +1,149 @@
+import datetime as dt
+import decimal as dec
+import json
+import platform
+import random
+import subprocess
+import tempfile
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from noisemapper.management.commands._benchmark_utils import timed, test_database, make_api_client, \
+    make_processed_record, populate_database
+from noisemapper.models import Recording, RecordingRow
+from noisemapper.response_cache import response_cache
+from noisemapper.utils import cluster_data, grid_cluster_data, distance, GeoWeightedMiddle
+
+
+class Command(BaseCommand):
+    help = 'Times the map, download and upload endpoints (through the test client), and the clustering functions, ' \
+           'on throwaway databases of generated recordings, one per --rows. ' \
+           'Writes the results as JSON (--output), and compares them with an earlier run (--compare).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                            help='Number of recordings of each database, e.g. 10000 100000 1000000')
+        parser.add_argument('--devices', type=int, default=4)
+        parser.add_argument('--spread', type=float, default=0.1, help='Size of the area, in degrees')
+        parser.add_argument('--resolution', default='50', help='In meters, like the resolution parameter of the map API')
+        parser.add_argument('--snippet-size', type=int, default=1024,
+                            help='Size of the snippet files of the first device, which are downloaded, in bytes')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of records uploaded per batch')
+        parser.add_argument('--linear-rows', type=int, default=5000,
+                            help='cluster_data compares every point with every cluster, so it only gets this many')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='Compare the results with the ones in this JSON file')
+
+    def handle(self, *args, **options):
+        results = []
+        for rows in options['rows']:
+            results.extend(self._run(rows, options))
+
+        report = dict(
+            commit=_get_commit(),
+            created_at=dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            python=platform.python_version(),
+            django=django.get_version(),
+            options={k: options[k] for k in ('rows', 'devices', 'spread', 'resolution', 'snippet_size',
+                                              'batch_size', 'linear_rows', 'repeat', 'seed')},
+            results=results,
+        )
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump(report, fh, indent=2)
+
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as fh:
+                previous = {(r['name'], r['dataset']): r for r in json.load(fh)['results']}
+
+        for result in results:
+            line = '%-20s %8d of %8d rows: median %8.4f s, min %8.4f s' % (
+                result['name'], result['rows'], result['dataset'], result['median'], result['min'])
+            old = previous.get((result['name'], result['dataset']))
+            if old:
+                line += '   (was %.4f s, %+.1f%%)' % (old['median'], (result['median'] / old['median'] - 1) * 100)
+            self.stdout.write(line)
+
+    def _run(self, rows, options):
+        rnd = random.Random(options['seed'])
+        resolution = options['resolution']
+        results = []
+
+        def measure(name, func, count=rows):
+            times = []
+            for _ in range(options['repeat']):
+                # Every run is computed, not served from the cache
+                response_cache.clear()
+                times.append(timed(func)[0])
+            times.sort()
+            results.append(dict(name=name, dataset=rows, rows=count, times=times, min=times[0],
+                                median=times[len(times) // 2]))
+
+        with test_database(on_disk=True), tempfile.TemporaryDirectory() as snippet_dir, \
+                override_settings(SNIPPET_STORAGE_DIR=snippet_dir, INGEST_QUEUE_ENABLED=False,
+                                  ADMISSION_CONTROL_ENABLED=False):
+            elapsed, device_names = timed(lambda: populate_database(
+                rnd, rows, devices=options['devices'], spread=options['spread'], snippet_size=options['snippet_size']))
+            self.stdout.write('Generated %d recordings in %.1f s' % (rows, elapsed))
+
+            User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+            client = Client()
+            client.login(username='benchmark', password='benchmark')
+            query = dict(deviceNames='|'.join(device_names), micSources='internal|headset', is_cropping='false',
+                         resolution=resolution, maxOrAvg='measurement_avg')
+
+            def get(path, **params):
+                response = client.get(path, dict(query, **params))
+                if response.status_code != 200:
+                    raise CommandError('%s failed with status %d' % (path, response.status_code))
+                return b''.join(response.streaming_content) if response.streaming else response.content
+
+            measure('actual_data', lambda: get('/api/get_actual_data/'))
+            measure('actual_data_summary', lambda: get('/api/get_actual_data/', layout='summary'))
+            measure('actual_data_cells', lambda: get('/api/get_actual_data/', aggregation='cells'))
+            measure('deviation_data', lambda: get('/api/get_deviation_data/'))
+            measure('download', lambda: get('/api/download/', deviceNames=device_names[0]),
+                    count=Recording.objects.filter(device_name=device_names[0]).count())
+
+            data = sorted(RecordingRow.from_queryset(Recording.objects.all()), key=lambda r: r.pk)
+            key_func = (lambda r: (r.lat, r.lon))
+            decimal_resolution = dec.Decimal(resolution)
+
+            def aggregator_factory():
+                return GeoWeightedMiddle(extractor=(lambda r: (r.lat, r.lon, r.measurement_avg)))
+
+            measure('grid_cluster_data', lambda: grid_cluster_data(
+                data, key_func=key_func, resolution=decimal_resolution, aggregator_factory=aggregator_factory))
+            linear_data = data[:options['linear_rows']]
+            measure('cluster_data', lambda: cluster_data(
+                linear_data, key_func=key_func, is_same_func=(lambda a, b: distance(a, b) < decimal_resolution),
+                aggregator_factory=aggregator_factory), count=len(linear_data))
+
+            # Last, as it adds recordings
+            api_client = make_api_client()
+            bodies = iter([json.dumps([make_processed_record(rnd) for _ in range(options['batch_size'])])
+                           for _ in range(options['repeat'])])
+
+            def upload():
+                response = api_client.post('/api/upload_recording_batch/', next(bodies),
+                                           content_type='application/json')
+                if response.status_code != 200:
+                    raise CommandError('Upload failed with status %d' % response.status_code)
+
+            measure('upload_batch', upload, count=options['batch_size'])
+
+        return results
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,58 @@
+import json
+import random
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from noisemapper.ingest import ingest_queue
+from noisemapper.management.commands._benchmark_utils import timed, test_database, make_api_client, \
+    make_processed_record
+from noisemapper.snippet_storage import snippet_writer
+
+
+class Command(BaseCommand):
+    help = 'Measures the throughput and latency of api_upload_recording_batch, and the throughput of draining ' \
+           'the ingest queue, in records per second, on a throwaway database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-sizes', default='1,100,1000')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of batches uploaded per batch size')
+        parser.add_argument('--snippet-size', type=int, default=0, help='Size of the attached audio file, in bytes')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--no-queue', action='store_true',
+                            help='Save the records in the upload request, like with INGEST_QUEUE_ENABLED=false')
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        batch_sizes = [int(x) for x in options['batch_sizes'].split(',')]
+
+        with test_database(), tempfile.TemporaryDirectory() as snippet_dir, \
+                override_settings(SNIPPET_STORAGE_DIR=snippet_dir, INGEST_QUEUE_ENABLED=not options['no_queue'],
+                                  ADMISSION_CONTROL_ENABLED=False):
+            client = make_api_client()
+            for batch_size in batch_sizes:
+                total_time = 0
+                latencies = []
+                for _ in range(options['repeat']):
+                    batch = [make_processed_record(rnd, options['snippet_size']) for _ in range(batch_size)]
+                    body = json.dumps(batch)
+                    elapsed, response = timed(
+                        lambda: client.post('/api/upload_recording_batch/', body, content_type='application/json'))
+                    if response.status_code != 200:
+                        raise CommandError('Upload failed with status %d' % response.status_code)
+                    total_time += elapsed
+                    latencies.append(elapsed)
+
+                latencies.sort()
+                records = batch_size * options['repeat']
+                self.stdout.write('batch of %5d: %8.1f records/s (%.4f s per batch, p50 %.4f s, p99 %.4f s)'
+                                  % (batch_size, records / total_time, total_time / options['repeat'],
+                                     latencies[len(latencies) // 2], latencies[(len(latencies) * 99 - 1) // 100]))
+
+                if not options['no_queue']:
+                    drain_time, _ = timed(lambda: ingest_queue.drain(records))
+                    self.stdout.write('  drained in %.4f s: %8.1f records/s' % (drain_time, records / drain_time))
+
+            # Let the background writers finish before the snippet directory is removed
+            snippet_writer.shutdown()
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from noisemapper.ingest import ingest_queue
+from noisemapper.metrics import metrics
+
+
+class Command(BaseCommand):
+    help = 'Saves the uploaded records waiting in the ingest queue (see IngestQueue).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of records saved per transaction')
+        parser.add_argument('--follow', action='store_true',
+                            help='Keep waiting for new records, instead of exiting when the queue is empty')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait before looking at an empty queue again, with --follow')
+
+    def handle(self, *args, **options):
+        while True:
+            taken, saved = ingest_queue.drain(options['batch_size'])
+            metrics.flush()
+            if taken:
+                self.stdout.write('Took %d records from the queue, saved %d new recordings' % (taken, saved))
+            elif not options['follow']:
+                break
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from noisemapper.models import RecordingCluster
+from noisemapper.response_cache import response_cache
+
+
+class Command(BaseCommand):
+    help = 'Clusters all the recordings again, at the resolutions of CLUSTER_STORE_RESOLUTIONS ' \
+           '(see RecordingCluster). Run it after changing them, and once after the migrations that added ' \
+           'the clusters and their sums.'
+
+    def handle(self, *args, **options):
+        RecordingCluster.rebuild()
+        # Cached map responses may have been clustered without the store
+        response_cache.clear()
+
+        for resolution in settings.CLUSTER_STORE_RESOLUTIONS:
+            count = RecordingCluster.objects.filter(resolution=resolution).count()
+            self.stdout.write('%d m: %d clusters' % (resolution, count))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from noisemapper.models import RecordingGroupTotals
+from noisemapper.response_cache import response_cache
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the per (device_name, mic_source) measurement totals from the recordings, ' \
+           'including the archived ones. Run it once after the migrations, if there is an archive.'
+
+    def handle(self, *args, **options):
+        RecordingGroupTotals.rebuild()
+        # Cached deviation responses were computed from the old totals
+        response_cache.clear()
+        self.stdout.write('Rebuilt the totals of %d groups' % RecordingGroupTotals.objects.count())
@@ -0,0 +1,33 @@
+import datetime as dt
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from noisemapper.models import ArchivedMonth, RecordingCluster
+from noisemapper.models.archive import add_months
+from noisemapper.response_cache import response_cache
+
+
+class Command(BaseCommand):
+    help = 'Moves the recordings of the months before the last RECORDING_HOT_MONTHS into the archive database ' \
+           '(see ArchivedMonth), and clusters the remaining ones again. ' \
+           'Run "migrate --database %s" once, before the first rollover.' % settings.RECORDING_ARCHIVE_DATABASE
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=settings.RECORDING_HOT_MONTHS,
+                            help='Number of months (including the current one) kept in the main database')
+
+    def handle(self, *args, **options):
+        before = add_months(dt.date.today().replace(day=1), 1 - max(options['keep_months'], 1))
+        moved_count = ArchivedMonth.archive_before(before)
+        self.stdout.write('Moved %d recordings from before %s into the archive' % (moved_count, before))
+        if not moved_count:
+            return
+
+        # The moved recordings were taken out of the stored clusters
+        RecordingCluster.rebuild()
+        # Cached map responses were clustered with the old stored clusters
+        response_cache.clear()
+        for archived_month in ArchivedMonth.objects.order_by('month'):
+            self.stdout.write('%s: %d recordings' % (archived_month.month.strftime('%Y-%m'),
+                                                     archived_month.recording_count))
@@ -0,0 +1,174 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+__all__ = ('Metric', 'METRICS', 'MetricsRegistry', 'metrics')
+
+
+Metric = namedtuple('Metric', ('kind', 'help', 'buckets'))
+
+# In seconds; fine enough around the usual response times for p50 / p99 (histogram_quantile) to be meaningful
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.35, 0.5, 0.75, 1, 1.5, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)  # In bytes
+COUNT_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+
+METRICS = {
+    'noisemapper_requests_total': Metric(
+        'counter', 'Requests, by view and status code', None),
+    'noisemapper_request_duration_seconds': Metric(
+        'histogram', 'Time from the start of a request to the end of its (possibly streamed) response, by view',
+        LATENCY_BUCKETS),
+    'noisemapper_response_size_bytes': Metric(
+        'histogram', 'Size of the response bodies, as sent (i.e. compressed, if they are), by view', SIZE_BUCKETS),
+    'noisemapper_records_received_total': Metric(
+        'counter', 'Records accepted by the upload endpoints, by view', None),
+    'noisemapper_recordings_saved_total': Metric(
+        'counter', 'New recordings saved, from the uploads or the ingest queue (duplicates not included)', None),
+    'noisemapper_snippet_bytes_written_total': Metric(
+        'counter', 'Bytes of the uploaded snippets written to the disk', None),
+    'noisemapper_map_clusters': Metric(
+        'histogram', 'Number of clusters (or cells) in the map responses and tiles, by aggregation', COUNT_BUCKETS),
+    'noisemapper_ingest_queue_records': Metric(
+        'gauge', 'Records waiting in the ingest queue, when the metrics were last read', None),
+}
+
+
+class MetricsRegistry(object):
+    """
+    The counters, histograms and gauges of :data:`METRICS`, added up over all the processes (the uWSGI workers
+    and the commands, e.g. ``drain_ingest_queue``), in an SQLite file (``settings.METRICS_PATH``),
+    like the response cache.
+
+    Changes are collected in memory, and written by :meth:`flush` in one transaction. In every process, a daemon
+    thread (started with the first change) flushes them every ``settings.METRICS_FLUSH_INTERVAL`` seconds, so the
+    requests don't wait for the file, which all the workers write to. The commands flush when they are done with
+    a batch. Changes that couldn't be written are kept for the next flush.
+    Histograms are stored with cumulative buckets, the way :meth:`render` has to output them.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}  # (name, labels, le) -> increment
+        self._gauges = {}  # (name, labels, le) -> value
+        self._flusher_pid = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # One connection per thread and file; the path is read every time, so tests can override it
+        path = settings.METRICS_PATH
+        connections = self._local.__dict__.setdefault('connections', {})
+        if path not in connections:
+            connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Losing the last few increments in a power loss is fine, waiting for the disk on every request isn't
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS sample ('
+                               'name TEXT, labels TEXT, le TEXT, value REAL, PRIMARY KEY (name, labels, le))')
+            connections[path] = connection
+        return connections[path]
+
+    def _start_flusher(self) -> None:
+        # Threads don't survive a fork, so a uWSGI worker starts its own, even if the master had one
+        if self._flusher_pid != os.getpid():
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._flush_periodically, name='metrics-flusher', daemon=True).start()
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def _add(self, name: str, labels: dict, value: float, le: str = '') -> None:
+        key = (name, _format_labels(labels), le)
+        self._pending[key] = self._pending.get(key, 0) + value
+        self._start_flusher()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        assert METRICS[name].kind == 'counter'
+        with self._lock:
+            self._add(name, labels, value)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        metric = METRICS[name]
+        assert metric.kind == 'histogram'
+        with self._lock:
+            for bucket in metric.buckets:
+                if value <= bucket:
+                    self._add(name + '_bucket', labels, 1, le=repr(float(bucket)))
+            self._add(name + '_bucket', labels, 1, le='+Inf')
+            self._add(name + '_sum', labels, value)
+            self._add(name + '_count', labels, 1)
+
+    def set(self, name: str, value: float, **labels) -> None:
+        assert METRICS[name].kind == 'gauge'
+        with self._lock:
+            self._gauges[(name, _format_labels(labels), '')] = value
+            self._start_flusher()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            gauges, self._gauges = self._gauges, {}
+        if not pending and not gauges:
+            return
+
+        try:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany('INSERT OR IGNORE INTO sample VALUES (?, ?, ?, 0)', pending.keys())
+                connection.executemany('UPDATE sample SET value = value + ? WHERE name = ? AND labels = ? AND le = ?',
+                                       ((value, ) + key for key, value in pending.items()))
+                connection.executemany('INSERT OR REPLACE INTO sample VALUES (?, ?, ?, ?)',
+                                       (key + (value, ) for key, value in gauges.items()))
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            # The metrics are not worth failing a request for; they are written with the next flush instead
+            logging.exception("Couldn't write %d metric samples" % (len(pending) + len(gauges)))
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+                for key, value in gauges.items():
+                    # Unless the gauge has been set again since
+                    self._gauges.setdefault(key, value)
+
+    def render(self) -> str:
+        """
+        The stored metrics in the Prometheus text exposition format.
+        """
+        samples = {}
+        for name, labels, le, value in self._get_connection().execute('SELECT name, labels, le, value FROM sample'):
+            samples.setdefault(name, []).append((labels, le, value))
+
+        lines = []
+        for name, metric in sorted(METRICS.items()):
+            suffixes = ('_bucket', '_sum', '_count') if metric.kind == 'histogram' else ('', )
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for suffix in suffixes:
+                for labels, le, value in sorted(samples.get(name + suffix, []),
+                                                key=lambda s: (s[0], float(s[1]) if s[1] else 0)):
+                    if le:
+                        labels = (labels + ',' if labels else '') + 'le="%s"' % le
+                    lines.append('%s%s%s %s' % (name, suffix, '{%s}' % labels if labels else '', _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: dict) -> str:
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for key, value in sorted(labels.items()))
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0008_auto_20170321_1542'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recording',
+            name='timestamp',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='recording',
+            index_together=set([('lat', 'lon'), ('device_name', 'mic_source', 'timestamp')]),
+        ),
+    ]
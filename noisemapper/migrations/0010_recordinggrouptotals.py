@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Sum, Count
+
+
+def fill_group_totals(apps, schema_editor):
+    Recording = apps.get_model('noisemapper', 'Recording')
+    RecordingGroupTotals = apps.get_model('noisemapper', 'RecordingGroupTotals')
+
+    aggregates = {}
+    for measurement in ('measurement_avg', 'measurement_max'):
+        aggregates[measurement + '_sum'] = Sum(measurement)
+        aggregates[measurement + '_count'] = Count(measurement)
+
+    RecordingGroupTotals.objects.bulk_create([
+        RecordingGroupTotals(**dict(row, **{k: row[k] or 0 for k in aggregates}))
+        for row in Recording.objects.values('device_name', 'mic_source').annotate(**aggregates)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0009_recording_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordingGroupTotals',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_name', models.CharField(blank=True, max_length=200, null=True)),
+                ('mic_source', models.CharField(choices=[('internal', 'Internal'), ('headset', 'Headset')], default='internal', max_length=20)),
+                ('measurement_avg_sum', models.FloatField(default=0)),
+                ('measurement_avg_count', models.IntegerField(default=0)),
+                ('measurement_max_sum', models.FloatField(default=0)),
+                ('measurement_max_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='recordinggrouptotals',
+            unique_together=set([('device_name', 'mic_source')]),
+        ),
+        migrations.RunPython(fill_group_totals, migrations.RunPython.noop),
+    ]
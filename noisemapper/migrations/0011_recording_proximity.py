@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0010_recordinggrouptotals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recording',
+            name='proximity',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+    ]
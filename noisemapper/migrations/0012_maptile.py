@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 13:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0011_recording_proximity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapTile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.IntegerField()),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('params_key', models.CharField(max_length=40)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='maptile',
+            unique_together=set([('zoom', 'x', 'y', 'params_key')]),
+        ),
+    ]
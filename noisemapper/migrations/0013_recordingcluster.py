@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 15:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0012_maptile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordingCluster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField()),
+                ('lat', models.FloatField()),
+                ('lon', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RecordingClusterMember',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='recording',
+            name='uuid',
+            field=models.CharField(blank=True, db_index=True, max_length=36, null=True),
+        ),
+        migrations.AddField(
+            model_name='recordingclustermember',
+            name='recording',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cluster_memberships', to='noisemapper.Recording'),
+        ),
+        migrations.AddField(
+            model_name='recordingclustermember',
+            name='seed',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='noisemapper.Recording'),
+        ),
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='seed',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='noisemapper.Recording'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recordingclustermember',
+            unique_together=set([('recording', 'resolution')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recordingcluster',
+            unique_together=set([('resolution', 'seed')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='recordingcluster',
+            index_together=set([('resolution', 'lat', 'lon')]),
+        ),
+    ]
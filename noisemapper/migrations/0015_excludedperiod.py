@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 17:05
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+
+
+def add_known_periods(apps, schema_editor):
+    ExcludedPeriod = apps.get_model('noisemapper', 'ExcludedPeriod')
+    # Both were hardcoded in `_build_filters` and `_build_excludes` before
+    ExcludedPeriod.objects.create(
+        start=None,
+        end=datetime.datetime(year=2017, month=1, day=24, hour=20, minute=00),
+        reason='2017-01-24 21:31:09 -- ??',
+    )
+    ExcludedPeriod.objects.create(
+        start=datetime.datetime(year=2017, month=3, day=5, hour=0, minute=00),
+        end=datetime.datetime(year=2017, month=3, day=6, hour=0, minute=00),
+        reason='In this period, the app was set to use `MediaRecorder.AudioSource.VOICE_RECOGNITION` '
+               'which resulted in incorrect (too high) values.',
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0014_archivedmonth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExcludedPeriod',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(blank=True, null=True)),
+                ('end', models.DateTimeField()),
+                ('device_name', models.CharField(blank=True, max_length=200, null=True)),
+                ('reason', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.RunPython(add_known_periods, migrations.RunPython.noop),
+    ]
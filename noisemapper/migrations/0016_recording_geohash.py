@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 17:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0015_excludedperiod'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recording',
+            name='geohash',
+            field=models.CharField(blank=True, max_length=8, null=True),
+        ),
+    ]
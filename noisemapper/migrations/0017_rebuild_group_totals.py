@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 20:10
+from __future__ import unicode_literals
+
+from django.db import migrations, DEFAULT_DB_ALIAS
+from django.db.models import Sum, Count, Max, Q
+
+
+def rebuild_group_totals(apps, schema_editor):
+    """
+    Leaves the recordings of the excluded periods out of the totals, like `RecordingGroupTotals.rebuild`.
+    Only the recordings of the main database are added up: the archived ones (see `ArchivedMonth`) are added
+    by the rebuild_group_totals command, which should be run afterwards if there is an archive.
+    """
+    db_alias = schema_editor.connection.alias
+    if db_alias != DEFAULT_DB_ALIAS:
+        return
+
+    Recording = apps.get_model('noisemapper', 'Recording')
+    RecordingGroupTotals = apps.get_model('noisemapper', 'RecordingGroupTotals')
+    ExcludedPeriod = apps.get_model('noisemapper', 'ExcludedPeriod')
+
+    recordings = Recording.objects.all()
+    periods = ExcludedPeriod.objects.using(db_alias)
+    earliest = periods.filter(start=None, device_name=None).aggregate(Max('end'))['end__max']
+    if earliest is not None:
+        recordings = recordings.filter(timestamp__gte=earliest)
+    for period in periods.exclude(start=None, device_name=None):
+        condition = Q(timestamp__lt=period.end)
+        if period.start is not None:
+            condition &= Q(timestamp__gte=period.start)
+        if period.device_name is not None:
+            condition &= Q(device_name=period.device_name)
+        recordings = recordings.exclude(condition)
+
+    aggregates = {}
+    for measurement in ('measurement_avg', 'measurement_max'):
+        aggregates[measurement + '_sum'] = Sum(measurement)
+        aggregates[measurement + '_count'] = Count(measurement)
+
+    RecordingGroupTotals.objects.using(db_alias).all().delete()
+    RecordingGroupTotals.objects.using(db_alias).bulk_create([
+        RecordingGroupTotals(device_name=row['device_name'], mic_source=row['mic_source'],
+                             **{k: row[k] or 0 for k in aggregates})
+        for row in recordings.using(db_alias).values('device_name', 'mic_source').annotate(**aggregates)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0016_recording_geohash'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_group_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 20:50
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations
+
+
+def fill_proximity(apps, schema_editor):
+    """
+    Like the backfill_proximity command; run on the archive database too (see `ArchiveRouter`).
+    """
+    Recording = apps.get_model('noisemapper', 'Recording')
+    recordings = Recording.objects.using(schema_editor.connection.alias)
+
+    last_pk = 0
+    while True:
+        # Read completely before it's updated
+        rows = list(recordings.filter(proximity='', pk__gt=last_pk).exclude(device_state=None)
+                    .order_by('pk').values_list('pk', 'device_state')[:500])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+
+        pks_by_proximity = {}
+        for pk, device_state in rows:
+            try:
+                proximity = json.loads(device_state).get('proximityText') or ''
+            except (ValueError, AttributeError):
+                continue
+            if proximity:
+                pks_by_proximity.setdefault(proximity, []).append(pk)
+        for proximity, pks in pks_by_proximity.items():
+            recordings.filter(pk__in=pks).update(proximity=proximity)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0018_ingestcheckpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_proximity, migrations.RunPython.noop, hints={'model_name': 'recording'}),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 21:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_clusters(apps, schema_editor):
+    """
+    The stored clusters were built from all the recordings, without sums: they are built again
+    by ``rebuild_clusters``. Until then (while the sums don't add up), the map endpoints don't use them.
+    """
+    db_alias = schema_editor.connection.alias
+    apps.get_model('noisemapper', 'RecordingClusterMember').objects.using(db_alias).all().delete()
+    apps.get_model('noisemapper', 'RecordingCluster').objects.using(db_alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('noisemapper', '0019_fill_recording_proximity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='lat_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='lon_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='measurement_avg_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='measurement_avg_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='measurement_max_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordingcluster',
+            name='measurement_max_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(clear_clusters, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,8 @@
 
 from .administration import *
 from .recording import *
+from .tiles import *
+from .clusters import *
+from .archive import *
+from .periods import *
+from .ingest import *
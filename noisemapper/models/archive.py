@@ -0,0 +1,144 @@
+import datetime as dt
+from typing import Iterable, List, Optional, Set
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import F, Max, Q
+
+from noisemapper.models.clusters import RecordingCluster, RecordingClusterMember
+from noisemapper.models.recording import Recording
+
+__all__ = ('ArchivedMonth', )
+
+
+class ArchivedMonth(models.Model):
+    """
+    A calendar month whose recordings have been moved out of the main database, into the archive database
+    (``settings.RECORDING_ARCHIVE_DATABASE``), by :meth:`archive_before`. The recent recordings, which most
+    selections are about, are then in a smaller table, and the old ones don't fill the page cache.
+
+    The archive is only queried if the selected period begins before the end of the last archived month
+    (see :meth:`select_recordings`). Recordings uploaded late, with the timestamp of an archived month,
+    are saved in the main database, like any other, until the next rollover moves them.
+
+    The stored clusters (see :class:`RecordingCluster`) only cover the main database: selections that include
+    archived recordings are clustered on request.
+    """
+
+    # Number of recordings moved in one transaction (and passed as query parameters at once)
+    CHUNK_SIZE = 500
+
+    # The first day of the month
+    month = models.DateField(unique=True)
+    recording_count = models.IntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_boundary(cls) -> Optional[dt.datetime]:
+        """
+        The end of the last archived month: the archive only has recordings from before it.
+        """
+        last_month = cls.objects.aggregate(Max('month'))['month__max']
+        if last_month is None:
+            return None
+        return dt.datetime.combine(add_months(last_month, 1), dt.time())
+
+    @classmethod
+    def get_databases(cls, since: Optional[dt.datetime]) -> List[str]:
+        """
+        The databases that may have recordings from ``since`` on (from any time, if it's None).
+        """
+        databases = [DEFAULT_DB_ALIAS]
+        boundary = cls.get_boundary()
+        if boundary is not None and (since is None or since < boundary):
+            databases.append(settings.RECORDING_ARCHIVE_DATABASE)
+        return databases
+
+    @classmethod
+    def select_recordings(cls, filter_criteria: dict, excludes: Q) -> List[models.QuerySet]:
+        """
+        The filtered recordings, as one queryset per database that may have some of them.
+        """
+        queryset = Recording.objects.filter(**filter_criteria).exclude(excludes)
+        since = filter_criteria.get('timestamp__gte', filter_criteria.get('timestamp__gt'))
+        return [queryset.using(database) for database in cls.get_databases(since)]
+
+    @classmethod
+    def get_archived_uuids(cls, recordings: Iterable[Recording]) -> Set[str]:
+        """
+        The uuids of the ``recordings`` that are in the archive already. Only the ones from before
+        :meth:`get_boundary` are looked up, so this is free for all the usual uploads.
+        """
+        boundary = cls.get_boundary()
+        if boundary is None:
+            return set()
+        uuids = [r.uuid for r in recordings if r.uuid and r.timestamp < boundary]
+        archived = set()
+        # Stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(uuids), cls.CHUNK_SIZE):
+            archived.update(Recording.objects.using(settings.RECORDING_ARCHIVE_DATABASE)
+                            .filter(uuid__in=uuids[i:i + cls.CHUNK_SIZE]).values_list('uuid', flat=True))
+        return archived
+
+    @classmethod
+    def archive_before(cls, before: dt.date) -> int:
+        """
+        Moves the recordings from before ``before`` (the first day of a month) into the archive, keeping
+        their primary keys, and returns their number. They are copied into the archive first, and then deleted
+        from the main database, one chunk at a time, so an interrupted rollover can just be run again.
+
+        The stored clusters lose the moved recordings; call :meth:`RecordingCluster.rebuild` afterwards.
+        """
+        assert before.day == 1, 'Only whole months can be archived'
+        archive = settings.RECORDING_ARCHIVE_DATABASE
+        cutoff = dt.datetime.combine(before, dt.time())
+
+        moved_count = 0
+        while True:
+            # The archive commits first: if the main database then fails to, the chunk is copied again next time
+            with transaction.atomic(using=DEFAULT_DB_ALIAS), transaction.atomic(using=archive):
+                recordings = list(Recording.objects.filter(timestamp__lt=cutoff).order_by('pk')[:cls.CHUNK_SIZE])
+                if not recordings:
+                    break
+                pks = [r.pk for r in recordings]
+
+                _delete_recordings(archive, pks)
+                Recording.objects.using(archive).bulk_create(recordings)
+
+                RecordingClusterMember.objects.filter(recording_id__in=pks).delete()
+                RecordingClusterMember.objects.filter(seed_id__in=pks).delete()
+                RecordingCluster.objects.filter(seed_id__in=pks).delete()
+                _delete_recordings(DEFAULT_DB_ALIAS, pks)
+
+                month_counts = {}
+                for recording in recordings:
+                    month = recording.timestamp.date().replace(day=1)
+                    month_counts[month] = month_counts.get(month, 0) + 1
+                for month, count in month_counts.items():
+                    archived_month, _ = cls.objects.get_or_create(month=month)
+                    cls.objects.filter(pk=archived_month.pk).update(recording_count=F('recording_count') + count)
+
+            moved_count += len(recordings)
+        return moved_count
+
+
+def _delete_recordings(database: str, pks: List[int]) -> None:
+    """
+    Deletes the recordings without collecting them, and without sending ``post_delete`` for each of them
+    (which would clear the response cache thousands of times): they are still there, in the other database.
+    """
+    connection = connections[database]
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            connection.ops.quote_name(Recording._meta.db_table),
+            connection.ops.quote_name(Recording._meta.pk.column),
+            ', '.join(['%s'] * len(pks)),
+        ), pks)
+
+
+def add_months(month: dt.date, months: int) -> dt.date:
+    """
+    The first day of the month ``months`` after (or before, if negative) the month of ``month``.
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return dt.date(index // 12, index % 12 + 1, 1)
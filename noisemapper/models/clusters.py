@@ -0,0 +1,191 @@
+import math
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Sum
+
+from noisemapper.models.periods import ExcludedPeriod
+from noisemapper.models.recording import Recording
+from noisemapper.utils import EARTH_RADIUS, SpatialGrid, distance
+
+__all__ = ('RecordingCluster', 'RecordingClusterMember')
+
+
+class RecordingCluster(models.Model):
+    """
+    A cluster of the recordings, for one of ``settings.CLUSTER_STORE_RESOLUTIONS`` (in meters), identified by its
+    first recording (the seed), with the running sums of its members.
+    Kept up to date by :meth:`add_recordings` on upload: a new recording joins the oldest cluster whose seed
+    is closer than the resolution, or starts a new cluster.
+    Over the recordings of :meth:`get_base_recordings`, in the order they were saved, that is what
+    :func:`grid_group_data` does. Like the selections of the map endpoints, they leave out the excluded periods
+    (see :class:`ExcludedPeriod`); the clusters are rebuilt when the periods change.
+
+    For these resolutions, the map endpoints look the clusters of the selected recordings up,
+    instead of clustering them on every request, if all the base recordings are selected (see :meth:`covers`):
+    the recordings of a narrower selection may be clustered differently on their own.
+    """
+
+    resolution = models.IntegerField()
+    seed = models.ForeignKey(Recording, on_delete=models.CASCADE, related_name='+')
+    # The location of the seed
+    lat = models.FloatField()
+    lon = models.FloatField()
+
+    # The number of members, and their sums
+    count = models.IntegerField(default=0)
+    lat_sum = models.FloatField(default=0)
+    lon_sum = models.FloatField(default=0)
+    # Of the members that have the measurement
+    measurement_avg_sum = models.FloatField(default=0)
+    measurement_avg_count = models.IntegerField(default=0)
+    measurement_max_sum = models.FloatField(default=0)
+    measurement_max_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('resolution', 'seed')]
+        index_together = [('resolution', 'lat', 'lon')]
+
+    @staticmethod
+    def is_stored(resolution) -> bool:
+        return resolution is not None and resolution in settings.CLUSTER_STORE_RESOLUTIONS
+
+    @staticmethod
+    def get_base_recordings() -> models.QuerySet:
+        """
+        The recordings the clusters are built from: those of the main database that have a location, without
+        the ones of the excluded periods. Every selection of the map endpoints is a part of them.
+        """
+        recordings = Recording.objects.exclude(lat=None).exclude(lon=None) \
+            .exclude(ExcludedPeriod.get_excludes(None, None))
+        earliest = ExcludedPeriod.get_earliest()
+        if earliest is not None:
+            recordings = recordings.filter(timestamp__gte=earliest)
+        return recordings
+
+    @classmethod
+    def covers(cls, resolution: int, recordings: List) -> bool:
+        """
+        Whether the selected recordings (with a location) are all of the base recordings: a selection is a part
+        of them, so it is enough that there are as many as the clusters have members.
+        """
+        located = sum(1 for r in recordings if r.lat is not None and r.lon is not None)
+        return located == cls.objects.filter(resolution=resolution).aggregate(Sum('count'))['count__sum']
+
+    @classmethod
+    def add_recordings(cls, recordings: Iterable[Recording]) -> None:
+        """
+        Assigns the (saved) recordings to clusters, at every stored resolution, unless they are in
+        an excluded period.
+        """
+        points = sorted((r.pk, r.lat, r.lon, r.measurement_avg, r.measurement_max)
+                        for r in ExcludedPeriod.exclude_from(recordings) if r.lat is not None and r.lon is not None)
+        with transaction.atomic():
+            for resolution in settings.CLUSTER_STORE_RESOLUTIONS:
+                cls._assign(points, resolution)
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """
+        Clusters all the base recordings again, e.g. after the stored resolutions or the excluded periods
+        were changed.
+        """
+        with transaction.atomic():
+            RecordingClusterMember.objects.all().delete()
+            cls.objects.all().delete()
+            points = list(cls.get_base_recordings().order_by('pk')
+                          .values_list('pk', 'lat', 'lon', 'measurement_avg', 'measurement_max').iterator())
+            for resolution in settings.CLUSTER_STORE_RESOLUTIONS:
+                cls._assign(points, resolution)
+
+    @classmethod
+    def get_assignments(cls, resolution: int, recordings: models.QuerySet) -> Dict[int, int]:
+        """
+        The seed of the cluster of each of the ``recordings`` (by their primary keys) that has been assigned to one.
+        """
+        return dict(
+            RecordingClusterMember.objects.filter(resolution=resolution, recording__in=recordings)
+            .values_list('recording_id', 'seed_id').iterator()
+        )
+
+    @classmethod
+    def _assign(cls, points: List[Tuple[int, float, float, float, float]], resolution: int) -> None:
+        """
+        Assigns the (pk, lat, lon, measurement_avg, measurement_max) points to clusters, and adds them to
+        the sums of the clusters.
+        """
+        if not points:
+            return
+
+        grid = SpatialGrid(resolution)
+        seed_ids = []  # By their order number in `grid`
+        for seed_id, lat, lon in cls._get_candidates(points, resolution):
+            grid.add((lat, lon))
+            seed_ids.append(seed_id)
+
+        new_clusters = []
+        members = []
+        increments = {}  # seed_id -> the increments of the fields of `_add_point`
+        for pk, lat, lon, measurement_avg, measurement_max in points:
+            best_order = None
+            for order, seed in grid.nearby((lat, lon)):
+                if (best_order is None or order < best_order) and distance(seed, (lat, lon)) < resolution:
+                    best_order = order
+            if best_order is None:
+                best_order = len(seed_ids)
+                grid.add((lat, lon))
+                seed_ids.append(pk)
+                new_clusters.append(cls(resolution=resolution, seed_id=pk, lat=lat, lon=lon))
+            members.append(RecordingClusterMember(resolution=resolution, seed_id=seed_ids[best_order], recording_id=pk))
+            _add_point(increments.setdefault(seed_ids[best_order], {}), lat, lon, measurement_avg, measurement_max)
+
+        for cluster in new_clusters:
+            for field, increment in increments.pop(cluster.seed_id).items():
+                setattr(cluster, field, increment)
+        cls.objects.bulk_create(new_clusters)
+        # Only the clusters the points joined
+        for seed_id, increment in increments.items():
+            cls.objects.filter(resolution=resolution, seed_id=seed_id).update(
+                **{field: F(field) + value for field, value in increment.items()})
+        RecordingClusterMember.objects.bulk_create(members)
+
+    @classmethod
+    def _get_candidates(cls, points: List[Tuple[int, float, float, float, float]],
+                        resolution: int) -> models.QuerySet:
+        """
+        The (seed, lat, lon) of the clusters whose seeds may be in range of any of the points, oldest first.
+        """
+        lats = [point[1] for point in points]
+        lons = [point[2] for point in points]
+        lat_padding = math.degrees(resolution / EARTH_RADIUS) * SpatialGrid.PADDING
+        south, north = min(lats) - lat_padding, max(lats) + lat_padding
+
+        queryset = cls.objects.filter(resolution=resolution, lat__gte=south, lat__lte=north)
+        lon_padding = SpatialGrid(resolution).lon_span(max(abs(south), abs(north)))
+        # Near the poles or the antimeridian, all the longitudes are candidates
+        if lon_padding is not None and min(lons) - lon_padding >= -180 and max(lons) + lon_padding <= 180:
+            queryset = queryset.filter(lon__gte=min(lons) - lon_padding, lon__lte=max(lons) + lon_padding)
+        return queryset.order_by('seed_id').values_list('seed_id', 'lat', 'lon')
+
+
+def _add_point(increment: dict, lat: float, lon: float, measurement_avg: float, measurement_max: float) -> None:
+    for field, value in (('count', 1), ('lat_sum', lat), ('lon_sum', lon)):
+        increment[field] = increment.get(field, 0) + value
+    for measurement, value in (('measurement_avg', measurement_avg), ('measurement_max', measurement_max)):
+        if value is not None:
+            increment[measurement + '_sum'] = increment.get(measurement + '_sum', 0) + value
+            increment[measurement + '_count'] = increment.get(measurement + '_count', 0) + 1
+
+
+class RecordingClusterMember(models.Model):
+    """
+    The cluster of a recording at one resolution, identified by its seed, like in :class:`RecordingCluster`.
+    """
+
+    resolution = models.IntegerField()
+    recording = models.ForeignKey(Recording, on_delete=models.CASCADE, related_name='cluster_memberships')
+    seed = models.ForeignKey(Recording, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        unique_together = [('recording', 'resolution')]
@@ -0,0 +1,14 @@
+from django.db import models
+
+__all__ = ('IngestCheckpoint', )
+
+
+class IngestCheckpoint(models.Model):
+    """
+    The last item of an ingest queue (see :class:`IngestQueue`, identified by the ``queue_id`` stored in its file)
+    whose record has been saved. Updated in the same transaction as the recordings, so the items up to it are
+    known to be saved even if they couldn't be removed from the queue afterwards.
+    """
+
+    queue_id = models.CharField(max_length=36, unique=True)
+    last_item_id = models.IntegerField()
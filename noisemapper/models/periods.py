@@ -0,0 +1,94 @@
+import datetime as dt
+from functools import reduce
+from operator import or_
+from typing import Iterable, List, Optional
+
+from django.db import models, transaction
+from django.db.models import Max, Q
+from django.db.models.signals import post_save, post_delete
+
+from noisemapper.models.tiles import MapTile
+
+__all__ = ('ExcludedPeriod',)
+
+
+class ExcludedPeriod(models.Model):
+    """
+    A period whose recordings are left out of the map responses and the downloads, e.g. because the app measured
+    incorrectly then. The period is from ``start`` (or from the beginning, if it's empty) to ``end`` (exclusive),
+    for the recordings of ``device_name`` (or of all the devices, if it's empty).
+    """
+
+    start = models.DateTimeField(blank=True, null=True)
+    end = models.DateTimeField()
+    device_name = models.CharField(max_length=200, blank=True, null=True)
+    reason = models.TextField(blank=True)
+
+    def __str__(self):
+        return '%s - %s%s' % (self.start or '', self.end, ' (%s)' % self.device_name if self.device_name else '')
+
+    @classmethod
+    def get_earliest(cls) -> Optional[dt.datetime]:
+        """
+        The end of the periods excluded for all the devices from the beginning: the earliest time a recording
+        may be selected from. Filtering for it, rather than excluding the period, lets the query use the index
+        on the timestamp.
+        """
+        return cls.objects.filter(start=None, device_name=None).aggregate(Max('end'))['end__max']
+
+    @classmethod
+    def get_excludes(cls, since: Optional[dt.datetime], until: Optional[dt.datetime]) -> Q:
+        """
+        The condition of the recordings to exclude from a selection from ``since`` to ``until``. Only the periods
+        that overlap the selection are in it, and the ones found by :meth:`get_earliest` are not.
+        """
+        periods = cls.objects.exclude(start=None, device_name=None)
+        if since is not None:
+            periods = periods.filter(end__gt=since)
+        if until is not None:
+            periods = periods.filter(Q(start=None) | Q(start__lt=until))
+
+        conditions = []
+        for period in periods.order_by('pk'):
+            condition = Q(timestamp__lt=period.end)
+            if period.start is not None:
+                condition &= Q(timestamp__gte=period.start)
+            if period.device_name is not None:
+                condition &= Q(device_name=period.device_name)
+            conditions.append(condition)
+        return reduce(or_, conditions) if conditions else Q()
+
+    @classmethod
+    def exclude_from(cls, recordings: Iterable) -> List:
+        """
+        The recordings (e.g. new ones, not saved yet) that are not in any of the periods.
+        """
+        periods = list(cls.objects.all())
+        return [recording for recording in recordings if not any(period.contains(recording) for period in periods)]
+
+    def contains(self, recording) -> bool:
+        return ((self.start is None or recording.timestamp >= self.start) and recording.timestamp < self.end
+                and (self.device_name is None or recording.device_name == self.device_name))
+
+
+def _period_changed(sender, **kwargs):
+    transaction.on_commit(_invalidate_responses)
+
+
+def _invalidate_responses():
+    # Imported here, as they import this module
+    from noisemapper.models.clusters import RecordingCluster
+    from noisemapper.models.recording import RecordingGroupTotals
+    from noisemapper.response_cache import response_cache
+
+    # The averages of the deviation data and the stored clusters leave out the periods too
+    RecordingGroupTotals.rebuild()
+    RecordingCluster.rebuild()
+    # Once the change is committed, and the cache first, like in `_recordings_added`
+    response_cache.clear()
+    # Any of the tiles may show recordings of the period
+    MapTile.objects.all().delete()
+
+
+post_save.connect(_period_changed, sender=ExcludedPeriod)
+post_delete.connect(_period_changed, sender=ExcludedPeriod)
@@ -1,19 +1,27 @@
 
-from django.db import models
+from typing import Iterable, Iterator, Dict, Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.db.models import F, Sum, Count
 
 from noisemapper.models.base import NoiseMapperBase
+from noisemapper.models.periods import ExcludedPeriod
 
 MIC_SOURCE_CHOICES = [('internal', 'Internal'), ('headset', 'Headset')]
 
-__all__ = ('Recording',)
+# Number of characters of `Recording.geohash`: cells of about 19 m by 38 m
+GEOHASH_PRECISION = 8
+
+__all__ = ('Recording', 'RecordingRow', 'RecordingGroupTotals')
 
 
 class Recording(NoiseMapperBase, models.Model):
 
-    uuid = models.CharField(max_length=36, blank=True, null=True)
+    uuid = models.CharField(max_length=36, blank=True, null=True, db_index=True)
     device_name = models.CharField(max_length=200, blank=True, null=True)
 
-    timestamp = models.DateTimeField()
+    timestamp = models.DateTimeField(db_index=True)
     process_result = models.TextField()
     device_state = models.TextField(blank=True, null=True)
     lat = models.FloatField(blank=True, null=True)
@@ -26,3 +34,126 @@ class Recording(NoiseMapperBase, models.Model):
     measurement_avg = models.FloatField(blank=True, null=True)
 
     mic_source = models.CharField(choices=MIC_SOURCE_CHOICES, default=MIC_SOURCE_CHOICES[0][0], max_length=20)
+    # Copied out of `device_state`, so it doesn't have to be parsed for every response
+    proximity = models.CharField(max_length=50, blank=True, default='')
+    # The geohash of the location; its prefixes are the cells the map data can be aggregated by in SQL
+    geohash = models.CharField(max_length=GEOHASH_PRECISION, blank=True, null=True)
+
+    class Meta:
+        # Matching the filters of the map and download endpoints (see `_build_filters`)
+        index_together = [
+            ('device_name', 'mic_source', 'timestamp'),
+            ('lat', 'lon'),
+        ]
+
+
+class RecordingRow(object):
+    """
+    The columns of a :class:`Recording` the map endpoints work with, without the big TextFields and
+    the overhead of a model instance. Clustering may set ``weight`` and ``deviation`` on it, like on a Recording,
+    and ``cluster_id`` is set if the recording's cluster was looked up (see :class:`RecordingCluster`).
+    """
+
+    FIELDS = ('pk', 'uuid', 'device_name', 'timestamp', 'lat', 'lon', 'measurement_avg', 'measurement_max',
+              'mic_source', 'proximity')
+
+    __slots__ = FIELDS + ('weight', 'deviation', 'cluster_id')
+
+    def __init__(self, pk, uuid, device_name, timestamp, lat, lon, measurement_avg, measurement_max, mic_source,
+                 proximity):
+        self.pk = pk
+        self.uuid = uuid
+        self.device_name = device_name
+        self.timestamp = timestamp
+        self.lat = lat
+        self.lon = lon
+        self.measurement_avg = measurement_avg
+        self.measurement_max = measurement_max
+        self.mic_source = mic_source
+        self.proximity = proximity
+
+    @classmethod
+    def from_queryset(cls, queryset: models.QuerySet) -> Iterator['RecordingRow']:
+        for values in queryset.values_list(*cls.FIELDS).iterator():
+            yield cls(*values)
+
+
+class RecordingGroupTotals(models.Model):
+    """
+    Running sums and counts of the measurements, per (device_name, mic_source) group,
+    so their averages don't have to be aggregated over the whole table on every request.
+    Kept up to date by :meth:`add_recordings` on upload. Like the map responses, they leave out the recordings of
+    the excluded periods (see :class:`ExcludedPeriod`); they are rebuilt when the periods change.
+    """
+
+    MEASUREMENTS = ('measurement_avg', 'measurement_max')
+
+    device_name = models.CharField(max_length=200, blank=True, null=True)
+    mic_source = models.CharField(choices=MIC_SOURCE_CHOICES, default=MIC_SOURCE_CHOICES[0][0], max_length=20)
+
+    measurement_avg_sum = models.FloatField(default=0)
+    measurement_avg_count = models.IntegerField(default=0)
+    measurement_max_sum = models.FloatField(default=0)
+    measurement_max_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('device_name', 'mic_source')]
+
+    @classmethod
+    def add_recordings(cls, recordings: Iterable[Recording]) -> None:
+        increments = {}
+        for recording in ExcludedPeriod.exclude_from(recordings):
+            group = increments.setdefault((recording.device_name, recording.mic_source), {})
+            for measurement in cls.MEASUREMENTS:
+                value = getattr(recording, measurement)
+                if value is not None:
+                    group[measurement + '_sum'] = group.get(measurement + '_sum', 0) + value
+                    group[measurement + '_count'] = group.get(measurement + '_count', 0) + 1
+
+        with transaction.atomic():
+            for (device_name, mic_source), increment in increments.items():
+                if not increment:
+                    continue
+                totals, _ = cls.objects.get_or_create(device_name=device_name, mic_source=mic_source)
+                cls.objects.filter(pk=totals.pk).update(**{k: F(k) + v for k, v in increment.items()})
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """
+        Recomputes the totals of all the groups from the recordings.
+        """
+        recordings = Recording.objects.exclude(ExcludedPeriod.get_excludes(None, None))
+        earliest = ExcludedPeriod.get_earliest()
+        if earliest is not None:
+            recordings = recordings.filter(timestamp__gte=earliest)
+
+        aggregates = {}
+        for measurement in cls.MEASUREMENTS:
+            aggregates[measurement + '_sum'] = Sum(measurement)
+            aggregates[measurement + '_count'] = Count(measurement)
+
+        groups = {}
+        # The archived recordings (see `ArchivedMonth`) still count
+        for database in (DEFAULT_DB_ALIAS, settings.RECORDING_ARCHIVE_DATABASE):
+            for row in recordings.using(database).values('device_name', 'mic_source').annotate(**aggregates):
+                totals = groups.setdefault((row['device_name'], row['mic_source']), dict.fromkeys(aggregates, 0))
+                for k in aggregates:
+                    totals[k] += row[k] or 0
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([
+                cls(device_name=device_name, mic_source=mic_source, **totals)
+                for (device_name, mic_source), totals in groups.items()
+            ])
+
+    @classmethod
+    def get_averages(cls, measurement: str) -> Dict[Tuple[str, str], float]:
+        if measurement not in cls.MEASUREMENTS:
+            raise ValueError('Unknown measurement: %s' % measurement)
+        averages = {}
+        for totals in cls.objects.all():
+            count = getattr(totals, measurement + '_count')
+            if count:
+                averages[(totals.device_name, totals.mic_source)] = getattr(totals, measurement + '_sum') / count
+        return averages
@@ -0,0 +1,86 @@
+import math
+from functools import reduce
+from operator import or_
+from typing import Iterable, Tuple
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Q
+
+__all__ = ('MapTile',)
+
+
+class MapTile(models.Model):
+    """
+    The clustered map data of one (Web Mercator, "slippy map") tile, for one set of filter parameters,
+    stored as the ready-to-send JSON response.
+    Filled lazily when a tile is first requested, and deleted when a new recording lands inside it, or when it's
+    among the oldest of more than ``settings.TILE_MAX_COUNT`` tiles (see :meth:`evict`).
+    """
+
+    zoom = models.IntegerField()
+    x = models.IntegerField()
+    y = models.IntegerField()
+    params_key = models.CharField(max_length=40)
+
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('zoom', 'x', 'y', 'params_key')]
+
+    @staticmethod
+    def get_bounds(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+        """
+        The (south, north, west, east) edges of the tile, in degrees.
+        """
+        n = 2 ** zoom
+
+        def lat(tile_y):
+            return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+        return lat(y + 1), lat(y), x / n * 360 - 180, (x + 1) / n * 360 - 180
+
+    @staticmethod
+    def get_tile(lat: float, lon: float, zoom: int) -> Tuple[int, int]:
+        n = 2 ** zoom
+        lat_rad = math.radians(lat)
+        x = int((lon + 180) / 360 * n)
+        y = int((1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    @staticmethod
+    def get_resolution(zoom: int, y: int) -> float:
+        """
+        The clustering resolution of the tile, in meters: the ground size of ``settings.TILE_CLUSTER_RADIUS_PX``
+        pixels at the middle of the tile, like the auto-resolution of the map page.
+        """
+        south, north, _, _ = MapTile.get_bounds(zoom, 0, y)
+        meters_per_pixel = 156543.03392 * math.cos(math.radians((south + north) / 2)) / 2 ** zoom
+        return meters_per_pixel * settings.TILE_CLUSTER_RADIUS_PX
+
+    @classmethod
+    def invalidate(cls, points: Iterable[Tuple[float, float]]) -> None:
+        """
+        Deletes the tiles (on every zoom level, for every filter) that contain any of ``points``.
+        """
+        points = [(lat, lon) for lat, lon in points if lat is not None and lon is not None]
+        for zoom in range(settings.TILE_MAX_ZOOM + 1):
+            tiles = list({cls.get_tile(lat, lon, zoom) for lat, lon in points})
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(tiles), 200):
+                condition = reduce(or_, (Q(x=x, y=y) for x, y in tiles[i:i + 200]))
+                cls.objects.filter(condition, zoom=zoom).delete()
+
+    @classmethod
+    def evict(cls) -> None:
+        """
+        Deletes the oldest tiles, if there are more than ``settings.TILE_MAX_COUNT``. A tenth more than the excess
+        goes, so this doesn't have to delete again for every new tile.
+        """
+        excess = cls.objects.count() - settings.TILE_MAX_COUNT
+        if excess <= 0:
+            return
+        evicted = excess + settings.TILE_MAX_COUNT // 10
+        newest_evicted = cls.objects.order_by('pk').values_list('pk', flat=True)[evicted - 1]
+        cls.objects.filter(pk__lte=newest_evicted).delete()
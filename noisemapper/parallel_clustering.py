@@ -0,0 +1,259 @@
+import decimal as dec
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from operator import itemgetter
+from typing import Any, Callable, List, Optional, Tuple, T
+
+from django.conf import settings
+
+from noisemapper.utils import EARTH_RADIUS, SpatialGrid, distance, grid_group_data, aggregate_clusters
+
+__all__ = ('ParallelClusterer', 'parallel_clusterer')
+
+
+class ParallelClusterer(object):
+    """
+    Does what :func:`grid_group_data`, :func:`aggregate_clusters` and :func:`grid_cluster_data` do, in a pool of
+    ``processes`` processes, for selections of at least ``min_rows`` points (smaller ones are clustered in the calling
+    thread, like before).
+
+    The points are split into longitude strips with the same number of points, which are clustered independently.
+    Afterwards, the clusters whose seeds are closer than ``resolution`` to each other, but ended up in different strips,
+    are merged (into the oldest one), so there are no doubled clusters along the edges of the strips.
+    The clusters are the same as those of :func:`grid_group_data`, except near the edges, where a point may end up
+    in a different (but still nearby) cluster.
+
+    Only the keys, and the values picked by ``value_func``, are sent to the processes: pickling whole recordings
+    would take longer than clustering them.
+
+    If a process of the pool dies (e.g. it's killed for using too much memory), the pool is replaced by a new one,
+    and the work it was given is done in the calling thread instead. Commands have to :meth:`shutdown` the pool
+    before they exit.
+
+    The processes are started by a fork server (see :func:`use_fork_server`), which is set up when the first
+    clusterer is created, at startup.
+    """
+
+    def __init__(self, processes: int, min_rows: int):
+        self.processes = processes
+        self.min_rows = min_rows
+        self._lock = threading.Lock()
+        self._executor = None
+        if processes > 1:
+            use_fork_server()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Created lazily, so each uWSGI worker has its own pool, not one shared with the master
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes)
+            return self._executor
+
+    def _run(self, func: Callable, calls: List[tuple]) -> List:
+        """
+        The results of ``func(*args)`` for the ``args`` of each of ``calls``, computed in the pool.
+        """
+        executor = self._get_executor()
+        try:
+            futures = [executor.submit(func, *args) for args in calls]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            logging.exception("A clustering process died, starting a new pool")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            return [func(*args) for args in calls]
+
+    def shutdown(self) -> None:
+        """
+        Stops the processes of the pool; they are started again if it's needed after all.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _is_parallel(self, data: List, resolution: Optional[dec.Decimal]) -> bool:
+        return self.processes > 1 and len(data) >= max(self.min_rows, 1) and resolution is not None and resolution > 0
+
+    def group(self, data: List[T], key_func: Callable[[T], Tuple[float, float]],
+              resolution: Optional[dec.Decimal]) -> dict:
+        """
+        Same as :func:`grid_group_data`.
+        """
+        if not self._is_parallel(data, resolution):
+            return grid_group_data(data, key_func, resolution)
+
+        keys = [key_func(datapoint) for datapoint in data]
+        return {
+            keys[members[0]]: [data[i] for i in members]
+            for members in self._group_indexes(keys, float(resolution))
+            }
+
+    def cluster(self, data: List[T], key_func: Callable[[T], Tuple[float, float]], value_func: Callable[[T], Any],
+                resolution: Optional[dec.Decimal], aggregator_class: type, retain_original=False) -> dict:
+        """
+        Same as :func:`grid_cluster_data`, with ``aggregator_class(extractor=value_func)`` as the aggregator factory.
+        ``aggregator_class`` has to be an :class:`Aggregator` that takes an extractor, like all of ours.
+        """
+        return self.aggregate(self.group(data, key_func, resolution), value_func, aggregator_class, retain_original)
+
+    def aggregate(self, clustered: dict, value_func: Callable[[T], Any], aggregator_class: type,
+                  retain_original=False) -> dict:
+        """
+        Same as :func:`aggregate_clusters`, for already grouped points (see :meth:`group`), with
+        ``aggregator_class(extractor=value_func)`` as the aggregator factory.
+        """
+        total = sum(len(values) for values in clustered.values())
+        if self.processes <= 1 or total < max(self.min_rows, 1):
+            return aggregate_clusters(clustered, (lambda: aggregator_class(extractor=value_func)), retain_original)
+
+        chunks = _split_evenly(list(clustered.items()), total, self.processes * 4, weight=(lambda item: len(item[1])))
+        results = self._run(_aggregate_chunk, [
+            (aggregator_class, [[value_func(value) for value in values] for _, values in chunk])
+            for chunk in chunks
+            ])
+
+        clustered_2 = dict()
+        for chunk, result in zip(chunks, results):
+            for (key, values), (new_key, new_value, extra_attrs) in zip(chunk, result):
+                if not new_key:
+                    new_key = key
+                if retain_original:
+                    if extra_attrs:
+                        for value, extra_attr in zip(values, extra_attrs):
+                            for k, v in extra_attr.items():
+                                setattr(value, k, v)
+                    clustered_2[new_key] = dict(original=values, aggregated_value=new_value)
+                else:
+                    clustered_2[new_key] = new_value
+        return clustered_2
+
+    def _group_indexes(self, keys: List[Tuple[float, float]], resolution: float) -> List[List[int]]:
+        """
+        The clusters, as lists of indexes into ``keys``, the seed first, in the order of their seeds.
+        """
+        by_lon = sorted(range(len(keys)), key=lambda i: keys[i][1])
+        strips = [sorted(strip) for strip in _split_evenly(by_lon, len(by_lon), self.processes, weight=(lambda i: 1))]
+
+        results = self._run(_group_strip, [([keys[i] for i in strip], resolution) for strip in strips])
+
+        clusters = []
+        for strip_index, (strip, result) in enumerate(zip(strips, results)):
+            west = min(keys[i][1] for i in strip) if strip_index else -180.0
+            east = min(keys[i][1] for i in strips[strip_index + 1]) if strip_index + 1 < len(strips) else 180.0
+            for members in result:
+                clusters.append((strip_index, [strip[i] for i in members], west, east))
+        clusters.sort(key=lambda cluster: cluster[1][0])
+
+        return _merge_edges(clusters, keys, resolution)
+
+
+def use_fork_server() -> None:
+    """
+    Makes the pools start their processes from a fork server, instead of forking the calling process.
+    A uWSGI worker has threads running, e.g. the snippet writers and the metrics flusher. A process forked while
+    one of them holds a lock (that of logging, or of the metrics) would hang as soon as it needs it.
+    The fork server is a new process: it sets Django up once, and the processes are forked from it.
+    """
+    start_method = multiprocessing.get_start_method(allow_none=True)
+    if start_method is not None:
+        if start_method != 'forkserver':
+            logging.warning("The clustering processes are started with %s, not by a fork server" % start_method)
+        return
+    multiprocessing.set_start_method('forkserver')
+    # Django first: importing this module imports the models
+    multiprocessing.set_forkserver_preload(['noisemapper_wrapper.wsgi', __name__])
+    if not os.path.basename(sys.executable).startswith('python'):
+        # In uWSGI, it's the uwsgi binary; the fork server is run by the interpreter uWSGI embeds
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'bin', 'python3'))
+
+
+def _group_strip(keys: List[Tuple[float, float]], resolution: float) -> List[List[int]]:
+    clustered = grid_group_data(list(enumerate(keys)), key_func=itemgetter(1), resolution=resolution)
+    return [[i for i, _ in members] for members in clustered.values()]
+
+
+def _aggregate_chunk(aggregator_class: type, clusters: List[List]) -> List[tuple]:
+    return [aggregator_class(extractor=_identity).extend(values).get() for values in clusters]
+
+
+def _identity(value):
+    return value
+
+
+def _merge_edges(clusters: List[tuple], keys: List[Tuple[float, float]], resolution: float) -> List[List[int]]:
+    """
+    Merges each cluster whose seed is in range of the seed of an older cluster in another strip into that cluster.
+    Only the seeds close to the edge of their strip can be in range of another strip, so only they are compared.
+    """
+    grid = SpatialGrid(resolution)
+    edge_clusters = []  # By the order number of their seeds in `grid`
+    merged = []
+    for strip_index, members, west, east in clusters:
+        seed = keys[members[0]]
+        if not _is_near_edge(seed, west, east, resolution):
+            merged.append(members)
+            continue
+
+        best_order = None
+        for order, other_seed in grid.nearby(seed):
+            if (best_order is None or order < best_order) and edge_clusters[order][0] != strip_index \
+                    and distance(other_seed, seed) < resolution:
+                best_order = order
+        if best_order is None:
+            grid.add(seed)
+            edge_clusters.append((strip_index, members))
+            merged.append(members)
+        else:
+            edge_clusters[best_order][1].extend(members)
+
+    for _, members in edge_clusters:
+        # Back in the original order (which keeps the seed first)
+        members.sort()
+    return merged
+
+
+def _is_near_edge(point: Tuple[float, float], west: float, east: float, resolution: float) -> bool:
+    """
+    Whether ``point`` is in range of the west or the east edge (meridian, from pole to pole) of its strip.
+    """
+    lat, lon = math.radians(point[0]), point[1]
+    angle = resolution / EARTH_RADIUS * SpatialGrid.PADDING
+    for edge in (west, east):
+        lon_diff = math.radians(abs(lon - edge))
+        if lon_diff >= math.pi / 2:
+            # The closest point of the edge is a pole
+            edge_angle = math.pi / 2 - abs(lat)
+        else:
+            edge_angle = math.asin(math.cos(lat) * math.sin(lon_diff))
+        if edge_angle <= angle:
+            return True
+    return False
+
+
+def _split_evenly(items: List[T], total_weight: int, parts: int, weight: Callable[[T], int]) -> List[List[T]]:
+    """
+    Splits ``items`` into at most ``parts`` consecutive, non-empty chunks of about the same total ``weight``.
+    """
+    chunks = [[]]
+    chunks_weight = 0
+    for item in items:
+        if chunks_weight >= total_weight * len(chunks) / parts and chunks[-1]:
+            chunks.append([])
+        chunks[-1].append(item)
+        chunks_weight += weight(item)
+    return chunks
+
+
+parallel_clusterer = ParallelClusterer(
+    processes=settings.PARALLEL_CLUSTERING_PROCESSES,
+    min_rows=settings.PARALLEL_CLUSTERING_MIN_ROWS,
+)
@@ -20,5 +20,6 @@ def _is_staff_user(user: User) -> bool:
     return user.is_authenticated and user.is_staff
 
 can_download = Permission('can_download', _is_staff_user)
+can_view_metrics = Permission('can_view_metrics', _is_staff_user)
 
 
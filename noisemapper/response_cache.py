@@ -0,0 +1,192 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from typing import Callable, Optional, Iterator, List, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.http.request import HttpRequest
+from django.http.response import HttpResponse, HttpResponseNotModified
+
+from noisemapper.models.recording import Recording
+
+__all__ = ('ResponseCache', 'response_cache', 'cache_response')
+
+
+CacheEntry = namedtuple('CacheEntry', ('etag', 'content_type', 'content'))
+
+
+class ResponseCache(object):
+    """
+    A size-bounded LRU cache of response bodies, stored in an SQLite file (``settings.RESPONSE_CACHE_PATH``),
+    so it is shared by all the uWSGI processes.
+    When the total size of the bodies exceeds ``settings.RESPONSE_CACHE_MAX_BYTES``, the least recently used
+    ones are evicted.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # One connection per thread and file; the path is read every time, so tests can override it
+        path = settings.RESPONSE_CACHE_PATH
+        connections = self._local.__dict__.setdefault('connections', {})
+        if path not in connections:
+            connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS entry ('
+                               'key TEXT PRIMARY KEY, etag TEXT, content_type TEXT, content BLOB, '
+                               'size INTEGER, last_used REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entry_last_used ON entry (last_used)')
+            connection.execute('CREATE TABLE IF NOT EXISTS generation (value INTEGER)')
+            connection.execute('INSERT INTO generation SELECT 0 WHERE NOT EXISTS (SELECT * FROM generation)')
+            connections[path] = connection
+        return connections[path]
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        connection = self._get_connection()
+        row = connection.execute('SELECT etag, content_type, content FROM entry WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE entry SET last_used = ? WHERE key = ?', (time.time(), key))
+        return CacheEntry(row[0], row[1], bytes(row[2]))
+
+    def get_generation(self) -> int:
+        """
+        Incremented by every :meth:`clear`. Read it before computing a response, and pass it to :meth:`set`,
+        so a response computed from data that has changed since is not stored.
+        """
+        return self._get_connection().execute('SELECT value FROM generation').fetchone()[0]
+
+    def set(self, key: str, content_type: str, content: bytes, generation: int) -> CacheEntry:
+        return self.set_many([(key, content_type, content)], generation)[0]
+
+    def set_many(self, items: List[Tuple[str, str, bytes]], generation: int) -> List[CacheEntry]:
+        """
+        Stores the (key, content type, content) items in one transaction, like :meth:`set`.
+        """
+        entries = [CacheEntry(hashlib.sha1(content).hexdigest(), content_type, content)
+                   for _, content_type, content in items]
+        now = time.time()
+        rows = [(key, entry.etag, entry.content_type, entry.content, len(entry.content), now)
+                for (key, _, _), entry in zip(items, entries)
+                if len(entry.content) <= settings.RESPONSE_CACHE_MAX_BYTES]
+        if not rows:
+            return entries
+
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if self.get_generation() != generation:
+                connection.execute('ROLLBACK')
+                return entries
+            connection.executemany('INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._evict(connection)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return entries
+
+    @staticmethod
+    def _evict(connection: sqlite3.Connection) -> None:
+        total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entry').fetchone()[0]
+        excess = total_size - settings.RESPONSE_CACHE_MAX_BYTES
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in connection.execute('SELECT key, size FROM entry ORDER BY last_used'):
+            evicted.append((key, ))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany('DELETE FROM entry WHERE key = ?', evicted)
+
+    def clear(self) -> None:
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute('DELETE FROM entry')
+        connection.execute('UPDATE generation SET value = value + 1')
+        connection.execute('COMMIT')
+
+
+response_cache = ResponseCache()
+
+
+def cache_response(key_func: Callable[[HttpRequest], str]):
+    """
+    Decorator for GET views whose response only depends on the key computed by ``key_func``
+    (and on the recordings and the excluded periods, whose changes clear the cache).
+    Successful responses are served from :data:`response_cache`, with an ``ETag``, and a
+    ``304 Not Modified`` is sent if the client already has the same body (``If-None-Match``).
+    """
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            key = '%s:%s' % (view_func.__name__, key_func(request))
+            entry = response_cache.get(key)
+            if entry is None:
+                generation = response_cache.get_generation()
+                response = view_func(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if response.streaming:
+                    response.streaming_content = _cache_stream(key, response['Content-Type'],
+                                                               response.streaming_content, generation)
+                    return response
+                entry = response_cache.set(key, response['Content-Type'], response.content, generation)
+
+            etag = '"%s"' % entry.etag
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+            if etag in [_strip_etag(x) for x in if_none_match.split(',')]:
+                response = HttpResponseNotModified()
+            else:
+                response = HttpResponse(entry.content, content_type=entry.content_type)
+            response['ETag'] = etag
+            return response
+
+        return _wrapped_view
+
+    return decorator
+
+
+def _strip_etag(etag: str) -> str:
+    """
+    Undoes what GZipMiddleware / gzip_page does to our ETags: weakening them (Django 1.11+), or adding ``;gzip``.
+    """
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.replace(';gzip"', '"')
+
+
+def _cache_stream(key: str, content_type: str, chunks: Iterator[bytes], generation: int) -> Iterator[bytes]:
+    """
+    Passes a streamed response through, and caches it once it has been sent completely.
+    """
+    collected = []
+    size = 0
+    for chunk in chunks:
+        if collected is not None:
+            collected.append(chunk)
+            size += len(chunk)
+            if size > settings.RESPONSE_CACHE_MAX_BYTES:
+                collected = None
+        yield chunk
+    if collected is not None:
+        response_cache.set(key, content_type, b''.join(collected), generation)
+
+
+def _clear_response_cache(sender, **kwargs):
+    # Once the change is committed, so the responses computed until then aren't cached (see `get_generation`)
+    transaction.on_commit(response_cache.clear)
+
+
+post_save.connect(_clear_response_cache, sender=Recording)
+post_delete.connect(_clear_response_cache, sender=Recording)
@@ -0,0 +1,16 @@
+from django.conf import settings
+
+__all__ = ('ArchiveRouter',)
+
+
+class ArchiveRouter(object):
+    """
+    Keeps everything in the default database, except that the archive database
+    (``settings.RECORDING_ARCHIVE_DATABASE``) gets the recording table too, for the archived months
+    (see :class:`ArchivedMonth`). The archive is only ever queried explicitly, with ``using()``.
+    """
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.RECORDING_ARCHIVE_DATABASE:
+            return app_label == 'noisemapper' and model_name == 'recording'
+        return None
@@ -0,0 +1,145 @@
+import array
+import datetime as dt
+import json
+import struct
+import sys
+import uuid as uuid_lib
+from typing import Callable, Iterable, Iterator, Optional, Any, List
+
+__all__ = ('format_timestamp', 'recordings_to_columns', 'iter_json', 'BINARY_CONTENT_TYPE', 'encode_binary')
+
+
+def format_timestamp(timestamp) -> str:
+    """
+    Same as ``timestamp.strftime('%Y-%m-%d %H:%M:%S')``, but several times faster.
+    """
+    return str(timestamp)[:19]
+
+
+def recordings_to_columns(recordings: Iterable) -> dict:
+    """
+    The compact ("columnar") form of a cluster's originals: one list per field, instead of one dict per recording,
+    so the keys aren't repeated. The fields are the ones of ``recording_to_json2``.
+    """
+    recordings = list(recordings)
+    columns = dict(
+        timestamp=[format_timestamp(r.timestamp) for r in recordings],
+        uuid=[r.uuid for r in recordings],
+        avg=[r.measurement_avg for r in recordings],
+        max=[r.measurement_max for r in recordings],
+        device_name=[r.device_name for r in recordings],
+        mic_source=[r.mic_source for r in recordings],
+        proximity=[r.proximity for r in recordings],
+    )
+    for attr in ('weight', 'deviation'):
+        if recordings and hasattr(recordings[0], attr):
+            columns[attr] = [getattr(r, attr, None) for r in recordings]
+    return columns
+
+
+def iter_json(data: dict, default: Optional[Callable[[Any], Any]] = None, chunk_size=200) -> Iterator[str]:
+    """
+    Encodes ``data`` like ``json.dumps`` (but without the optional whitespace), except that the elements of
+    its ``data`` list are encoded and yielded ``chunk_size`` at a time, so the whole document
+    never has to be in memory as a single string.
+    """
+    encoder = json.JSONEncoder(default=default, separators=(',', ':'))
+
+    head = dict(data)
+    items = head.pop('data')
+    yield encoder.encode(head)[:-1] + (',' if head else '') + '"data":['
+    for i in range(0, len(items), chunk_size):
+        yield (',' if i else '') + encoder.encode(items[i:i + chunk_size])[1:-1]
+    yield ']}'
+
+
+BINARY_CONTENT_TYPE = 'application/vnd.noisemapper.clusters'
+
+_BINARY_MAGIC = b'NMC1'
+_EPOCH = dt.datetime(1970, 1, 1)
+_NO_STRING = 0xFFFFFFFF
+_NAN = float('nan')
+
+
+def encode_binary(data: dict) -> bytes:
+    """
+    Packs a map response, whose clusters have their originals as recordings (not yet converted to JSON),
+    into a compact struct-of-arrays. All numbers are little-endian. Strings are stored only once, in a table,
+    and are referred to by their index in it.
+
+    - header: ``b'NMC1'``, f64 min, f64 max, u32 number of clusters (n), u32 number of originals (m),
+      u8 flags (bit 0: the originals have a weight, bit 1: they have a deviation)
+    - strings: u32 count, then for each: u16 length in bytes, UTF-8 bytes
+    - clusters: f64 lat[n], f64 lon[n], f64 value[n], f64 display[n], u32 number of originals[n]
+    - originals, in cluster order: i64 timestamp (Unix time)[m], 16 byte uuid[m], f32 avg[m], f32 max[m],
+      u32 device name[m], u32 mic source[m], u32 proximity[m], then f32 weight[m] and f32 deviation[m]
+      if they are flagged
+
+    Missing numbers are NaN, missing strings are 0xFFFFFFFF, and missing uuids are all zeros.
+    """
+    clusters = data['data']
+    originals = [r for cluster in clusters for r in cluster['original']]
+    has_weight = bool(originals) and hasattr(originals[0], 'weight')
+    has_deviation = bool(originals) and hasattr(originals[0], 'deviation')
+
+    strings = {}
+
+    def string_index(value: Optional[str]) -> int:
+        if value is None:
+            return _NO_STRING
+        return strings.setdefault(value, len(strings))
+
+    device_names = [string_index(r.device_name) for r in originals]
+    mic_sources = [string_index(r.mic_source) for r in originals]
+    proximities = [string_index(r.proximity) for r in originals]
+
+    parts = [
+        _BINARY_MAGIC,
+        struct.pack('<ddIIB', data['min'], data['max'], len(clusters), len(originals),
+                    has_weight | has_deviation << 1),
+        struct.pack('<I', len(strings)),
+    ]
+    for string in strings:
+        encoded = string.encode('utf-8')
+        parts.append(struct.pack('<H', len(encoded)))
+        parts.append(encoded)
+
+    parts += [
+        _pack('d', [c['coordinates']['lat'] for c in clusters]),
+        _pack('d', [c['coordinates']['lon'] for c in clusters]),
+        _pack('d', [c['value'] for c in clusters]),
+        _pack('d', [c.get('display', _NAN) for c in clusters]),
+        _pack('I', [len(c['original']) for c in clusters]),
+
+        _pack('q', [int((r.timestamp - _EPOCH).total_seconds()) for r in originals]),
+        b''.join(_uuid_bytes(r.uuid) for r in originals),
+        _pack('f', [_or_nan(r.measurement_avg) for r in originals]),
+        _pack('f', [_or_nan(r.measurement_max) for r in originals]),
+        _pack('I', device_names),
+        _pack('I', mic_sources),
+        _pack('I', proximities),
+    ]
+    if has_weight:
+        parts.append(_pack('f', [_or_nan(r.weight) for r in originals]))
+    if has_deviation:
+        parts.append(_pack('f', [_or_nan(r.deviation) for r in originals]))
+
+    return b''.join(parts)
+
+
+def _pack(typecode: str, values: List) -> bytes:
+    packed = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _or_nan(value: Optional[float]) -> float:
+    return _NAN if value is None else value
+
+
+def _uuid_bytes(value: Optional[str]) -> bytes:
+    try:
+        return uuid_lib.UUID(value).bytes
+    except (TypeError, ValueError, AttributeError):
+        return bytes(16)
@@ -0,0 +1,149 @@
+import base64
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, List, Tuple, Iterator
+
+from django.conf import settings
+
+from noisemapper.metrics import metrics
+
+__all__ = ('snippet_path', 'find_snippet', 'iter_concatenated', 'SnippetWriter', 'snippet_writer')
+
+
+def snippet_path(uuid: Optional[str]) -> str:
+    """
+    Where the snippet of the recording ``uuid`` is stored. Snippets are spread into subdirectories
+    by the first two characters of their name, so no directory grows too large.
+    """
+    filename = settings.FILENAME_PATTERN % uuid
+    return os.path.join(settings.SNIPPET_STORAGE_DIR, filename[:2], filename)
+
+
+def find_snippet(uuid: Optional[str]) -> str:
+    """
+    Like :func:`snippet_path`, but falls back to the flat layout snippets were stored in
+    before the subdirectories were introduced.
+    """
+    path = snippet_path(uuid)
+    if os.path.exists(path):
+        return path
+    return os.path.join(settings.SNIPPET_STORAGE_DIR, settings.FILENAME_PATTERN % uuid)
+
+
+def iter_concatenated(files: List[Tuple[str, int]], start: int, stop: int, chunk_size=256 * 1024) -> Iterator[bytes]:
+    """
+    Yields the bytes [start, stop) of the concatenation of ``files``, given as (filename, size) pairs,
+    in chunks, without reading more than one chunk into memory.
+
+    The sizes are trusted, so the output always has the announced length: a file that has disappeared
+    or shrunk since is padded with zeros (i.e. silence), so the offsets of the following ones stay valid.
+    """
+    offset = 0
+    for filename, size in files:
+        if offset + size <= start:
+            offset += size
+            continue
+        if offset >= stop:
+            break
+
+        skip = max(start - offset, 0)
+        remaining = min(size, stop - offset) - skip
+        try:
+            with open(filename, 'rb') as fh:
+                fh.seek(skip)
+                while remaining > 0:
+                    chunk = fh.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+        except OSError:
+            logging.exception("Couldn't read %s" % filename)
+        while remaining > 0:
+            padding = min(chunk_size, remaining)
+            remaining -= padding
+            yield bytes(padding)
+        offset += size
+
+
+class SnippetWriter(object):
+    """
+    Decodes and writes the uploaded snippets in background threads, so the upload request doesn't have to wait
+    for the disk. At most ``max_pending`` snippets are queued: above that, :meth:`submit` blocks, so a big upload
+    can't pile up all its snippets in memory.
+
+    A snippet is written to a temporary file next to its place, whose name is the result of the future returned
+    by :meth:`submit`. Once its recording is saved, it is renamed into place by :meth:`publish`, otherwise
+    removed by :meth:`discard`; so a half-written snippet, or that of a recording that wasn't saved,
+    is never visible.
+    """
+
+    def __init__(self, threads: int, max_pending: int):
+        self.threads = threads
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created lazily, so the threads are started in the uWSGI worker, not in the master before forking
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads)
+            return self._executor
+
+    def submit(self, uuid: Optional[str], encoded_data: str) -> Future:
+        self._slots.acquire()
+        try:
+            future = self._get_executor().submit(self._write, uuid, encoded_data)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    @staticmethod
+    def _write(uuid: Optional[str], encoded_data: str) -> str:
+        tmp_filename = None
+        try:
+            directory = os.path.dirname(snippet_path(uuid))
+            os.makedirs(directory, exist_ok=True)
+
+            data = base64.b64decode(encoded_data)
+            fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+        except:
+            logging.exception("Couldn't decode or save the uploaded file for %s" % uuid)
+            if tmp_filename and os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        metrics.inc('noisemapper_snippet_bytes_written_total', len(data))
+        return tmp_filename
+
+    @staticmethod
+    def publish(uuid: Optional[str], tmp_filename: str) -> None:
+        os.replace(tmp_filename, snippet_path(uuid))
+
+    @staticmethod
+    def discard(tmp_filename: str) -> None:
+        try:
+            os.remove(tmp_filename)
+        except FileNotFoundError:
+            pass
+
+    def shutdown(self, wait=True) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+snippet_writer = SnippetWriter(
+    threads=settings.SNIPPET_WRITER_THREADS,
+    max_pending=settings.SNIPPET_WRITER_MAX_PENDING,
+)
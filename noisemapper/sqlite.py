@@ -0,0 +1,14 @@
+from django.conf import settings
+
+__all__ = ('configure_connection',)
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Receiver of ``connection_created``: sets ``settings.SQLITE_PRAGMAS`` on every new SQLite connection.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
@@ -1,3 +1,1037 @@
-from django.test import TestCase
+import base64
+import datetime as dt
+import decimal as dec
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import sqlite3
+import struct
+import subprocess
+import tempfile
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+
+from noisemapper.admission import admission_controller
+from noisemapper.ingest import create_recording, save_new_recordings, ingest_queue
+from noisemapper.metrics import MetricsRegistry, metrics
+from noisemapper.management.commands._benchmark_utils import make_processed_record, make_api_client
+from noisemapper.models import Recording, RecordingGroupTotals, RecordingCluster, RecordingClusterMember, MapTile, \
+    ExcludedPeriod, ArchivedMonth
+from noisemapper.models.recording import RecordingRow
+from noisemapper.parallel_clustering import ParallelClusterer
+from noisemapper.response_cache import response_cache
+from noisemapper.serialization import encode_binary
+from noisemapper.snippet_storage import SnippetWriter, snippet_path
+from noisemapper.utils import iter_json_array
+from noisemapper.views.api_endpoints import _build_filters, _build_excludes, _parse_range
+
+
+class TemporaryFilesMixin(object):
+    """
+    Points the SQLite files next to the database (the response cache, the ingest queue, ...) and the snippet
+    storage to a temporary directory, so the tests start empty and never touch the real ones.
+    """
+
+    def setUp(self):
+        super(TemporaryFilesMixin, self).setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        overrides = override_settings(
+            RESPONSE_CACHE_PATH=os.path.join(self.temp_dir, 'response_cache.sqlite3'),
+            INGEST_QUEUE_PATH=os.path.join(self.temp_dir, 'ingest_queue.sqlite3'),
+            METRICS_PATH=os.path.join(self.temp_dir, 'metrics.sqlite3'),
+            ADMISSION_PATH=os.path.join(self.temp_dir, 'admission.sqlite3'),
+            SNIPPET_STORAGE_DIR=os.path.join(self.temp_dir, 'snippets'),
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # Before the override is gone, so the metrics of the test aren't written to the real file later
+        self.addCleanup(metrics.flush)
+
+
+class MapQueryPlanTest(TestCase):
+    """
+    Makes sure SQLite answers the map queries from the indexes, instead of scanning the whole table.
+    """
+
+    def _get_plan(self, **params) -> str:
+        request = RequestFactory().get('/', dict(deviceNames='a|b', micSources='internal|headset', **params))
+        queryset = Recording.objects.filter(**_build_filters(request)).exclude(_build_excludes(request))
+        sql, sql_params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, sql_params)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def _get_index_name(self, columns) -> str:
+        table = Recording._meta.db_table
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        for index_name, constraint in constraints.items():
+            if constraint['index'] and constraint['columns'] == list(columns):
+                return index_name
+        self.fail('No index on %s' % (columns, ))
+
+    def test_filters_use_device_mic_source_timestamp_index(self):
+        plan = self._get_plan(is_cropping='false')
+        index_name = self._get_index_name(('device_name', 'mic_source', 'timestamp'))
+        self.assertIn('USING INDEX %s' % index_name, plan)
+
+    def test_cropped_filters_use_an_index(self):
+        plan = self._get_plan(is_cropping='true', south='59.9', north='60.0', west='10.6', east='10.8')
+        self.assertIn('USING INDEX', plan)
+        self.assertNotRegex(plan, r'\bSCAN\b')
+
+    def test_bounding_box_index_exists(self):
+        self._get_index_name(('lat', 'lon'))
+
+
+class InvalidationTest(TemporaryFilesMixin, TransactionTestCase):
+    """
+    The cached responses and tiles are only invalidated once new recordings are committed, so a response
+    computed before the commit can't be cached as up to date.
+    """
+
+    def test_invalidated_after_commit(self):
+        recording = create_recording(make_processed_record(random.Random(1)), 'a')
+        zoom = 10
+        x, y = MapTile.get_tile(recording.lat, recording.lon, zoom)
+        MapTile.objects.create(zoom=zoom, x=x, y=y, params_key='key', content='{}')
+        generation = response_cache.get_generation()
+
+        with transaction.atomic():
+            save_new_recordings([recording], set())
+            self.assertEqual(response_cache.get_generation(), generation)
+            self.assertTrue(MapTile.objects.filter(zoom=zoom, x=x, y=y).exists())
+
+        self.assertNotEqual(response_cache.get_generation(), generation)
+        self.assertFalse(MapTile.objects.filter(zoom=zoom, x=x, y=y).exists())
+
+    def test_excluded_period_rebuilds_clusters(self):
+        rnd = random.Random(1)
+        save_new_recordings([create_recording(make_processed_record(rnd), 'a') for _ in range(50)], set())
+        base = list(RecordingCluster.get_base_recordings())
+        self.assertTrue(RecordingCluster.covers(100, base))
+
+        ExcludedPeriod.objects.create(start=dt.datetime(2017, 4, 1), end=dt.datetime(2017, 5, 1))
+        narrowed = list(RecordingCluster.get_base_recordings())
+        self.assertTrue(0 < len(narrowed) < len(base))
+        self.assertFalse(RecordingCluster.covers(100, base))
+        self.assertTrue(RecordingCluster.covers(100, narrowed))
+
+
+class InvalidParameterTest(TemporaryFilesMixin, TestCase):
+    """
+    Invalid parameters get a 400 with the reason, instead of a 500.
+    """
+
+    PATHS = ('/api/get_actual_data/', '/api/get_deviation_data/', '/api/get_cluster_originals/',
+             '/api/tiles/1/0/0/', '/api/download/')
+
+    def setUp(self):
+        super(InvalidParameterTest, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client = Client()
+        self.client.login(username='admin', password='admin')
+
+    def _get(self, path, **params):
+        return self.client.get(path, dict(dict(deviceNames='a', micSources='internal', is_cropping='false',
+                                               resolution='50', maxOrAvg='measurement_avg', cluster='1'), **params))
+
+    def test_invalid_time_filters(self):
+        for params in (dict(hours='25'), dict(hours='x'), dict(weekdays='9'), {'from': 'garbage'},
+                       {'to': '2017-02-30'}):
+            for path in self.PATHS:
+                response = self._get(path, **params)
+                self.assertEqual(response.status_code, 400, (path, params))
+                self.assertIn(b'Invalid', response.content)
+
+    def test_invalid_cell_aggregation(self):
+        for params in (dict(aggregation='cells', cellPrecision='x'), dict(aggregation='cells', maxOrAvg='pk')):
+            response = self._get('/api/get_actual_data/', **params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_unknown_measurement(self):
+        # All but the download, which doesn't show a measurement
+        for path in self.PATHS[:-1]:
+            self.assertEqual(self._get(path, maxOrAvg='uuid').status_code, 400, path)
+
+    def test_valid_time_filters(self):
+        response = self._get('/api/get_actual_data/', hours='1|2', weekdays='1|7', to='2017-03-01 12:00')
+        self.assertEqual(response.status_code, 200)
+
+
+class GroupTotalsTest(TemporaryFilesMixin, TestCase):
+    """
+    The averages the deviation data is computed from leave out the excluded periods, like the selections do.
+    """
+
+    def setUp(self):
+        super(GroupTotalsTest, self).setUp()
+        rnd = random.Random(1)
+        self.recordings = [create_recording(make_processed_record(rnd), 'a') for _ in range(50)]
+        for recording in self.recordings:
+            recording.mic_source = 'internal'
+        # Only these, not the ones the migrations add
+        ExcludedPeriod.objects.all().delete()
+        ExcludedPeriod.objects.create(start=dt.datetime(2017, 4, 1), end=dt.datetime(2017, 5, 1), device_name='a')
+        ExcludedPeriod.objects.create(end=dt.datetime(2017, 3, 10))
+
+    def _assert_totals(self):
+        included = [r for r in self.recordings if not (dt.datetime(2017, 4, 1) <= r.timestamp < dt.datetime(2017, 5, 1)
+                                                       or r.timestamp < dt.datetime(2017, 3, 10))]
+        self.assertTrue(0 < len(included) < len(self.recordings))
+        totals = RecordingGroupTotals.objects.get(device_name='a', mic_source='internal')
+        self.assertEqual(totals.measurement_avg_count, len(included))
+        self.assertAlmostEqual(totals.measurement_avg_sum, sum(r.measurement_avg for r in included))
+
+    def test_totals_leave_out_excluded_periods(self):
+        save_new_recordings(self.recordings, set())
+        self._assert_totals()
+        RecordingGroupTotals.rebuild()
+        self._assert_totals()
+
+    def test_group_without_totals(self):
+        save_new_recordings(self.recordings, set())
+        RecordingGroupTotals.objects.all().delete()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+        response = self.client.get('/api/get_deviation_data/', dict(
+            deviceNames='a', micSources='internal', is_cropping='false', resolution='50', maxOrAvg='measurement_avg'))
+        self.assertEqual(response.status_code, 200)
+
+
+class StoredClustersTest(TemporaryFilesMixin, TestCase):
+    """
+    The stored clusters are only used when all the recordings they are built from are selected (the excluded
+    periods, like the one the migrations add in March 2017, are left out of both); either way, the clusters are
+    the same as those of clustering the selection on its own.
+    """
+
+    def setUp(self):
+        super(StoredClustersTest, self).setUp()
+        rnd = random.Random(1)
+        self.recordings = [create_recording(make_processed_record(rnd, spread=0.01), device_name)
+                           for device_name in ('a', 'b') for _ in range(200)]
+        self.assertTrue(any(dt.datetime(2017, 3, 5) <= r.timestamp < dt.datetime(2017, 3, 6) for r in self.recordings))
+        # In two uploads, so the second one joins the clusters of the first
+        save_new_recordings(self.recordings[::2], set())
+        save_new_recordings(self.recordings[1::2], set())
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _get_clusters(self, **params):
+        response_cache.clear()
+        with mock.patch.object(RecordingCluster, 'get_assignments', wraps=RecordingCluster.get_assignments) as lookup:
+            response = self.client.get('/api/get_actual_data/', dict(dict(
+                deviceNames='a|b', micSources='internal|headset', is_cropping='false', resolution='100',
+                maxOrAvg='measurement_avg'), **params))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content).decode('utf-8')), lookup.called
+
+    def test_stored_clusters(self):
+        for params, stored in ((dict(), True), (dict(deviceNames='a'), False), (dict(hours='1|2|3'), False)):
+            clusters, looked_up = self._get_clusters(**params)
+            self.assertEqual(looked_up, stored, params)
+            with override_settings(CLUSTER_STORE_RESOLUTIONS=()):
+                self.assertEqual(self._get_clusters(**params), (clusters, False), params)
+
+    def _get_stored(self):
+        return list(RecordingCluster.objects.order_by('resolution', 'seed_id').values_list(
+            'resolution', 'seed_id', 'lat', 'lon', 'count', 'measurement_avg_count', 'measurement_max_count'))
+
+    def test_sums(self):
+        base = list(RecordingCluster.get_base_recordings())
+        self.assertTrue(0 < len(base) < len(self.recordings))
+        for resolution in settings.CLUSTER_STORE_RESOLUTIONS:
+            self.assertTrue(RecordingCluster.covers(resolution, base))
+            self.assertFalse(RecordingCluster.covers(resolution, base[1:]))
+
+        # Kept up to date on upload, as if they were clustered at once
+        stored = self._get_stored()
+        sums = list(RecordingCluster.objects.order_by('resolution', 'seed_id').values_list(
+            'lat_sum', 'lon_sum', 'measurement_avg_sum', 'measurement_max_sum'))
+        RecordingCluster.rebuild()
+        self.assertEqual(self._get_stored(), stored)
+        for expected, actual in zip(sums, RecordingCluster.objects.order_by('resolution', 'seed_id').values_list(
+                'lat_sum', 'lon_sum', 'measurement_avg_sum', 'measurement_max_sum')):
+            for expected_sum, actual_sum in zip(expected, actual):
+                self.assertAlmostEqual(expected_sum, actual_sum)
+
+        by_pk = {r.pk: r for r in base}
+        for cluster in RecordingCluster.objects.filter(resolution=100):
+            members = [by_pk[pk] for pk in RecordingClusterMember.objects.filter(
+                resolution=100, seed_id=cluster.seed_id).values_list('recording_id', flat=True)]
+            self.assertEqual(cluster.count, len(members))
+            self.assertAlmostEqual(cluster.measurement_avg_sum, sum(r.measurement_avg for r in members))
+
+
+class MapTileTest(TemporaryFilesMixin, TestCase):
+
+    def setUp(self):
+        super(MapTileTest, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _get_tile(self, zoom, x, y):
+        response = self.client.get('/api/tiles/%d/%d/%d/' % (zoom, x, y), dict(
+            deviceNames='a', micSources='internal', maxOrAvg='measurement_avg'))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    @override_settings(TILE_VALUE_RANGES={'measurement_avg': (30, 90), 'measurement_max': (40, 110)})
+    def test_same_scale(self):
+        rnd = random.Random(1)
+        recordings = []
+        # A quiet and a loud tile
+        for lon, value in ((10.7, 40), (10.7, 45), (11.7, 60), (11.7, 100)):
+            recording = create_recording(make_processed_record(rnd), 'a')
+            recording.lon, recording.measurement_avg, recording.mic_source = lon, value, 'internal'
+            recordings.append(recording)
+        save_new_recordings(recordings, set())
+
+        zoom = 9
+        displays = []
+        for lon in (10.7, 11.7):
+            x, y = MapTile.get_tile(recordings[0].lat, lon, zoom)
+            displays.extend(cluster['display'] for cluster in self._get_tile(zoom, x, y)['data'])
+        # One cluster in each, of 42.5 and 80 dB, on the scale from 30 to 90, instead of both at the bottom of theirs
+        self.assertEqual([round(display, 3) for display in displays], [2.208, 2.833])
+
+    @override_settings(TILE_MAX_COUNT=20)
+    def test_eviction(self):
+        for x in range(20):
+            MapTile.objects.create(zoom=5, x=x, y=0, params_key='key', content='{}')
+        MapTile.evict()
+        self.assertEqual(MapTile.objects.count(), 20)
+
+        # Over the limit by one, the oldest three go
+        self._get_tile(5, 0, 1)
+        self.assertEqual(sorted(MapTile.objects.filter(y=0).values_list('x', flat=True)), list(range(3, 20)))
+        self.assertTrue(MapTile.objects.filter(zoom=5, x=0, y=1).exists())
+
+
+class ClusterOriginalsTest(TemporaryFilesMixin, TestCase):
+    """
+    The pages of the originals of a cluster are looked up by the members stored with the summary response.
+    """
+
+    PARAMS = dict(deviceNames='a', micSources='internal|headset', is_cropping='false', resolution='200',
+                  maxOrAvg='measurement_avg')
+
+    def setUp(self):
+        super(ClusterOriginalsTest, self).setUp()
+        rnd = random.Random(1)
+        save_new_recordings([create_recording(make_processed_record(rnd, spread=0.01), 'a') for _ in range(300)],
+                            set())
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _get_pages(self, data_type, cluster, page_size):
+        pages = []
+        with mock.patch('noisemapper.views.api_endpoints._group_recordings') as group:
+            while not pages or pages[-1]['original']:
+                response = self.client.get('/api/get_cluster_originals/', dict(
+                    self.PARAMS, dataType=data_type, cluster=cluster, page=len(pages), pageSize=page_size))
+                self.assertEqual(response.status_code, 200)
+                pages.append(json.loads(response.content.decode('utf-8')))
+        self.assertFalse(group.called)
+        return pages
+
+    def test_paging(self):
+        for data_type, path in (('actual', '/api/get_actual_data/'), ('deviation', '/api/get_deviation_data/')):
+            response = self.client.get(path, dict(self.PARAMS, layout='summary'))
+            clusters = json.loads(b''.join(response.streaming_content).decode('utf-8'))['data']
+            cluster = max(clusters, key=lambda c: c['count'])
+            self.assertGreater(cluster['count'], 10)
+
+            pages = self._get_pages(data_type, cluster['id'], 7)
+            originals = [original for page in pages for original in page['original']]
+            self.assertEqual(len(pages), (cluster['count'] + 6) // 7 + 1)
+            self.assertEqual({page['count'] for page in pages}, {cluster['count']})
+            self.assertEqual(len({original['uuid'] for original in originals}), cluster['count'])
+            if data_type == 'deviation':
+                self.assertTrue(all('deviation' in original for original in originals))
+
+            # The same, if the selection has to be clustered again
+            response_cache.clear()
+            response = self.client.get('/api/get_cluster_originals/', dict(
+                self.PARAMS, dataType=data_type, cluster=cluster['id'], page=0, pageSize=7))
+            self.assertEqual(json.loads(response.content.decode('utf-8')), pages[0])
+
+    def test_no_such_cluster(self):
+        response = self.client.get('/api/get_cluster_originals/', dict(self.PARAMS, cluster=0))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(INGEST_QUEUE_ENABLED=True)
+class IngestQueueTest(TemporaryFilesMixin, TestCase):
+
+    def setUp(self):
+        super(IngestQueueTest, self).setUp()
+        self.rnd = random.Random(1)
+
+    def test_single_upload_is_saved(self):
+        client = make_api_client()
+        record = make_processed_record(self.rnd)
+        server_ids = []
+        for _ in range(2):
+            response = client.post('/api/upload_recording/', json.dumps(record), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            server_ids.append(json.loads(response.content.decode('utf-8'))['server_id'])
+        # The same for the re-sent one
+        self.assertEqual(server_ids, [Recording.objects.get().pk] * 2)
+        self.assertEqual(len(ingest_queue), 0)
+
+    def test_drain(self):
+        records = [make_processed_record(self.rnd) for _ in range(5)]
+        del records[0]['uuid']
+        ingest_queue.put('a', records[:3])
+        # Re-sent, and one that can't be saved
+        ingest_queue.put('a', records[2:] + [{'uuid': 'x'}])
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(ingest_queue.drain(4), (4, 3))
+            self.assertEqual(ingest_queue.drain(10), (3, 2))
+        self.assertEqual(ingest_queue.drain(10), (0, 0))
+        self.assertEqual(Recording.objects.count(), 5)
+
+    def test_interrupted_drain(self):
+        records = [make_processed_record(self.rnd) for _ in range(3)]
+        for record in records:
+            del record['uuid']
+        ingest_queue.put('a', records)
+        connection = ingest_queue._get_connection()
+        items = connection.execute('SELECT * FROM item').fetchall()
+        self.assertEqual(ingest_queue.drain(10), (3, 3))
+
+        # As if the items couldn't be removed after the recordings were saved
+        connection.executemany('INSERT INTO item VALUES (?, ?, ?, ?)', items)
+        ingest_queue.put('a', records[:1])
+        self.assertEqual(ingest_queue.drain(10), (1, 1))
+        self.assertEqual(len(ingest_queue), 0)
+        self.assertEqual(Recording.objects.count(), 4)
+
+
+class ParallelClustererTest(TestCase):
+
+    def test_fork_server(self):
+        clusterer = ParallelClusterer(processes=2, min_rows=0)
+        self.addCleanup(clusterer.shutdown)
+        # Not forked from this process, whose threads may hold locks
+        self.assertNotEqual(clusterer._get_executor().submit(os.getppid).result(), os.getpid())
+
+    def test_broken_pool(self):
+        rnd = random.Random(1)
+        points = [(59.94 + rnd.uniform(-0.01, 0.01), 10.72 + rnd.uniform(-0.02, 0.02)) for _ in range(2000)]
+        clusterer = ParallelClusterer(processes=2, min_rows=0)
+        self.addCleanup(clusterer.shutdown)
+        expected = clusterer.group(points, key_func=(lambda p: p), resolution=dec.Decimal(50))
+
+        for pid in list(clusterer._get_executor()._processes):
+            os.kill(pid, signal.SIGKILL)
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(clusterer.group(points, key_func=(lambda p: p), resolution=dec.Decimal(50)), expected)
+        # With a new pool
+        self.assertEqual(clusterer.group(points, key_func=(lambda p: p), resolution=dec.Decimal(50)), expected)
+
+
+class BackfillProximityTest(TemporaryFilesMixin, TestCase):
+
+    def test_backfill(self):
+        rnd = random.Random(1)
+        recordings = [create_recording(make_processed_record(rnd), 'a') for _ in range(7)]
+        recordings[1].device_state = '{}'
+        recordings[4].device_state = 'not json'
+        for recording in recordings:
+            recording.proximity = ''
+        save_new_recordings(recordings, set())
+
+        with self.assertLogs(level='ERROR'):
+            call_command('backfill_proximity', chunk_size=2, stdout=io.StringIO())
+        expected = [json.loads(r.device_state).get('proximityText', '') if i != 4 else ''
+                    for i, r in enumerate(recordings)]
+        self.assertEqual(list(Recording.objects.order_by('pk').values_list('proximity', flat=True)), expected)
+
+
+class ParseRangeTest(TestCase):
+
+    def test_parse_range(self):
+        for header, expected in (
+                ('', None),
+                ('bytes=0-99', (0, 100)),
+                ('bytes=10-', (10, 100)),
+                ('bytes=90-200', (90, 100)),
+                ('bytes=-10', (90, 100)),
+                ('bytes=-200', (0, 100)),
+                ('bytes=99-99', (99, 100)),
+                # Ignored: invalid, multiple or other units
+                ('bytes=5-3', None),
+                ('bytes=-', None),
+                ('bytes=0-1,5-6', None),
+                ('items=0-1', None),
+                # Not satisfiable
+                ('bytes=100-', False),
+                ('bytes=100-200', False),
+                ('bytes=-0', False)):
+            self.assertEqual(_parse_range(header, 100), expected, header)
+        self.assertEqual(_parse_range('bytes=0-', 0), False)
+        self.assertEqual(_parse_range('bytes=-5', 0), False)
+
+
+class UploadSnippetTest(TemporaryFilesMixin, TransactionTestCase):
+    """
+    The snippets of an uploaded batch are only put in place once their recordings are saved.
+    """
+
+    def setUp(self):
+        super(UploadSnippetTest, self).setUp()
+        self.rnd = random.Random(1)
+        self.client = make_api_client()
+
+    def _upload(self, records):
+        return self.client.post('/api/upload_recording_batch/', json.dumps(records), content_type='application/json')
+
+    def _get_files(self):
+        return sorted(name for _, _, names in os.walk(settings.SNIPPET_STORAGE_DIR) for name in names)
+
+    def _assert_snippets(self, records):
+        for record in records:
+            with open(snippet_path(record['uuid']), 'rb') as fh:
+                self.assertEqual(fh.read(), base64.b64decode(record['file']))
+        # No temporary files left
+        self.assertEqual(len(self._get_files()), len(records))
+
+    def _test_upload(self):
+        records = [make_processed_record(self.rnd, snippet_size=100) for _ in range(3)]
+        self.assertEqual(self._upload(records).status_code, 200)
+        self._assert_snippets(records)
+        ingest_queue.drain(10)
+
+        # Not replaced by those of a re-sent batch
+        resent = [dict(record, file=make_processed_record(self.rnd, snippet_size=100)['file']) for record in records]
+        new = make_processed_record(self.rnd, snippet_size=100)
+        self.assertEqual(self._upload(resent[:2] + [new]).status_code, 200)
+        self._assert_snippets(records + [new])
+
+    @override_settings(INGEST_QUEUE_ENABLED=False)
+    def test_upload(self):
+        self._test_upload()
+
+    @override_settings(INGEST_QUEUE_ENABLED=True)
+    def test_queued_upload(self):
+        self._test_upload()
+        self.assertEqual(ingest_queue.drain(10), (3, 1))
+        self.assertEqual(Recording.objects.count(), 4)
+
+    def test_failed_write(self):
+        records = [make_processed_record(self.rnd, snippet_size=100) for _ in range(3)]
+        write = SnippetWriter._write
+
+        def fail_second(uuid, encoded_data):
+            if uuid == records[1]['uuid']:
+                raise OSError('No space left on device')
+            return write(uuid, encoded_data)
+
+        with mock.patch.object(SnippetWriter, '_write', side_effect=fail_second):
+            self.assertEqual(self._upload(records).status_code, 500)
+        self.assertEqual(Recording.objects.count(), 0)
+        self.assertEqual(self._get_files(), [])
+
+    def test_invalid_record(self):
+        records = [make_processed_record(self.rnd, snippet_size=100) for _ in range(3)]
+        del records[2]['timestamp']
+        self.assertEqual(self._upload(records).status_code, 401)
+        self.assertEqual(Recording.objects.count(), 0)
+        self.assertEqual(self._get_files(), [])
+
+
+class IterJsonArrayTest(TestCase):
+    """
+    The streamed parser gives the same elements as ``json.loads``, wherever the chunks happen to end.
+    """
+
+    def _parse(self, text: str, chunk_size: int) -> list:
+        return list(iter_json_array(io.BytesIO(text.encode('utf-8')), chunk_size=chunk_size))
+
+    def test_same_as_json_loads(self):
+        documents = (
+            '[]',
+            ' [ ] ',
+            '[1]',
+            '[12345, -6.5e-3, 1E+10, true, false, null]',
+            '[{"a": [1, 2, {"b": "]},["}], "c": "\\u00e6\\"\\\\"}, "ø å 漢字", []]',
+            '\n[\n  {"uuid": "x", "processResult": {"avg": 40.25}},\n  {"uuid": "y"}\n]\n',
+            json.dumps([make_processed_record(random.Random(1), snippet_size=300) for _ in range(3)]),
+        )
+        for document in documents:
+            for chunk_size in (1, 2, 3, 7, 64 * 1024):
+                self.assertEqual(self._parse(document, chunk_size), json.loads(document), (document, chunk_size))
+
+    def test_invalid(self):
+        for document in ('', '{"a": 1}', '[1 2]', '[1,', '[1', '[{"a": 1}', '["a" :]'):
+            for chunk_size in (1, 64 * 1024):
+                with self.assertRaises(ValueError, msg=(document, chunk_size)):
+                    self._parse(document, chunk_size)
+
+
+class ResponseCacheTest(TemporaryFilesMixin, TestCase):
+
+    @override_settings(RESPONSE_CACHE_MAX_BYTES=30)
+    @mock.patch('noisemapper.response_cache.time')
+    def test_least_recently_used_are_evicted(self, clock):
+        # Every use is a second after the previous one, so their order is unambiguous
+        clock.time.side_effect = itertools.count(1000)
+        generation = response_cache.get_generation()
+        for key in 'abc':
+            response_cache.set(key, 'text/plain', key.encode('ascii') * 10, generation)
+        response_cache.get('a')
+        response_cache.set('d', 'text/plain', b'd' * 10, generation)
+        self.assertIsNone(response_cache.get('b'))
+        for key in 'acd':
+            self.assertEqual(response_cache.get(key).content, key.encode('ascii') * 10)
+
+        # Too big to be stored at all; the others stay
+        entry = response_cache.set('e', 'text/plain', b'e' * 31, generation)
+        self.assertEqual(entry.content, b'e' * 31)
+        self.assertIsNone(response_cache.get('e'))
+        self.assertIsNotNone(response_cache.get('a'))
+
+    def test_generation(self):
+        generation = response_cache.get_generation()
+        entry = response_cache.set('a', 'text/plain', b'a', generation)
+        self.assertEqual(response_cache.get('a'), entry)
+
+        response_cache.clear()
+        self.assertIsNone(response_cache.get('a'))
+        self.assertEqual(response_cache.get_generation(), generation + 1)
+        # Computed before the clear
+        response_cache.set('a', 'text/plain', b'a', generation)
+        self.assertIsNone(response_cache.get('a'))
+        response_cache.set('a', 'text/plain', b'a', generation + 1)
+        self.assertEqual(response_cache.get('a'), entry)
+
+    def test_etag(self):
+        save_new_recordings([create_recording(make_processed_record(random.Random(1)), 'a') for _ in range(10)],
+                            set())
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        params = dict(deviceNames='a', micSources='internal|headset', is_cropping='false', resolution='50',
+                      maxOrAvg='measurement_avg')
+
+        # Streamed, and stored once it is sent
+        content = b''.join(self.client.get('/api/get_actual_data/', params).streaming_content)
+        response = self.client.get('/api/get_actual_data/', params)
+        self.assertEqual(response.content, content)
+        etag = response['ETag']
+        self.assertEqual(etag, '"%s"' % hashlib.sha1(content).hexdigest())
+
+        # Also as changed by the gzip middleware
+        for if_none_match in (etag, 'W/' + etag, etag[:-1] + ';gzip"', '"other", ' + etag):
+            response = self.client.get('/api/get_actual_data/', params, HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual(response.status_code, 304, if_none_match)
+            self.assertEqual(response['ETag'], etag)
+        response = self.client.get('/api/get_actual_data/', params, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual((response.status_code, response.content), (200, content))
+
+        # A different selection has its own entry
+        response = self.client.get('/api/get_actual_data/', dict(params, resolution='500'))
+        self.assertTrue(response.streaming)
+
+
+class EncodeBinaryTest(TestCase):
+
+    def _decode(self, content: bytes) -> dict:
+        """
+        Unpacks the format described in `encode_binary`, into the fields of the clusters and the originals.
+        """
+        offset = 0
+
+        def read(fmt: str):
+            nonlocal offset
+            values = struct.unpack_from('<' + fmt, content, offset)
+            offset += struct.calcsize('<' + fmt)
+            return values
+
+        magic = read('4s')[0]
+        value_min, value_max, n, m, flags = read('ddIIB')
+        strings = []
+        for _ in range(read('I')[0]):
+            length = read('H')[0]
+            strings.append(read('%ds' % length)[0].decode('utf-8'))
+        decoded = dict(magic=magic, min=value_min, max=value_max, strings=strings, clusters={}, originals={})
+        for name, fmt in (('lat', 'd'), ('lon', 'd'), ('value', 'd'), ('display', 'd'), ('count', 'I')):
+            decoded['clusters'][name] = list(read('%d%s' % (n, fmt)))
+        decoded['originals']['timestamp'] = list(read('%dq' % m))
+        decoded['originals']['uuid'] = [read('16s')[0] for _ in range(m)]
+        for name, fmt in (('avg', 'f'), ('max', 'f'), ('device_name', 'I'), ('mic_source', 'I'), ('proximity', 'I')):
+            decoded['originals'][name] = list(read('%d%s' % (m, fmt)))
+        for name, flag in (('weight', 1), ('deviation', 2)):
+            if flags & flag:
+                decoded['originals'][name] = list(read('%df' % m))
+        self.assertEqual(offset, len(content))
+        return decoded
+
+    def test_encode(self):
+        originals = [
+            RecordingRow(1, '0a9d1f0e-3c4b-4d5e-8f60-718293a4b5c6', 'a', dt.datetime(2017, 3, 1, 12, 0, 1),
+                         59.9, 10.7, 40.5, 70.25, 'internal', 'NEAR'),
+            RecordingRow(2, None, 'ø', dt.datetime(2017, 3, 2), 59.91, 10.71, 45, None, 'headset', None),
+            RecordingRow(3, 'not a uuid', 'a', dt.datetime(1970, 1, 1), 59.92, 10.72, None, 80, 'internal', 'FAR'),
+        ]
+        for original, weight in zip(originals, (0.5, 0.25, 1)):
+            original.weight = weight
+        data = dict(success=True, min=2, max=3, data=[
+            dict(coordinates={'lat': 59.9, 'lon': 10.7}, value=42.75, display=2.5, original=originals[:2]),
+            dict(coordinates={'lat': 59.92, 'lon': 10.72}, value=80, original=originals[2:]),
+        ])
+
+        decoded = self._decode(encode_binary(data))
+        self.assertEqual((decoded['magic'], decoded['min'], decoded['max']), (b'NMC1', 2, 3))
+        self.assertEqual(decoded['strings'], ['a', 'ø', 'internal', 'headset', 'NEAR', 'FAR'])
+
+        clusters = decoded['clusters']
+        self.assertEqual(clusters['lat'], [59.9, 59.92])
+        self.assertEqual(clusters['lon'], [10.7, 10.72])
+        self.assertEqual(clusters['value'], [42.75, 80])
+        self.assertEqual(clusters['display'][0], 2.5)
+        self.assertTrue(math.isnan(clusters['display'][1]))
+        self.assertEqual(clusters['count'], [2, 1])
+
+        no_string = 0xFFFFFFFF
+        decoded_originals = decoded['originals']
+        self.assertEqual(decoded_originals['timestamp'], [1488369601, 1488412800, 0])
+        self.assertEqual(decoded_originals['uuid'],
+                         [uuid.UUID(originals[0].uuid).bytes, bytes(16), bytes(16)])
+        self.assertEqual(decoded_originals['avg'][:2], [40.5, 45])
+        self.assertTrue(math.isnan(decoded_originals['avg'][2]))
+        self.assertEqual(decoded_originals['max'][::2], [70.25, 80])
+        self.assertTrue(math.isnan(decoded_originals['max'][1]))
+        self.assertEqual(decoded_originals['device_name'], [0, 1, 0])
+        self.assertEqual(decoded_originals['mic_source'], [2, 3, 2])
+        self.assertEqual(decoded_originals['proximity'], [4, no_string, 5])
+        self.assertEqual(decoded_originals['weight'], [0.5, 0.25, 1])
+        self.assertNotIn('deviation', decoded_originals)
+
+    def test_empty(self):
+        decoded = self._decode(encode_binary(dict(success=True, min=-1, max=1, data=[])))
+        self.assertEqual((decoded['min'], decoded['max'], decoded['strings']), (-1, 1, []))
+        self.assertEqual(decoded['clusters']['count'], [])
+
+
+class ArchiveTest(TemporaryFilesMixin, TestCase):
+    """
+    Archiving moves the old recordings, but they are still selected, and still recognized when re-sent.
+    """
+
+    multi_db = True
+
+    PARAMS = dict(deviceNames='a', micSources='internal|headset', is_cropping='false', resolution='50',
+                  maxOrAvg='measurement_avg', layout='summary')
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        ExcludedPeriod.objects.all().delete()
+        rnd = random.Random(1)
+        # From March to May 2017
+        self.records = [make_processed_record(rnd) for _ in range(40)]
+        save_new_recordings([create_recording(record, 'a') for record in self.records], set())
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _get_uuids(self, database):
+        return set(Recording.objects.using(database).values_list('uuid', flat=True))
+
+    def _get_selected_count(self, **params):
+        response_cache.clear()
+        response = self.client.get('/api/get_actual_data/', dict(self.PARAMS, **params))
+        self.assertEqual(response.status_code, 200)
+        clusters = json.loads(b''.join(response.streaming_content).decode('utf-8'))['data']
+        return sum(cluster['count'] for cluster in clusters)
+
+    @mock.patch.object(ArchivedMonth, 'CHUNK_SIZE', 3)
+    def test_archive_before(self):
+        archive = settings.RECORDING_ARCHIVE_DATABASE
+        old = {r['uuid'] for r in self.records if r['timestamp'] < '2017-04-01'}
+        self.assertTrue(0 < len(old) < len(self.records))
+        pks = dict(Recording.objects.values_list('uuid', 'pk'))
+
+        self.assertEqual(ArchivedMonth.get_databases(None), ['default'])
+        self.assertEqual(ArchivedMonth.archive_before(dt.date(2017, 4, 1)), len(old))
+        self.assertEqual(self._get_uuids(archive), old)
+        self.assertEqual(self._get_uuids('default'), {r['uuid'] for r in self.records} - old)
+        self.assertEqual(dict(Recording.objects.using(archive).values_list('uuid', 'pk')),
+                         {uuid: pk for uuid, pk in pks.items() if uuid in old})
+        self.assertEqual(list(ArchivedMonth.objects.values_list('month', 'recording_count')),
+                         [(dt.date(2017, 3, 1), len(old))])
+        # Nothing left to move
+        self.assertEqual(ArchivedMonth.archive_before(dt.date(2017, 4, 1)), 0)
+
+        self.assertEqual(ArchivedMonth.get_boundary(), dt.datetime(2017, 4, 1))
+        self.assertEqual(ArchivedMonth.get_databases(None), ['default', archive])
+        self.assertEqual(ArchivedMonth.get_databases(dt.datetime(2017, 3, 31)), ['default', archive])
+        self.assertEqual(ArchivedMonth.get_databases(dt.datetime(2017, 4, 1)), ['default'])
+
+        # Still selected, from the archive only if the selection begins before the boundary
+        self.assertEqual(self._get_selected_count(), len(self.records))
+        self.assertEqual(self._get_selected_count(**{'from': '2017-03-15'}),
+                         len([r for r in self.records if r['timestamp'] >= '2017-03-15']))
+        self.assertEqual(self._get_selected_count(**{'to': '2017-04-01'}), len(old))
+
+        # Re-sent, they are not saved again
+        recordings = [create_recording(record, 'a') for record in self.records]
+        self.assertEqual(ArchivedMonth.get_archived_uuids(recordings), old)
+        self.assertEqual(save_new_recordings(recordings, set()), 0)
+        self.assertEqual(Recording.objects.count() + Recording.objects.using(archive).count(), len(self.records))
+
+
+class TimeFilterTest(TemporaryFilesMixin, TestCase):
+    """
+    The selected recordings are the same as those found by going through all of them in Python.
+    """
+
+    def setUp(self):
+        super(TimeFilterTest, self).setUp()
+        ExcludedPeriod.objects.all().delete()
+        rnd = random.Random(1)
+        recordings = []
+        for device_name in ('a', 'b'):
+            for _ in range(300):
+                recording = create_recording(make_processed_record(rnd), device_name)
+                recording.mic_source = 'internal'
+                recordings.append(recording)
+        save_new_recordings(recordings, set())
+        self.recordings = list(Recording.objects.all())
+
+    def _select(self, **params) -> set:
+        request = RequestFactory().get('/', dict(dict(deviceNames='a|b', micSources='internal', is_cropping='false'),
+                                                 **params))
+        queryset = Recording.objects.filter(**_build_filters(request)).exclude(_build_excludes(request))
+        return set(queryset.values_list('pk', flat=True))
+
+    def _expect(self, condition) -> set:
+        periods = list(ExcludedPeriod.objects.all())
+        return {r.pk for r in self.recordings
+                if condition(r) and not any(period.contains(r) for period in periods)}
+
+    def _assert_selections(self):
+        selections = (
+            (dict(), lambda r: True),
+            ({'from': '2017-04-10'}, lambda r: r.timestamp >= dt.datetime(2017, 4, 10)),
+            ({'from': '2017-04-10 12:30:00', 'to': '2017-05-01'},
+             lambda r: dt.datetime(2017, 4, 10, 12, 30) <= r.timestamp < dt.datetime(2017, 5, 1)),
+            ({'to': '2017-03-20T06:00:00'}, lambda r: r.timestamp < dt.datetime(2017, 3, 20, 6)),
+            (dict(hours='0|7|23'), lambda r: r.timestamp.hour in (0, 7, 23)),
+            (dict(weekdays='1|7'), lambda r: r.timestamp.isoweekday() in (1, 7)),
+            (dict(hours='12|13', weekdays='3', deviceNames='b'),
+             lambda r: r.timestamp.hour in (12, 13) and r.timestamp.isoweekday() == 3 and r.device_name == 'b'),
+        )
+        for params, condition in selections:
+            expected = self._expect(condition)
+            self.assertTrue(expected, params)
+            self.assertEqual(self._select(**params), expected, params)
+
+    def test_time_filters(self):
+        self._assert_selections()
+
+    def test_excluded_periods(self):
+        ExcludedPeriod.objects.create(end=dt.datetime(2017, 3, 10))
+        ExcludedPeriod.objects.create(end=dt.datetime(2017, 3, 20), device_name='a')
+        ExcludedPeriod.objects.create(start=dt.datetime(2017, 4, 1), end=dt.datetime(2017, 4, 15))
+        ExcludedPeriod.objects.create(start=dt.datetime(2017, 5, 1), end=dt.datetime(2017, 5, 8), device_name='b')
+        self._assert_selections()
+
+        # Only the periods that overlap the selection are in the query
+        self.assertFalse(ExcludedPeriod.get_excludes(dt.datetime(2017, 5, 8), None))
+        self.assertFalse(ExcludedPeriod.get_excludes(dt.datetime(2017, 3, 20), dt.datetime(2017, 4, 1)))
+        self.assertTrue(ExcludedPeriod.get_excludes(None, dt.datetime(2017, 3, 12)))
+
+        self.assertEqual({r.pk for r in ExcludedPeriod.exclude_from(self.recordings)}, self._expect(lambda r: True))
+
+
+class CellAggregationTest(TemporaryFilesMixin, TestCase):
+    """
+    The cells aggregated in the database are the same as those of grouping the recordings in Python.
+    """
+
+    multi_db = True
+
+    def setUp(self):
+        super(CellAggregationTest, self).setUp()
+        ExcludedPeriod.objects.all().delete()
+        rnd = random.Random(1)
+        recordings = [create_recording(make_processed_record(rnd, spread=0.05), 'a') for _ in range(300)]
+        recordings[0].measurement_avg = None
+        recordings[1].geohash = None
+        save_new_recordings(recordings, set())
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _get_cells(self, **params) -> list:
+        response_cache.clear()
+        response = self.client.get('/api/get_actual_data/', dict(dict(
+            deviceNames='a', micSources='internal|headset', is_cropping='false', resolution='100',
+            maxOrAvg='measurement_avg', aggregation='cells'), **params))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))['data']
+
+    def _expect_cells(self, precision: int, measurement: str) -> dict:
+        recordings = list(Recording.objects.all()) + \
+            list(Recording.objects.using(settings.RECORDING_ARCHIVE_DATABASE).all())
+        cells = {}
+        for recording in recordings:
+            value = getattr(recording, measurement)
+            if recording.geohash is None or value is None:
+                continue
+            cells.setdefault(recording.geohash[:precision], []).append((recording, value))
+        return cells
+
+    def _assert_cells(self, precision: int, measurement: str):
+        cells = self._get_cells(cellPrecision=str(precision), maxOrAvg=measurement)
+        expected = self._expect_cells(precision, measurement)
+        self.assertGreater(len(expected), 1)
+        self.assertEqual([cell['id'] for cell in cells], sorted(expected))
+        for cell in cells:
+            members = expected[cell['id']]
+            values = [value for _, value in members]
+            self.assertEqual(cell['count'], len(members))
+            self.assertAlmostEqual(cell['sum'], sum(values))
+            self.assertAlmostEqual(cell['value'], sum(values) / len(values))
+            self.assertEqual((cell['min'], cell['max']), (min(values), max(values)))
+            self.assertAlmostEqual(cell['coordinates']['lat'], sum(r.lat for r, _ in members) / len(members))
+            self.assertAlmostEqual(cell['coordinates']['lon'], sum(r.lon for r, _ in members) / len(members))
+            self.assertTrue(2 <= cell['display'] <= 3)
+        self.assertEqual(sum(cell['count'] for cell in cells), 298 if measurement == 'measurement_avg' else 299)
+
+    def test_cells(self):
+        for precision in (5, 6):
+            for measurement in ('measurement_avg', 'measurement_max'):
+                self._assert_cells(precision, measurement)
+
+    def test_cells_with_archive(self):
+        self.assertGreater(ArchivedMonth.archive_before(dt.date(2017, 4, 1)), 0)
+        self._assert_cells(6, 'measurement_avg')
+
+
+@override_settings(ADMISSION_CONTROL_ENABLED=True, ADMISSION_DEVICE_RATE=0.1, ADMISSION_DEVICE_BURST=2,
+                   ADMISSION_MAX_IN_FLIGHT=1)
+class AdmissionControlTest(TemporaryFilesMixin, TestCase):
+
+    def setUp(self):
+        super(AdmissionControlTest, self).setUp()
+        self.rnd = random.Random(1)
+        self.client = make_api_client()
+
+    def _upload(self):
+        return self.client.post('/api/upload_recording_batch/', json.dumps([make_processed_record(self.rnd)]),
+                                content_type='application/json')
+
+    def test_fails_open(self):
+        for method in ('admit', 'release'):
+            with mock.patch.object(admission_controller, method, side_effect=sqlite3.OperationalError('locked')), \
+                    self.assertLogs(level='ERROR'):
+                self.assertEqual(self._upload().status_code, 200, method)
+
+    def test_device_token_bucket(self):
+        self.assertEqual(self._upload().status_code, 200)
+        self.assertEqual(self._upload().status_code, 200)
+        response = self._upload()
+        self.assertEqual(response.status_code, 429)
+        # One token per 10 seconds
+        self.assertEqual(response['Retry-After'], '10')
+
+        # Other devices have their own
+        self.client.defaults['HTTP_X_NOISEMAPPER_API_DEVICE_NAME'] = 'b3RoZXI='
+        self.assertEqual(self._upload().status_code, 200)
+
+    def test_in_flight_cap(self):
+        held = admission_controller.admit('other')
+        response = self._upload()
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(5 <= int(response['Retry-After']) <= 10)
+
+        admission_controller.release(held.slot)
+        self.assertEqual(self._upload().status_code, 200)
+
+    def _hold_slot(self, **columns):
+        slot = admission_controller.admit('other').slot
+        for column, value in columns.items():
+            admission_controller._get_connection().execute('UPDATE slot SET %s = ? WHERE id = ?' % column,
+                                                           (value, slot))
+
+    def test_expired_slot(self):
+        self._hold_slot(acquired_at=0)
+        self.assertEqual(self._upload().status_code, 200)
+
+    def test_slot_of_finished_process(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        self._hold_slot(pid=process.pid)
+        self.assertEqual(self._upload().status_code, 200)
+
+    def test_slot_of_running_process(self):
+        self._hold_slot(pid=os.getppid())
+        self.assertEqual(self._upload().status_code, 503)
+
+
+class MetricsTest(TemporaryFilesMixin, TestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        # Flushed by the tests themselves
+        patcher = mock.patch.object(MetricsRegistry, '_start_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = MetricsRegistry()
+
+    def _samples(self, name):
+        return [line for line in self.registry.render().splitlines() if line.startswith(name)]
+
+    def test_render(self):
+        for value in (0.004, 0.2, 0.2, 60):
+            self.registry.observe('noisemapper_request_duration_seconds', value, view='a"b\\c\nd')
+        self.registry.inc('noisemapper_requests_total', view='x', status=200)
+        self.registry.flush()
+        self.registry.inc('noisemapper_requests_total', 2, view='x', status=200)
+        self.registry.flush()
+
+        self.assertEqual(self._samples('noisemapper_requests_total'),
+                         ['noisemapper_requests_total{status="200",view="x"} 3'])
+        labels = 'view="a\\"b\\\\c\\nd"'
+        samples = self._samples('noisemapper_request_duration_seconds')
+        # Cumulative, in the order of the bounds, with +Inf last
+        self.assertEqual(samples[:3], ['noisemapper_request_duration_seconds_bucket{%s,le="0.005"} 1' % labels,
+                                       'noisemapper_request_duration_seconds_bucket{%s,le="0.01"} 1' % labels,
+                                       'noisemapper_request_duration_seconds_bucket{%s,le="0.025"} 1' % labels])
+        self.assertIn('noisemapper_request_duration_seconds_bucket{%s,le="0.25"} 3' % labels, samples)
+        self.assertEqual(samples[-4:], ['noisemapper_request_duration_seconds_bucket{%s,le="30.0"} 3' % labels,
+                                        'noisemapper_request_duration_seconds_bucket{%s,le="+Inf"} 4' % labels,
+                                        'noisemapper_request_duration_seconds_sum{%s} 60.404' % labels,
+                                        'noisemapper_request_duration_seconds_count{%s} 4' % labels])
+
+    def test_failed_flush(self):
+        self.registry.inc('noisemapper_requests_total', view='x', status=200)
+        self.registry.set('noisemapper_ingest_queue_records', 5)
+        with mock.patch.object(self.registry, '_get_connection', side_effect=sqlite3.OperationalError('locked')), \
+                self.assertLogs(level='ERROR'):
+            self.registry.flush()
+        self.registry.inc('noisemapper_requests_total', view='x', status=200)
+        self.registry.set('noisemapper_ingest_queue_records', 7)
+        self.registry.flush()
+
+        self.assertEqual(self._samples('noisemapper_requests_total'),
+                         ['noisemapper_requests_total{status="200",view="x"} 2'])
+        self.assertEqual(self._samples('noisemapper_ingest_queue_records'), ['noisemapper_ingest_queue_records 7'])
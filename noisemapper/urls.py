@@ -7,12 +7,17 @@ urlpatterns = [
     url(r'^$', views.index, name='index'),
 
     url(r'^api/upload_recording/$', views.api_upload_recording, name='api_upload_recording'),
-    url(r'^api/upload_recording_batch/$', views.api_upload_recording_batch, name='api_upload_recording'),
+    url(r'^api/upload_recording_batch/$', views.api_upload_recording_batch,
+        name='api_upload_recording_batch'),
     url(r'^api/get_actual_data/$', views.api_get_actual_data, name='api_get_actual_data'),
     url(r'^api/get_deviation_data/$', views.api_get_deviation_from_average_data, name='api_get_deviation_data'),
+    url(r'^api/get_cluster_originals/$', views.api_get_cluster_originals, name='api_get_cluster_originals'),
+    url(r'^api/tiles/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)/$', views.api_get_tile, name='api_get_tile'),
 
     url(r'^api/download/$', views.download_selection, name='api_download'),
 
+    url(r'^api/metrics/$', views.api_metrics, name='api_metrics'),
+
     url(r'^api/manual', views.api_manual),
     url(r'^api/echo', views.api_echo),
 
@@ -1,18 +1,27 @@
 import base64
+import codecs
+import cProfile
 import datetime as dt
 import decimal as dec
 import json
 import logging
-from collections import OrderedDict
+import math
+import os
+import re
+import time
 from functools import wraps
-from typing import Callable, Iterable, Any, T, Tuple, List, Optional
+from typing import Callable, Iterable, Iterator, Any, T, Tuple, List, Optional, BinaryIO, Union
 
 import gpxpy.geo
+import numpy as np
 from django.conf import settings
 from django.http.response import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from noisemapper.models.recording import Recording
+from noisemapper.instrumentation import RequestStats, start_request_stats
+from noisemapper.metrics import metrics
+from noisemapper.models.recording import Recording, RecordingRow
+from noisemapper.serialization import format_timestamp
 
 __all__ = ('sjs',)
 
@@ -90,23 +99,165 @@ def api_protect(function=None):
     return csrf_exempt(decorator)
 
 
+def iter_json_array(stream: BinaryIO, chunk_size=64 * 1024) -> Iterator[Any]:
+    """
+    Parses a JSON array read from ``stream`` (e.g. the request), and yields its elements one by one,
+    so only the current element has to be in memory, not the whole document.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + text_decoder.decode(chunk, final=eof)
+        pos = 0
+
+    def next_char() -> Optional[str]:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                return None
+            read_more()
+
+    if next_char() != '[':
+        raise ValueError('Expected a JSON array')
+    pos += 1
+
+    if next_char() == ']':
+        return
+    while True:
+        next_char()
+        # A failed attempt is only retried when the buffer has doubled, so big elements aren't parsed too many times
+        min_size = 0
+        while True:
+            while len(buffer) - pos < min_size and not eof:
+                read_more()
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # A number at the end of the buffer may continue in the next chunk
+                number_may_continue = (isinstance(element, (int, float)) and not isinstance(element, bool)
+                                       and (end == len(buffer) or buffer[end] in '0123456789.eE+-'))
+                if eof or not number_may_continue:
+                    break
+            min_size = 2 * (len(buffer) - pos)
+        pos = end
+        yield element
+
+        separator = next_char()
+        pos += 1
+        if separator == ']':
+            break
+        if separator != ',':
+            raise ValueError('Expected , or ] after an array element, got %r' % separator)
+
+
 class RequestLoggerMiddleware(object):
+    """
+    Logs every request with its statistics (see :class:`RequestStats`): the wall time, the number and time of
+    the SQL queries, the rows they returned, and the time of the instrumented sections (e.g. ``cluster`` and
+    ``serialize``), as one JSON line. The same go into a ``Server-Timing`` header (in milliseconds),
+    so they show up in the network panel of the browser.
+
+    A streamed body is produced after the headers are sent, so its time (``stream``) is only in the log line,
+    which is written when the stream ends.
+    The time and the size of the response also go into the per-view histograms of :data:`metrics`.
+    If ``settings.REQUEST_PROFILE_THRESHOLD`` is set, the requests that take longer are profiled, and the stats
+    are dumped into ``settings.REQUEST_PROFILE_DIR``, to be read with ``pstats`` or snakeviz.
+    """
+
     def __init__(self, get_response):
         self.get_response = get_response
-        # One-time configuration and initialization.
 
     def __call__(self, request):
-        # Code to be executed for each request before
-        # the view (and later middleware) are called.
+        stats = start_request_stats()
+        profiler = cProfile.Profile() if settings.REQUEST_PROFILE_THRESHOLD > 0 else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+        elapsed = stats.get_elapsed()
+        if profiler is not None and elapsed >= settings.REQUEST_PROFILE_THRESHOLD:
+            _dump_profile(profiler, request)
+
+        response['Server-Timing'] = ', '.join(
+            ['db;dur=%.1f;desc="%d queries, %d rows"' % (stats.sql_time * 1000, stats.sql_count, stats.sql_rows)]
+            + ['%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in sorted(stats.timings.items())]
+            + ['total;dur=%.1f' % (elapsed * 1000)]
+        )
+        if response.streaming:
+            response.streaming_content = _log_after_stream(request, response, stats, response.streaming_content)
+        else:
+            _log_request(request, response, stats, len(response.content))
+        return response
 
-        logging.info("Processing request to %s" % request.path_info)
 
-        response = self.get_response(request)
+def _log_after_stream(request, response, stats: RequestStats, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    chunks = iter(chunks)
+    size = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        finally:
+            stats.add_timing('stream', time.perf_counter() - start)
+        size += len(chunk)
+        yield chunk
+    _log_request(request, response, stats, size)
 
-        # Code to be executed for each request/response after
-        # the view is called.
 
-        return response
+def _log_request(request, response, stats: RequestStats, size: int) -> None:
+    logging.info('Request %s' % json.dumps(dict(
+        method=request.method,
+        path=request.path_info,
+        status=response.status_code,
+        total=round(stats.get_elapsed(), 4),
+        sql_count=stats.sql_count,
+        sql_time=round(stats.sql_time, 4),
+        sql_rows=stats.sql_rows,
+        **{name: round(seconds, 4) for name, seconds in stats.timings.items()}
+    ), sort_keys=True))
+
+    view = _get_view_name(request)
+    metrics.inc('noisemapper_requests_total', view=view, status=response.status_code)
+    metrics.observe('noisemapper_request_duration_seconds', stats.get_elapsed(), view=view)
+    metrics.observe('noisemapper_response_size_bytes', size, view=view)
+
+
+def _get_view_name(request) -> str:
+    # The URL name, so the number of label values is bounded (unlike with the paths)
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.url_name or match.view_name
+
+
+def _dump_profile(profiler: cProfile.Profile, request) -> None:
+    os.makedirs(settings.REQUEST_PROFILE_DIR, exist_ok=True)
+    filename = '%s-%s.prof' % (dt.datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                               re.sub(r'[^A-Za-z0-9]+', '_', request.path_info).strip('_'))
+    profiler.dump_stats(os.path.join(settings.REQUEST_PROFILE_DIR, filename))
+
+
+EARTH_RADIUS = gpxpy.geo.EARTH_RADIUS  # In meters
 
 
 class Aggregator(object):
@@ -114,6 +265,11 @@ class Aggregator(object):
     def __call__(self, new):
         raise NotImplementedError
 
+    def extend(self, new_values: Iterable) -> 'Aggregator':
+        for new in new_values:
+            self(new)
+        return self
+
     def get(self) -> Tuple[Any, float, Optional[List[dict]]]:
         raise NotImplementedError
 
@@ -130,11 +286,58 @@ def cluster_data(data: Iterable[T], key_func: Callable[[T], Any], is_same_func:
                 break
         clustered.setdefault(key, []).append(datapoint)
 
+    return aggregate_clusters(clustered, aggregator_factory, retain_original)
+
+
+def grid_cluster_data(data: Iterable[T], key_func: Callable[[T], Tuple[float, float]], resolution: Optional[dec.Decimal],
+                      aggregator_factory: Callable[[], Aggregator], retain_original=False):
+    """
+    Same as :func:`cluster_data` with "closer than ``resolution`` meters" as ``is_same_func``, but the cluster
+    seeds are kept in a :class:`SpatialGrid`, so each point is only compared with the seeds in the neighbouring
+    cells, instead of with every cluster found so far.
+
+    A point still joins the oldest cluster whose seed is in range, so the clusters (and their order) are the
+    same as what :func:`cluster_data` gives.
+    If ``resolution`` is not a positive number, only points with exactly the same key are merged.
+    """
+    clustered = grid_group_data(data, key_func, resolution)
+    return aggregate_clusters(clustered, aggregator_factory, retain_original)
+
+
+def grid_group_data(data: Iterable[T], key_func: Callable[[T], Tuple[float, float]],
+                    resolution: Optional[dec.Decimal]) -> dict:
+    """
+    The grouping step of :func:`grid_cluster_data`, without aggregating the clusters:
+    returns the points of each cluster, keyed by the key of its first point.
+    """
+    clustered = {}
+
+    if resolution is None or not resolution > 0:
+        for datapoint in data:
+            clustered.setdefault(key_func(datapoint), []).append(datapoint)
+        return clustered
+
+    grid = SpatialGrid(float(resolution))
+    for datapoint in data:
+        key = key_func(datapoint)
+        best_order = best_key = None
+        for order, existing_key in grid.nearby(key):
+            if (best_order is None or order < best_order) and distance(existing_key, key) < resolution:
+                best_order, best_key = order, existing_key
+        if best_key is None:
+            grid.add(key)
+        else:
+            key = best_key
+        clustered.setdefault(key, []).append(datapoint)
+
+    return clustered
+
+
+def aggregate_clusters(clustered: dict, aggregator_factory: Callable[[], Aggregator], retain_original: bool):
     clustered_2 = dict()
     for key, values in clustered.items():
         aggregator = aggregator_factory()  # Create a new one for each cluster
-        for x in values:
-            aggregator(x)
+        aggregator.extend(values)
 
         new_key, new_value, extra_attrs = aggregator.get()
         if not new_key:
@@ -152,11 +355,117 @@ def cluster_data(data: Iterable[T], key_func: Callable[[T], Any], is_same_func:
     return clustered_2
 
 
+class SpatialGrid(object):
+    """
+    Buckets (lat, lon) points into cells that are ``resolution`` meters high (and the same number of degrees wide),
+    and answers "which points may be closer than ``resolution`` to this one" by looking at the neighbouring cells only.
+
+    The longitude span to look at grows towards the poles (and wraps around the antimeridian), so no point in range
+    is ever missed; the caller still has to check the exact distance of the candidates.
+    Each added point gets an increasing order number, so the caller can tell which one was added first.
+    """
+
+    # Makes the search window slightly larger than needed, so rounding errors can't hide a point in range
+    PADDING = 1.0001
+
+    def __init__(self, resolution: float):
+        self.angle = min(resolution / EARTH_RADIUS, math.pi)  # In radians
+        self.cell_size = math.degrees(self.angle) * self.PADDING  # In degrees
+        self.rows = {}  # row index -> {column index -> [(order, point)]}
+        self.count = 0
+
+    def _index(self, degrees: float) -> int:
+        return int(math.floor(degrees / self.cell_size))
+
+    def add(self, point: Tuple[float, float]) -> None:
+        lat, lon = point
+        self.rows.setdefault(self._index(lat), {}).setdefault(self._index(lon), []).append((self.count, point))
+        self.count += 1
+
+    def nearby(self, point: Tuple[float, float]) -> Iterable[Tuple[int, Tuple[float, float]]]:
+        lat, lon = point
+        lon_span = self.lon_span(lat)
+        for row_index in range(self._index(lat - self.cell_size), self._index(lat + self.cell_size) + 1):
+            row = self.rows.get(row_index)
+            if not row:
+                continue
+            if lon_span is None:
+                for cell in row.values():
+                    yield from cell
+                continue
+            for lon_from, lon_to in self._lon_ranges(lon - lon_span, lon + lon_span):
+                for column_index in range(self._index(lon_from), self._index(lon_to) + 1):
+                    yield from row.get(column_index, ())
+
+    def lon_span(self, lat: float) -> Optional[float]:
+        """
+        The largest longitude difference (in degrees) that can still be in range from a point at ``lat``,
+        or None if every longitude can.
+        From the haversine formula: hav(d) >= cos(lat_1) * cos(lat_2) * hav(d_lon).
+        """
+        lat = math.radians(abs(lat))
+        farthest_lat = lat + self.angle
+        if farthest_lat >= math.pi / 2:
+            return None
+        ratio = math.sin(self.angle / 2) ** 2 / (math.cos(lat) * math.cos(farthest_lat))
+        if ratio >= 1:
+            return None
+        span = math.degrees(2 * math.asin(math.sqrt(ratio))) * self.PADDING
+        return span if span < 180 else None
+
+    @staticmethod
+    def _lon_ranges(lon_from: float, lon_to: float) -> List[Tuple[float, float]]:
+        ranges = [(max(lon_from, -180), min(lon_to, 180))]
+        if lon_from < -180:
+            ranges.append((lon_from + 360, 180))
+        if lon_to > 180:
+            ranges.append((-180, lon_to - 360))
+        return ranges
+
+
 def distance(point_a: Tuple[float, float], point_b: Tuple[float, float]) -> float:
     dist_m = gpxpy.geo.haversine_distance(point_a[0], point_a[1], point_b[0], point_b[1])
     return dist_m
 
 
+_GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_encode(lat: float, lon: float, precision: int) -> str:
+    """
+    The geohash of the cell (of ``precision`` characters) that contains the point. Its prefixes are the cells
+    of the lower precisions that contain it.
+    """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    characters = []
+    bits = bit_count = 0
+    is_lon = True
+    while len(characters) < precision:
+        value, value_range = (lon, lon_range) if is_lon else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        is_lon = not is_lon
+        bit_count += 1
+        if bit_count == 5:
+            characters.append(_GEOHASH_ALPHABET[bits])
+            bits = bit_count = 0
+    return ''.join(characters)
+
+
+def geohash_cell_height(precision: int) -> float:
+    """
+    The north-south size of the geohash cells of ``precision`` characters, in meters.
+    At the equator, they are about as wide for odd precisions, and twice as wide for even ones.
+    """
+    lat_bits = precision * 5 // 2
+    return math.radians(180 / 2 ** lat_bits) * EARTH_RADIUS
+
+
 class Averager(Aggregator):
 
     def __init__(self, extractor):
@@ -215,7 +524,46 @@ class GeoWeightedMiddle(Aggregator):
         return geo_mid, avg_value, [{'weight': weight} for weight in weights]
 
 
-def recording_to_json(recording: Recording) -> dict:
+def haversine_distances(lats: np.ndarray, lons: np.ndarray, point: Tuple[float, float]) -> np.ndarray:
+    """
+    Batched version of :func:`distance`: the distances (in meters) of every (lats[i], lons[i]) from ``point``.
+    """
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    lat_0, lon_0 = math.radians(point[0]), math.radians(point[1])
+
+    a = np.sin((lats - lat_0) / 2) ** 2 + np.sin((lons - lon_0) / 2) ** 2 * np.cos(lats) * math.cos(lat_0)
+    return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+class VectorGeoWeightedMiddle(GeoWeightedMiddle):
+    """
+    Same as :class:`GeoWeightedMiddle`, but does the math on NumPy arrays of the whole cluster at once,
+    instead of one recording at a time.
+    """
+
+    def extend(self, new_values: Iterable) -> 'VectorGeoWeightedMiddle':
+        for new in new_values:
+            lat, lon, value = self.extractor(new)
+            self.locations.append((lat, lon))
+            self.values.append(value)
+        return self
+
+    def get(self):
+        locations = np.array(self.locations, dtype=float)
+        values = np.array(self.values, dtype=float)
+        lats, lons = locations[:, 0], locations[:, 1]
+
+        geo_mid = (float(lats.mean()), float(lons.mean()))
+
+        dist = haversine_distances(lats, lons, geo_mid)
+        dist[dist == 0] = 1
+        weights = 1 / dist
+        avg_value = float(np.dot(values, weights) / weights.sum())
+        return geo_mid, avg_value, [{'weight': weight} for weight in weights.tolist()]
+
+
+def recording_to_json(recording: Union[Recording, RecordingRow]) -> dict:
     ret = dict(
         uuid=recording.uuid,
         lat=recording.lat,
@@ -224,7 +572,7 @@ def recording_to_json(recording: Recording) -> dict:
         max=recording.measurement_max,
         device_name=recording.device_name,
         timestamp=recording.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-        proximity=json.loads(recording.device_state).get('proximityText', ''),
+        proximity=recording.proximity,
     )
 
     if hasattr(recording, 'weight'):
@@ -236,15 +584,16 @@ def recording_to_json(recording: Recording) -> dict:
     return ret
 
 
-def recording_to_json2(recording: Recording) -> dict:
-    ret = OrderedDict()
-    ret.update(timestamp=recording.timestamp.strftime('%Y-%m-%d %H:%M:%S'))
-    ret.update(uuid=recording.uuid)
-    ret.update(avg=recording.measurement_avg)
-    ret.update(max=recording.measurement_max)
-    ret.update(device_name=recording.device_name)
-    ret.update(mic_source=recording.mic_source)
-    ret.update(proximity=json.loads(recording.device_state).get('proximityText', ''))
+def recording_to_json2(recording: Union[Recording, RecordingRow]) -> dict:
+    ret = dict(
+        timestamp=format_timestamp(recording.timestamp),
+        uuid=recording.uuid,
+        avg=recording.measurement_avg,
+        max=recording.measurement_max,
+        device_name=recording.device_name,
+        mic_source=recording.mic_source,
+        proximity=recording.proximity,
+    )
 
     if hasattr(recording, 'weight'):
         ret.update(weight=getattr(recording, 'weight'))
@@ -1,39 +1,77 @@
 import base64
 import datetime
-import datetime as dt
 import decimal as dec
+import hashlib
+import heapq
+import hmac
 import logging
 import os
-import shutil
-import tempfile
+import re
+from array import array
+from concurrent.futures import Future
+from functools import wraps
 from json import loads, dumps
+from typing import Callable, Iterator, Optional, List, Set, Tuple
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.db.models import Avg
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, QuerySet, Sum
+from django.db.models.functions import Substr
 from django.http.request import HttpRequest
-from django.http.response import HttpResponseNotAllowed, HttpResponse, JsonResponse
-
-from noisemapper.models.recording import Recording, MIC_SOURCE_CHOICES
-from noisemapper.utils import sjs, api_protect, cluster_data, distance, GeoWeightedMiddle, \
-    recording_to_json2
+from django.http.response import HttpResponseNotAllowed, HttpResponse, StreamingHttpResponse, \
+    FileResponse, Http404
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.vary import vary_on_headers
+
+from noisemapper.admission import admission_control
+from noisemapper.ingest import create_recording, save_new_recordings, get_saved_uuids, ingest_queue, \
+    UPLOAD_CHUNK_SIZE
+from noisemapper.instrumentation import timing
+from noisemapper.metrics import metrics
+from noisemapper.models.archive import ArchivedMonth
+from noisemapper.models.recording import Recording, RecordingRow, RecordingGroupTotals, GEOHASH_PRECISION
+from noisemapper.models.tiles import MapTile
+from noisemapper.models.clusters import RecordingCluster
+from noisemapper.models.periods import ExcludedPeriod
+from noisemapper.parallel_clustering import parallel_clusterer
+from noisemapper.permissions import can_view_metrics
+from noisemapper.response_cache import cache_response, response_cache
+from noisemapper.serialization import recordings_to_columns, iter_json, encode_binary, BINARY_CONTENT_TYPE
+from noisemapper.snippet_storage import snippet_writer, find_snippet, iter_concatenated
+from noisemapper.utils import sjs, api_protect, aggregate_clusters, VectorGeoWeightedMiddle, recording_to_json2, \
+    iter_json_array, geohash_cell_height
 
 __all__ = ('api_upload_recording', 'api_upload_recording_batch',
-           'api_get_actual_data', 'api_get_deviation_from_average_data',
-           'download_selection',
+           'api_get_actual_data', 'api_get_deviation_from_average_data', 'api_get_cluster_originals', 'api_get_tile',
+           'download_selection', 'api_metrics',
            'api_manual', 'api_echo')
 
 
+def _get_device_name(request: HttpRequest) -> str:
+    device_name = request.META.get('HTTP_X_NOISEMAPPER_API_DEVICE_NAME', '')
+    if device_name:
+        device_name = base64.b64decode(device_name).decode('utf-8')
+
+    return device_name
+
+
 @api_protect
+@admission_control(_get_device_name)
 def api_upload_recording(request):
     device_name = _get_device_name(request)
 
     if request.method == 'POST':
         data = loads(request.body.decode("utf-8"))
 
-        recording = _create_recording(data)
-        recording.device_name = device_name
-        recording.save()
+        recording = create_recording(data, device_name)
+        # Saved right away, even if the batches are queued: the response has the id of the recording
+        with transaction.atomic():
+            if not save_new_recordings([recording], set()) and recording.uuid:
+                # Sent before; the client gets the id it didn't receive then
+                recording.pk = Recording.objects.filter(uuid=recording.uuid).values_list('pk', flat=True).first()
+        metrics.inc('noisemapper_records_received_total', view='api_upload_recording')
 
         response = dict(
             success=True,
@@ -44,74 +82,57 @@ def api_upload_recording(request):
         return HttpResponseNotAllowed(['POST'])
 
 
-def _create_recording(json_data) -> Recording:
-    location = json_data['state']['location']
-
-    recording = Recording()
-
-    if 'uuid' in json_data:
-        recording.uuid = json_data['uuid']
-
-    recording.timestamp = dt.datetime.strptime(json_data['timestamp'], '%Y-%m-%d %H:%M:%S')
-
-    process_result = json_data['processResult']
-    recording.process_result = dumps(process_result, default=sjs)
-    recording.measurement_avg = process_result.get('avg', None)
-    recording.measurement_max = process_result.get('max', None)
-
-    device_state = json_data['state']
-    recording.device_state = dumps(device_state, default=sjs)
-    recording.mic_source = device_state.get('micSource', MIC_SOURCE_CHOICES[0][0]).lower()
-
-    recording.lat = float(location['lat'])
-    recording.lon = float(location['lon'])
-    return recording
-
-
-def _get_device_name(request: HttpRequest) -> str:
-    device_name = request.META.get('HTTP_X_NOISEMAPPER_API_DEVICE_NAME', '')
-    if device_name:
-        device_name = base64.b64decode(device_name).decode('utf-8')
-
-    return device_name
-
-
-def _make_is_same(resolution):
+def _parse_resolution(resolution) -> Optional[dec.Decimal]:
     try:
         resolution = dec.Decimal(resolution)
     except:
-        resolution = False
-    if resolution:
-        return lambda a, b: distance(a, b) < resolution
-    else:
-        return lambda a, b: False
+        return None
+    if resolution.is_nan():
+        return None
+    return resolution
 
 
 @api_protect
+@admission_control(_get_device_name)
 def api_upload_recording_batch(request):
     device_name = _get_device_name(request)
 
     if request.method == 'POST':
-        data = loads(request.body.decode("utf-8"))
-        logging.info("Received %d ProcessedRecords" % len(data))
-
         uuids_processed = []
-        for processed_record in data:
-            recording = _create_recording(processed_record)
-            recording.device_name = device_name
-            recording.save()
-
-            if 'file' in processed_record:
-                try:
-                    full_filename = settings.FILENAME_PATTERN % recording.uuid
-                    full_filename = os.path.join(settings.SNIPPET_STORAGE_DIR, full_filename)
-                    with open(full_filename, "wb") as fh:
-                        fh.write(base64.b64decode(processed_record['file']))
-                except:
-                    logging.exception("Couldn't decode or save the uploaded file for %s" % recording.uuid)
-
-            uuids_processed.append(recording.uuid)
-
+        records = []
+        recordings = []
+        snippets = []  # (uuid, future of the temporary file), see `SnippetWriter`
+        try:
+            # Parse the body record by record, so only one snippet is in memory at a time
+            for processed_record in iter_json_array(request):
+                # Validates the record before it is accepted
+                recording = create_recording(processed_record, device_name)
+
+                if 'file' in processed_record:
+                    snippets.append((recording.uuid, snippet_writer.submit(recording.uuid,
+                                                                           processed_record.pop('file'))))
+
+                uuids_processed.append(recording.uuid)
+                records.append(processed_record)
+                recordings.append(recording)
+        except:
+            _discard_snippets(_wait_for_snippets(snippets) or [])
+            raise
+
+        written = _wait_for_snippets(snippets)
+        if written is None:
+            # None of the batch is saved, so the client sends it again
+            return HttpResponse(status=500, content="Couldn't save the files")
+        try:
+            saved_uuids = _save_records(device_name, records, recordings)
+        except:
+            _discard_snippets(written)
+            raise
+        # Only the snippets of the recordings that were saved now (not of re-sent ones), once that is committed
+        transaction.on_commit(lambda: _publish_snippets(written, saved_uuids))
+        metrics.inc('noisemapper_records_received_total', len(records), view='api_upload_recording_batch')
+
+        logging.info("Received %d ProcessedRecords" % len(uuids_processed))
         response = dict(
             success=True,
             uuids_processed=uuids_processed,
@@ -121,10 +142,69 @@ def api_upload_recording_batch(request):
         return HttpResponseNotAllowed(['POST'])
 
 
-def map_values(values, lower, higher, getter, setter) -> None:
+def _save_records(device_name: str, records: List[dict], recordings: List[Recording]) -> Set[Optional[str]]:
+    """
+    Queues the records (see `IngestQueue`), or saves their ``recordings`` right away if the queue is disabled.
+    Returns the uuids of the new recordings: those saved now, or, if they are queued, those not saved before
+    (the recordings without a uuid are always new). A batch re-sent while the first one is still queued looks new
+    too; the duplicates are skipped when the queue is drained.
+    """
+    if settings.INGEST_QUEUE_ENABLED:
+        saved_uuids = set()
+        for i in range(0, len(recordings), UPLOAD_CHUNK_SIZE):
+            saved_uuids.update(get_saved_uuids(recordings[i:i + UPLOAD_CHUNK_SIZE]))
+        ingest_queue.put(device_name, records)
+        return {r.uuid for r in recordings if r.uuid not in saved_uuids}
+
+    with transaction.atomic():
+        seen_uuids = set()
+        for i in range(0, len(recordings), UPLOAD_CHUNK_SIZE):
+            save_new_recordings(recordings[i:i + UPLOAD_CHUNK_SIZE], seen_uuids)
+    return {r.uuid for r in recordings if r.pk is not None}
+
+
+def _wait_for_snippets(snippets: List[Tuple[Optional[str], Future]]) -> Optional[List[Tuple[Optional[str], str]]]:
+    """
+    The (uuid, temporary file) of the snippets, once they are all written, or None if any of them couldn't be
+    (the others are removed then).
+    """
+    written = []
+    failed = False
+    for uuid, future in snippets:
+        try:
+            written.append((uuid, future.result()))
+        except Exception:
+            # Logged by the writer
+            failed = True
+    if failed:
+        _discard_snippets(written)
+        return None
+    return written
+
+
+def _discard_snippets(written: List[Tuple[Optional[str], str]]) -> None:
+    for _, tmp_filename in written:
+        snippet_writer.discard(tmp_filename)
+
+
+def _publish_snippets(written: List[Tuple[Optional[str], str]], saved_uuids: Set[Optional[str]]) -> None:
+    for uuid, tmp_filename in written:
+        try:
+            if uuid in saved_uuids:
+                snippet_writer.publish(uuid, tmp_filename)
+            else:
+                snippet_writer.discard(tmp_filename)
+        except OSError:
+            # The recordings are saved by now
+            logging.exception("Couldn't move the uploaded file for %s into place" % uuid)
+
+
+def map_values(values, lower, higher, getter, setter, source=None) -> None:
     """
     Maps a range of values onto another range. Values should be encapsulated in something,
      and the getter will be used to extract the value, and the setter to write back the new one.
+    The range mapped from is that of the values, or ``source`` (a (min, max) tuple), with the values outside of it
+    clamped to its ends.
 
     :param values:
     :type values: [T]
@@ -136,23 +216,51 @@ def map_values(values, lower, higher, getter, setter) -> None:
     :type getter: func(T) -> (int | float)
     :param setter:
     :type setter: func(T, int | float)
+    :param source:
+    :type source: (int | float, int | float) | None
     """
-    minval = getter(min(values, key=getter))
-    maxval = getter(max(values, key=getter))
+    if source is None:
+        minval = getter(min(values, key=getter))
+        maxval = getter(max(values, key=getter))
+    else:
+        minval, maxval = source
     try:
         slope = (higher - lower) / (maxval - minval)
     except ZeroDivisionError:
         slope = 0
     for obj in values:
-        val = getter(obj)
+        val = min(max(getter(obj), minval), maxval)
         new_val = lower + slope * (val - minval)
         setter(obj, new_val)
 
 
+class InvalidParameter(ValueError):
+    """
+    Raised for an invalid request parameter; the views decorated with `_reject_invalid_parameters` respond to it
+    with ``400 Bad Request``.
+    """
+
+
+def _reject_invalid_parameters(view_func):
+    """
+    Responds with ``400 Bad Request`` and the message, if the view raises `InvalidParameter`. Put it above
+    ``cache_response``, whose key function parses the parameters before the view is called.
+    """
+
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        try:
+            return view_func(request, *args, **kwargs)
+        except InvalidParameter as e:
+            return HttpResponse(status=400, content=str(e))
+
+    return _wrapped_view
+
+
 def _build_filters(request: HttpRequest):
     device_names = request.GET.get('deviceNames', '').split('|')
     mic_sources = request.GET.get('micSources', '').split('|')
-    is_cropping = request.GET['is_cropping'] == 'true'
+    is_cropping = request.GET.get('is_cropping') == 'true'
 
     filter_criteria = dict()
     if is_cropping:
@@ -171,97 +279,388 @@ def _build_filters(request: HttpRequest):
         mic_source__in=mic_sources,
     )
 
-    filter_criteria.update(
-        # 2017-01-24 21:31:09 -- ??
-        timestamp__gte=datetime.datetime(year=2017, month=1, day=24, hour=20, minute=00),
-        # # 2017-03-19 10:10:00 -- Started using a headset
-        # timestamp__gte=datetime.datetime(year=2017, month=3, day=19, hour=10, minute=10),
-    )
+    filter_criteria.update(_build_time_filters(request))
+
+    # Filtered for, instead of excluded, so the query starts from there in the timestamp index
+    earliest = ExcludedPeriod.get_earliest()
+    if earliest is not None and filter_criteria.get('timestamp__gte', earliest) <= earliest:
+        filter_criteria.update(timestamp__gte=earliest)
 
     return filter_criteria
 
 
-def _build_excludes(request: HttpRequest):
-    exclude_criteria = dict()
+def _build_time_filters(request: HttpRequest):
+    """
+    The filters of the selected period: from ``from`` (inclusive) to ``to`` (exclusive), each a date or
+    a date and time, and of the selected hours of the day (``hours``, 0-23) and days of the week
+    (``weekdays``, 1-7, Monday first), separated by ``|``, like the device names.
+    Raises InvalidParameter if any of them is invalid.
+    """
+    time_filters = dict()
+    for param, lookup in (('from', 'timestamp__gte'), ('to', 'timestamp__lt')):
+        if request.GET.get(param):
+            time_filters[lookup] = _parse_datetime(request.GET[param])
 
-    exclude_criteria.update(
-        # In this period, the app was set to use `MediaRecorder.AudioSource.VOICE_RECOGNITION`
-        # which resulted in incorrect (too high) values.
-        timestamp__gte=datetime.datetime(year=2017, month=3, day=5, hour=0, minute=00),
-        timestamp__lte=datetime.datetime(year=2017, month=3, day=5, hour=23, minute=59),
-    )
+    if request.GET.get('hours'):
+        time_filters.update(timestamp__hour__in=_parse_int_list(request, 'hours', 0, 23))
 
-    return exclude_criteria
+    if request.GET.get('weekdays'):
+        weekdays = _parse_int_list(request, 'weekdays', 1, 7)
+        # Django numbers the days from Sunday
+        time_filters.update(timestamp__week_day__in=sorted(weekday % 7 + 1 for weekday in weekdays))
 
+    return time_filters
 
-@login_required
-def api_get_actual_data(request):
-    resolution = request.GET['resolution']
-    max_or_avg = request.GET['maxOrAvg']
 
-    filter_criteria = _build_filters(request)
-    exclude_criteria = _build_excludes(request)
+def _parse_int_list(request: HttpRequest, param: str, lowest: int, highest: int) -> List[int]:
+    try:
+        values = sorted({int(value) for value in request.GET[param].split('|')})
+    except ValueError:
+        values = None
+    if values is None or not all(lowest <= value <= highest for value in values):
+        raise InvalidParameter('Invalid %s: %s' % (param, request.GET[param]))
+    return values
 
-    data = Recording.objects.filter(**filter_criteria).exclude(**exclude_criteria)
-    return _common_prepare_response_data(
-        data,
-        is_same_func=_make_is_same(resolution),
-        aggregator_factory=(lambda: GeoWeightedMiddle(extractor=(lambda r: (r.lat, r.lon, getattr(r, max_or_avg))))),
-        range=(2, 3),
+
+def _parse_datetime(value: str) -> datetime.datetime:
+    try:
+        parsed = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        # Well formatted, but out of range, e.g. the 30th of February
+        parsed = None
+    if parsed is None:
+        raise InvalidParameter('Invalid date: %s' % value)
+    if not isinstance(parsed, datetime.datetime):
+        parsed = datetime.datetime.combine(parsed, datetime.time())
+    return parsed
+
+
+def _build_excludes(request: HttpRequest) -> Q:
+    """
+    The recordings of the known bad periods (see :class:`ExcludedPeriod`) within the selected period.
+    """
+    time_filters = _build_time_filters(request)
+    return ExcludedPeriod.get_excludes(time_filters.get('timestamp__gte'), time_filters.get('timestamp__lt'))
+
+
+# The originals of a cluster are sent either as a list of dicts (rows) or as a dict of lists (columns),
+# or the whole response is packed into a binary struct-of-arrays (see `encode_binary`).
+# The summary layout leaves them out: the client loads them page by page, with `api_get_cluster_originals`
+LAYOUT_ROWS = 'rows'
+LAYOUT_COLUMNS = 'columns'
+LAYOUT_BINARY = 'binary'
+LAYOUT_SUMMARY = 'summary'
+
+ORIGINALS_PAGE_SIZE = 100
+ORIGINALS_MAX_PAGE_SIZE = 1000
+
+# With `aggregation=cells`, the actual data is aggregated by geohash cell in the database, see `_aggregate_cells`
+AGGREGATION_CELLS = 'cells'
+
+
+def _get_layout(request: HttpRequest) -> str:
+    if request.GET.get('format') == LAYOUT_BINARY or BINARY_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+        return LAYOUT_BINARY
+    layout = request.GET.get('layout')
+    return layout if layout in (LAYOUT_COLUMNS, LAYOUT_SUMMARY) else LAYOUT_ROWS
+
+
+def _get_measurement(request: HttpRequest) -> str:
+    """
+    The measurement shown on the map (``maxOrAvg``): the name of a ``Recording`` field.
+    """
+    measurement = request.GET['maxOrAvg']
+    if measurement not in RecordingGroupTotals.MEASUREMENTS:
+        raise InvalidParameter('Unknown measurement: %s' % measurement)
+    return measurement
+
+
+def _get_selection_criteria(request: HttpRequest) -> dict:
+    """
+    The parameters the selected recordings and their clusters depend on.
+    """
+    resolution = _parse_resolution(request.GET['resolution'])
+    criteria = dict(
+        # The excluded periods are not in the key: changing them clears the cache
+        filters=_build_filters(request),
+        resolution=str(resolution.normalize()) if resolution is not None else None,
+        max_or_avg=_get_measurement(request),
+    )
+    # The order of the selected devices and mic sources doesn't matter
+    for key in ('device_name__in', 'mic_source__in'):
+        criteria['filters'][key] = sorted(criteria['filters'][key])
+    return criteria
+
+
+def _hash_criteria(criteria: dict) -> str:
+    return hashlib.sha1(dumps(criteria, sort_keys=True, default=sjs).encode('utf-8')).hexdigest()
+
+
+def _data_cache_key(request: HttpRequest) -> str:
+    criteria = _get_selection_criteria(request)
+    criteria.update(
+        layout=_get_layout(request),
+        cell_precision=_get_cell_precision(request) if _is_cell_aggregation(request) else None,
     )
+    return _hash_criteria(criteria)
+
+
+def _get_recordings(request: HttpRequest) -> List[RecordingRow]:
+    """
+    The selected recordings, ordered by their primary key, so the clusters (and their ids) don't depend on
+    the order the database happens to return the rows in.
+    If the clusters are stored for the requested resolution, and all the recordings they are built from are
+    selected (none of them archived), the ``cluster_id`` of the recordings is set.
+    """
+    querysets = ArchivedMonth.select_recordings(_build_filters(request), _build_excludes(request))
+    recordings = sorted(_rows_from_querysets(querysets), key=lambda r: r.pk)
 
+    resolution = _parse_resolution(request.GET['resolution'])
+    if RecordingCluster.is_stored(resolution) and len(querysets) == 1 \
+            and RecordingCluster.covers(int(resolution), recordings):
+        assignments = RecordingCluster.get_assignments(int(resolution), querysets[0])
+        if len(assignments) == len(recordings):
+            for recording in recordings:
+                recording.cluster_id = assignments[recording.pk]
+        else:
+            logging.warning("%d recordings have no cluster at %s m, run rebuild_clusters"
+                            % (len(recordings) - len(assignments), resolution))
+    return recordings
 
-def _get_group_by_from_dict(d: dict, group_by: tuple) -> tuple:
-    return tuple([d[key] for key in group_by])
+
+def _rows_from_querysets(querysets: List[QuerySet]) -> Iterator[RecordingRow]:
+    for queryset in querysets:
+        yield from RecordingRow.from_queryset(queryset)
+
+
+def _actual_data(request: HttpRequest, recordings: List[RecordingRow] = None):
+    """
+    The recordings, the extractor of their (lat, lon, value) for the aggregator, and the value range of the actual data.
+    The recordings are the selected ones, or the given part of them (e.g. the originals of a cluster).
+    """
+    max_or_avg = _get_measurement(request)
+    return (
+        _get_recordings(request) if recordings is None else recordings,
+        (lambda r: (r.lat, r.lon, getattr(r, max_or_avg))),
+        (2, 3),
+    )
 
 
 def _get_group_by_from_object(o: object, group_by: tuple) -> tuple:
     return tuple([getattr(o, key) for key in group_by])
 
 
-@login_required
-def api_get_deviation_from_average_data(request):
-    resolution = request.GET['resolution']
-    max_or_avg = request.GET['maxOrAvg']
+def _deviation_from_average_data(request: HttpRequest, recordings: List[RecordingRow] = None):
+    """
+    Same as :func:`_actual_data`, for the deviation of the recordings from the average of their device and mic source.
+    """
+    max_or_avg = _get_measurement(request)
 
     group_by = ('device_name', 'mic_source')
 
-    filter_criteria = _build_filters(request)
-    exclude_criteria = _build_excludes(request)
-    queryset = Recording.objects.filter(**filter_criteria).exclude(**exclude_criteria)
-    average_values = queryset.values(*group_by).annotate(average_value=Avg(max_or_avg))
-    average_values = {_get_group_by_from_dict(x, group_by): x['average_value'] for x in average_values}
+    # The all-time average of each group (without the excluded periods), kept up to date on upload
+    average_values = RecordingGroupTotals.get_averages(max_or_avg)
+    if recordings is None:
+        recordings = _get_recordings(request)
+    recordings = [r for r in recordings if getattr(r, max_or_avg) is not None]
+
+    # A group may have no totals yet, e.g. if they were being rebuilt; it's compared to its average in the selection
+    missing = {}
+    for recording in recordings:
+        group = _get_group_by_from_object(recording, group_by)
+        if group not in average_values:
+            total = missing.setdefault(group, [0, 0])
+            total[0] += getattr(recording, max_or_avg)
+            total[1] += 1
+    average_values.update((group, value_sum / count) for group, (value_sum, count) in missing.items())
 
     annotated = []
-    for recording in queryset:
+    for recording in recordings:
         recording.deviation = getattr(recording, max_or_avg) - average_values[_get_group_by_from_object(recording, group_by)]
         annotated.append(recording)
 
-    return _common_prepare_response_data(
+    return (
         annotated,
-        is_same_func=_make_is_same(resolution),
-        aggregator_factory=(lambda: GeoWeightedMiddle(extractor=(lambda r: (r.lat, r.lon, getattr(r, 'deviation'))))),
-        range=(-1, +1),
+        (lambda r: (r.lat, r.lon, getattr(r, 'deviation'))),
+        (-1, +1),
     )
 
 
-def _common_prepare_response_data(data, is_same_func, aggregator_factory, range):
-    clustered = cluster_data(
-        data,
-        key_func=(lambda r: (r.lat, r.lon)),
-        is_same_func=is_same_func,
-        aggregator_factory=aggregator_factory,
-        retain_original=True,
+@login_required
+@gzip_page
+@vary_on_headers('Accept')
+@_reject_invalid_parameters
+@cache_response(_data_cache_key)
+def api_get_actual_data(request):
+    if _is_cell_aggregation(request):
+        return _cell_aggregated_response(request)
+    store_members = _get_members_storer(request, 'actual')
+    recordings, extractor, range = _actual_data(request)
+    return _common_prepare_response_data(
+        recordings,
+        resolution=_parse_resolution(request.GET['resolution']),
+        extractor=extractor,
+        range=range,
+        layout=_get_layout(request),
+        store_members=store_members,
     )
-    clustered = [
+
+
+@login_required
+@gzip_page
+@vary_on_headers('Accept')
+@_reject_invalid_parameters
+@cache_response(_data_cache_key)
+def api_get_deviation_from_average_data(request):
+    store_members = _get_members_storer(request, 'deviation')
+    recordings, extractor, range = _deviation_from_average_data(request)
+    return _common_prepare_response_data(
+        recordings,
+        resolution=_parse_resolution(request.GET['resolution']),
+        extractor=extractor,
+        range=range,
+        layout=_get_layout(request),
+        store_members=store_members,
+    )
+
+
+def _common_prepare_response_data(data, resolution, extractor, range, layout=LAYOUT_ROWS, store_members=None):
+    data = _prepare_response_data(data, resolution, extractor, range, layout, store_members=store_members)
+    if layout == LAYOUT_BINARY:
+        with timing('serialize'):
+            content = encode_binary(data)
+        return HttpResponse(content, content_type=BINARY_CONTENT_TYPE)
+    # Serialized while it is sent (see `RequestLoggerMiddleware`)
+    return StreamingHttpResponse(iter_json(data, default=sjs), content_type='application/json')
+
+
+def _is_cell_aggregation(request: HttpRequest) -> bool:
+    return request.GET.get('aggregation') == AGGREGATION_CELLS
+
+
+def _get_cell_precision(request: HttpRequest) -> int:
+    """
+    The geohash precision asked for (``cellPrecision``), or else the coarsest one whose cells are at most twice
+    the resolution high, about the size of a cluster.
+    """
+    if request.GET.get('cellPrecision'):
+        try:
+            precision = int(request.GET['cellPrecision'])
+        except ValueError:
+            raise InvalidParameter('Invalid cellPrecision: %s' % request.GET['cellPrecision'])
+        return min(max(precision, 1), GEOHASH_PRECISION)
+    resolution = _parse_resolution(request.GET['resolution'])
+    if resolution is None or resolution <= 0:
+        return GEOHASH_PRECISION
+    for precision in range(1, GEOHASH_PRECISION):
+        if geohash_cell_height(precision) <= 2 * resolution:
+            return precision
+    return GEOHASH_PRECISION
+
+
+def _aggregate_cells(request: HttpRequest) -> List[dict]:
+    """
+    The count, sum, minimum and maximum of the measurements of the selected recordings, and their mean location,
+    per geohash cell (see ``Recording.geohash``), aggregated with ``GROUP BY`` in the database,
+    so only one row per cell is read into Python.
+    The value of a cell is the plain mean of its measurements, not the distance-weighted one of the clusters.
+    """
+    max_or_avg = _get_measurement(request)
+    precision = _get_cell_precision(request)
+
+    cells = {}
+    for queryset in ArchivedMonth.select_recordings(_build_filters(request), _build_excludes(request)):
+        rows = queryset.exclude(geohash=None).exclude(**{max_or_avg: None}) \
+            .annotate(cell=Substr('geohash', 1, precision)).values('cell') \
+            .annotate(count=Count('pk'), sum=Sum(max_or_avg), min=Min(max_or_avg), max=Max(max_or_avg),
+                      lat_sum=Sum('lat'), lon_sum=Sum('lon')) \
+            .order_by()
+        # The cells of the main and the archive database are merged
+        for row in rows:
+            cell = cells.get(row['cell'])
+            if cell is None:
+                cells[row['cell']] = row
+                continue
+            for key in ('count', 'sum', 'lat_sum', 'lon_sum'):
+                cell[key] += row[key]
+            cell['min'] = min(cell['min'], row['min'])
+            cell['max'] = max(cell['max'], row['max'])
+
+    return [
         dict(
-            coordinates={'lat': key[0], 'lon': key[1]},
-            value=value['aggregated_value'],
-            original=[recording_to_json2(x) for x in value['original']],
+            id=cell['cell'],
+            coordinates={'lat': cell['lat_sum'] / cell['count'], 'lon': cell['lon_sum'] / cell['count']},
+            value=cell['sum'] / cell['count'],
+            count=cell['count'],
+            sum=cell['sum'],
+            min=cell['min'],
+            max=cell['max'],
         )
-        for key, value
-        in clustered.items()
-        ]
+        for _, cell in sorted(cells.items())
+    ]
+
+
+def _cell_aggregated_response(request: HttpRequest) -> HttpResponse:
+    """
+    The response of the map endpoint with ``aggregation=cells``: like the ``summary`` layout, with the cells
+    in place of the clusters (identified by their geohash), whatever the requested layout.
+    """
+    range_min, range_max = 2, 3
+    cells = _aggregate_cells(request)
+    metrics.observe('noisemapper_map_clusters', len(cells), aggregation='cells')
+    if cells:
+        def setter(obj, val):
+            obj['display'] = val
+
+        map_values(cells, range_min, range_max, lambda x: x['value'], setter)
+    data = dict(
+        success=True,
+        data=cells,
+        min=range_min,
+        max=range_max,
+        cell_precision=_get_cell_precision(request),
+    )
+    with timing('serialize'):
+        content = dumps(data, default=sjs)
+    return HttpResponse(content, content_type='application/json')
+
+
+def _get_coordinates(recording: RecordingRow):
+    return recording.lat, recording.lon
+
+
+def _group_recordings(recordings: List[RecordingRow], resolution) -> dict:
+    """
+    The recordings of each cluster, keyed by the location of the first one. Taken from the stored clusters if the
+    recordings have them (see `_get_recordings`), otherwise clustered now; in parallel, if there are many of them.
+    """
+    if recordings and hasattr(recordings[0], 'cluster_id'):
+        by_cluster = {}
+        for recording in recordings:
+            by_cluster.setdefault(recording.cluster_id, []).append(recording)
+        return {_get_coordinates(members[0]): members for members in by_cluster.values()}
+    return parallel_clusterer.group(recordings, key_func=_get_coordinates, resolution=resolution)
+
+
+def _prepare_response_data(data, resolution, extractor, range, layout=LAYOUT_ROWS, value_range=None,
+                           store_members=None) -> dict:
+    with timing('cluster'):
+        clustered = parallel_clusterer.aggregate(
+            _group_recordings(data, resolution),
+            value_func=extractor,
+            aggregator_class=VectorGeoWeightedMiddle,
+            retain_original=True,
+        )
+    if store_members is not None and layout == LAYOUT_SUMMARY:
+        # For the pages of the originals the client asks for next
+        store_members({value['original'][0].pk: value['original'] for value in clustered.values()})
+    with timing('serialize'):
+        clustered = [
+            _make_cluster(key, value, layout)
+            for key, value
+            in clustered.items()
+            ]
+    metrics.observe('noisemapper_map_clusters', len(clustered), aggregation='clusters')
 
     range_min, range_max = range
 
@@ -269,38 +668,319 @@ def _common_prepare_response_data(data, is_same_func, aggregator_factory, range)
         def setter(obj, val):
             obj['display'] = val
 
-        map_values(clustered, range_min, range_max, lambda x: x['value'], setter)
+        map_values(clustered, range_min, range_max, lambda x: x['value'], setter, source=value_range)
     data = dict(
         success=True,
         data=clustered,
         min=range_min,
         max=range_max,
     )
-    return JsonResponse(data, json_dumps_params=dict(default=sjs))
+    return data
+
+
+def _make_cluster(key: tuple, value: dict, layout: str) -> dict:
+    originals = value['original']
+    cluster = dict(
+        # The first recording of a cluster is its seed, so its id stays the same as long as the recordings,
+        # the filters and the resolution do
+        id=originals[0].pk,
+        coordinates={'lat': key[0], 'lon': key[1]},
+        value=value['aggregated_value'],
+    )
+    if layout == LAYOUT_SUMMARY:
+        cluster['count'] = len(originals)
+    else:
+        cluster['original'] = _convert_originals(originals, layout)
+    return cluster
+
+
+def _convert_originals(originals: list, layout: str):
+    if layout == LAYOUT_BINARY:
+        # Packed later, by `encode_binary`
+        return originals
+    if layout == LAYOUT_COLUMNS:
+        return recordings_to_columns(originals)
+    return [recording_to_json2(x) for x in originals]
+
+
+# The data types of `api_get_cluster_originals`, named after the map endpoints
+_DATA_SOURCES = {
+    'actual': _actual_data,
+    'deviation': _deviation_from_average_data,
+}
+
+
+def _parse_originals_page(request: HttpRequest):
+    """
+    The (cluster id, page, page size) asked for, or None if any of them is invalid.
+    """
+    try:
+        cluster_id = int(request.GET['cluster'])
+        page = int(request.GET.get('page', 0))
+        page_size = int(request.GET.get('pageSize', ORIGINALS_PAGE_SIZE))
+    except (KeyError, ValueError):
+        return None
+    if page < 0 or not 0 < page_size <= ORIGINALS_MAX_PAGE_SIZE:
+        return None
+    return cluster_id, page, page_size
+
+
+def _cluster_originals_cache_key(request: HttpRequest) -> str:
+    return '%s:%s:%s' % (_data_cache_key(request), request.GET.get('dataType'), _parse_originals_page(request))
+
+
+# The primary keys of the originals of each cluster of a selection are kept in the response cache,
+# so a page of them can be served without clustering the whole selection again
+MEMBERS_CONTENT_TYPE = 'application/x-noisemapper-members'
+
+
+def _get_members_key_prefix(request: HttpRequest, data_type: str) -> str:
+    return 'members:%s' % _hash_criteria(dict(_get_selection_criteria(request), data_type=data_type))
+
+
+def _get_members_storer(request: HttpRequest, data_type: str) -> Callable[[dict], None]:
+    """
+    The function that stores the originals of the clusters (``{cluster id: recordings}``) of the selection,
+    unless the recordings change from now until then (see ``ResponseCache.get_generation``).
+    """
+    prefix = _get_members_key_prefix(request, data_type)
+    generation = response_cache.get_generation()
+
+    def store_members(clusters: dict) -> None:
+        response_cache.set_many([
+            ('%s:%d' % (prefix, cluster_id), MEMBERS_CONTENT_TYPE, array('q', (r.pk for r in originals)).tobytes())
+            for cluster_id, originals in clusters.items()
+        ], generation)
+
+    return store_members
+
+
+def _get_members(request: HttpRequest, data_type: str, cluster_id: int) -> Optional[List[RecordingRow]]:
+    """
+    The stored originals of the cluster, or None if they are not stored.
+    """
+    entry = response_cache.get('%s:%d' % (_get_members_key_prefix(request, data_type), cluster_id))
+    if entry is None:
+        return None
+    pks = array('q')
+    pks.frombytes(entry.content)
+    pks = pks.tolist()
+
+    querysets = ArchivedMonth.select_recordings(_build_filters(request), _build_excludes(request))
+    members = []
+    # Stay below SQLite's limit on the number of query parameters
+    for i in range(0, len(pks), UPLOAD_CHUNK_SIZE):
+        members.extend(_rows_from_querysets([q.filter(pk__in=pks[i:i + UPLOAD_CHUNK_SIZE]) for q in querysets]))
+    # In the order they were clustered in
+    return sorted(members, key=lambda r: r.pk)
 
 
 @login_required
-def download_selection(request: HttpRequest):
+@gzip_page
+@_reject_invalid_parameters
+@cache_response(_cluster_originals_cache_key)
+def api_get_cluster_originals(request):
+    """
+    One page of the originals of a cluster of a ``layout=summary`` map response. Takes the same parameters as
+    the map endpoint named by ``dataType`` (``actual`` or ``deviation``), plus the ``cluster`` id, the ``page``
+    number (from 0) and the ``pageSize``.
+    The originals are looked up by the primary keys stored with the map response (see `_get_members_storer`);
+    only if they have been evicted since is the selection clustered again.
+    """
+    data_type = request.GET.get('dataType', 'actual')
+    data_source = _DATA_SOURCES.get(data_type)
+    page_params = _parse_originals_page(request)
+    if data_source is None or page_params is None:
+        return HttpResponse(status=400, content="Invalid parameters")
+    cluster_id, page, page_size = page_params
+
+    originals = _get_members(request, data_type, cluster_id)
+    if originals is not None:
+        originals, extractor, _ = data_source(request, originals)
+    else:
+        store_members = _get_members_storer(request, data_type)
+        recordings, extractor, _ = data_source(request)
+        with timing('cluster'):
+            clustered = _group_recordings(recordings, _parse_resolution(request.GET['resolution']))
+        clusters = {values[0].pk: values for values in clustered.values()}
+        store_members(clusters)
+        originals = clusters.get(cluster_id)
+    if not originals:
+        raise Http404('No such cluster')
+
+    # Only this cluster is aggregated, for the weights of its originals
+    with timing('cluster'):
+        aggregate_clusters({cluster_id: originals}, (lambda: VectorGeoWeightedMiddle(extractor=extractor)),
+                           retain_original=True)
+
+    start = page * page_size
+    layout = LAYOUT_COLUMNS if request.GET.get('layout') == LAYOUT_COLUMNS else LAYOUT_ROWS
+    data = dict(
+        success=True,
+        cluster=cluster_id,
+        page=page,
+        page_size=page_size,
+        count=len(originals),
+        original=_convert_originals(originals[start:start + page_size], layout),
+    )
+    with timing('serialize'):
+        content = dumps(data, default=sjs)
+    return HttpResponse(content, content_type='application/json')
+
+
+@login_required
+@_reject_invalid_parameters
+def api_get_tile(request, zoom, x, y):
+    """
+    The clustered actual data of one map tile, see :class:`MapTile`. Takes the same parameters as
+    :func:`api_get_actual_data`, except for the resolution (which depends on the zoom level) and the cropping.
+    """
+    zoom, x, y = int(zoom), int(x), int(y)
+    if zoom > settings.TILE_MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+        raise Http404('No such tile')
 
+    max_or_avg = _get_measurement(request)
     filter_criteria = _build_filters(request)
-    exclude_criteria = _build_excludes(request)
+    excludes = _build_excludes(request)
+
+    # All the tiles are displayed on the same scale, not each on the range of its own values
+    value_range = settings.TILE_VALUE_RANGES[max_or_avg]
+    params = [sorted(filter_criteria['device_name__in']), sorted(filter_criteria['mic_source__in']), max_or_avg,
+              value_range]
+    time_filters = _build_time_filters(request)
+    if time_filters:
+        params.append(time_filters)
+    params_key = hashlib.sha1(dumps(params, sort_keys=True, default=sjs).encode('utf-8')).hexdigest()
+
+    tile = MapTile.objects.filter(zoom=zoom, x=x, y=y, params_key=params_key).first()
+    if tile is None:
+        generation = response_cache.get_generation()
+        south, north, west, east = MapTile.get_bounds(zoom, x, y)
+        for key in ('lat__gt', 'lat__lt', 'lon__gt', 'lon__lt'):
+            filter_criteria.pop(key, None)
+        filter_criteria.update(lat__gte=south, lat__lt=north, lon__gte=west, lon__lt=east)
+
+        querysets = ArchivedMonth.select_recordings(filter_criteria, excludes)
+        data = _prepare_response_data(
+            sorted(_rows_from_querysets(querysets), key=lambda r: r.pk),
+            resolution=MapTile.get_resolution(zoom, y),
+            extractor=(lambda r: (r.lat, r.lon, getattr(r, max_or_avg))),
+            range=(2, 3),
+            value_range=value_range,
+        )
+        with timing('serialize'):
+            content = dumps(data, default=sjs)
+        tile, created = MapTile.objects.get_or_create(zoom=zoom, x=x, y=y, params_key=params_key,
+                                                      defaults=dict(content=content))
+        if created and response_cache.get_generation() != generation:
+            # Recordings were added while it was computed, so it may be missing some (see `_recordings_added`)
+            tile.delete()
+        elif created:
+            MapTile.evict()
+
+    return HttpResponse(tile.content, content_type='application/json')
 
-    data = Recording.objects.filter(**filter_criteria).exclude(**exclude_criteria)
 
-    with tempfile.TemporaryFile() as tmpfile:
-        for recording in data:
-            full_filename = settings.FILENAME_PATTERN % recording.uuid
-            full_filename = os.path.join(settings.SNIPPET_STORAGE_DIR, full_filename)
-            with open(full_filename, 'rb') as infile:
-                shutil.copyfileobj(infile, tmpfile)
+@login_required
+@_reject_invalid_parameters
+def download_selection(request: HttpRequest):
 
-        tmpfile.seek(0)
-        response = HttpResponse(tmpfile.read(), content_type='audio/pcm')
+    filter_criteria = _build_filters(request)
+    excludes = _build_excludes(request)
+
+    # Ordered, so that a download can be resumed with a Range request
+    uuids = [uuid for _, uuid in heapq.merge(*[
+        queryset.order_by('pk').values_list('pk', 'uuid').iterator()
+        for queryset in ArchivedMonth.select_recordings(filter_criteria, excludes)
+    ])]
+
+    snippets = []
+    for uuid in uuids:
+        full_filename = find_snippet(uuid)
+        try:
+            snippets.append((full_filename, os.path.getsize(full_filename)))
+        except OSError:
+            logging.warning("Snippet of %s is missing, leaving it out of the download" % uuid)
+
+    total_size = sum(size for _, size in snippets)
+    etag = '"%s"' % hashlib.md5('\n'.join('%s:%d' % snippet for snippet in snippets).encode('utf-8')).hexdigest()
+
+    byte_range = None
+    if request.META.get('HTTP_IF_RANGE', etag) == etag:
+        byte_range = _parse_range(request.META.get('HTTP_RANGE', ''), total_size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % total_size
+            return response
+
+    if byte_range:
+        start, stop = byte_range
+        response = StreamingHttpResponse(iter_concatenated(snippets, start, stop), status=206,
+                                         content_type='audio/pcm')
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, total_size)
+    elif len(snippets) == 1:
+        # Lets the server send the file with sendfile() (wsgi.file_wrapper)
+        start, stop = 0, total_size
+        response = FileResponse(open(snippets[0][0], 'rb'), content_type='audio/pcm')
+    else:
+        start, stop = 0, total_size
+        response = StreamingHttpResponse(iter_concatenated(snippets, start, stop), content_type='audio/pcm')
 
+    response['Content-Length'] = stop - start
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
     response['Content-Disposition'] = 'attachment; filename="merged.pcm"'
     return response
 
 
+def api_metrics(request):
+    """
+    The metrics of all the processes (see :class:`MetricsRegistry`), in the Prometheus text format,
+    for staff users and for scrapers sending ``settings.METRICS_TOKEN``.
+    """
+    if not (_has_metrics_token(request) or can_view_metrics(request.user)):
+        return HttpResponse(status=401, content="Unauthorized!")
+
+    metrics.set('noisemapper_ingest_queue_records', len(ingest_queue))
+    metrics.flush()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _has_metrics_token(request: HttpRequest) -> bool:
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(authorization.encode('utf-8'), ('Bearer ' + token).encode('utf-8'))
+
+
+def _parse_range(header: str, total_size: int):
+    """
+    Parses a single-range ``Range: bytes=...`` header.
+    Returns the requested [start, stop) byte interval, None if the whole content should be sent,
+    or False if the range can't be satisfied.
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or match.groups() == ('', ''):
+        # Missing, malformed or multi-range requests get the whole content
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            # Invalid, so ignored, like a malformed header (RFC 7233, section 3.1)
+            return None
+        if start >= total_size:
+            return False
+        stop = min(int(last) + 1, total_size) if last else total_size
+    else:
+        # Suffix range: the last N bytes; none of an empty content, or of a zero-length suffix, can be sent
+        if int(last) == 0 or total_size == 0:
+            return False
+        start = max(total_size - int(last), 0)
+        stop = total_size
+    return start, stop
+
+
 @login_required
 def api_manual(request):
     # cnt = 0
@@ -97,13 +97,41 @@ WSGI_APPLICATION = 'noisemapper_wrapper.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
+# The SQLite backend, with the queries counted for the request statistics (see `RequestLoggerMiddleware`)
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'noisemapper.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        # Each uWSGI worker keeps its connection, instead of opening a new one for every request
+        'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
+    },
+    # Only the recordings of the archived months (see `ArchivedMonth`), which the map endpoints rarely select
+    'archive': {
+        'ENGINE': 'noisemapper.backends.sqlite3',
+        'NAME': os.environ.get('ARCHIVE_DATABASE_PATH', os.path.join(BASE_DIR, 'archive.sqlite3')),
+        'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
+    },
 }
 
+DATABASE_ROUTERS = ['noisemapper.routers.ArchiveRouter']
+
+# The rollover_recordings command moves the recordings older than this many (whole) months into the archive
+RECORDING_ARCHIVE_DATABASE = 'archive'
+RECORDING_HOT_MONTHS = int(os.environ.get('RECORDING_HOT_MONTHS', 12))
+
+# Set on every new SQLite connection (see `configure_connection`)
+SQLITE_PRAGMAS = [
+    # Readers don't wait for the writer, and the writer doesn't wait for readers
+    ('journal_mode', 'WAL'),
+    # With WAL, a power loss can lose the last transactions, but can't corrupt the database
+    ('synchronous', 'NORMAL'),
+    # In milliseconds: how long to wait for the write lock before failing with "database is locked"
+    ('busy_timeout', 20000),
+    # In KiB, when negative
+    ('cache_size', -64000),
+    ('mmap_size', 256 * 1024 * 1024),
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -150,6 +178,70 @@ if not os.path.exists(SNIPPET_STORAGE_DIR):
 
 FILENAME_PATTERN = '%s.3gp'
 
+# Snippets are decoded and written by background threads, at most this many can wait for them
+SNIPPET_WRITER_THREADS = int(os.environ.get('SNIPPET_WRITER_THREADS', 2))
+SNIPPET_WRITER_MAX_PENDING = int(os.environ.get('SNIPPET_WRITER_MAX_PENDING', 8))
+
+
+# Map tiles (see `MapTile`) are served up to this zoom level, clustered with the ground size of this many pixels
+TILE_MAX_ZOOM = 20
+TILE_CLUSTER_RADIUS_PX = 10
+# The values (in dB) shown at the ends of the colour scale of the tiles, the same for all of them
+TILE_VALUE_RANGES = {'measurement_avg': (30, 90), 'measurement_max': (40, 110)}
+# The oldest tiles are deleted when there are more than this many
+TILE_MAX_COUNT = int(os.environ.get('TILE_MAX_COUNT', 100000))
+
+
+# Uploaded batches are queued in this SQLite file, and saved by the drain_ingest_queue command (see `IngestQueue`)
+INGEST_QUEUE_ENABLED = (os.environ.get('INGEST_QUEUE_ENABLED', 'true') == 'true')
+INGEST_QUEUE_PATH = os.environ.get('INGEST_QUEUE_PATH', os.path.join(BASE_DIR, 'ingest_queue.sqlite3'))
+
+
+# Admission control of the upload endpoints (see `AdmissionController`), with its state in this SQLite file.
+# Each device may upload ADMISSION_DEVICE_RATE (> 0) times per second, with bursts of ADMISSION_DEVICE_BURST;
+# keep ADMISSION_MAX_IN_FLIGHT below the number of uWSGI workers, so some are always left for the map endpoints
+ADMISSION_CONTROL_ENABLED = (os.environ.get('ADMISSION_CONTROL_ENABLED', 'true') == 'true')
+ADMISSION_PATH = os.environ.get('ADMISSION_PATH', os.path.join(BASE_DIR, 'admission.sqlite3'))
+ADMISSION_DEVICE_RATE = float(os.environ.get('ADMISSION_DEVICE_RATE', 0.5))
+ADMISSION_DEVICE_BURST = int(os.environ.get('ADMISSION_DEVICE_BURST', 5))
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 1))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))  # In seconds, for the 503s
+ADMISSION_SLOT_TIMEOUT = int(os.environ.get('ADMISSION_SLOT_TIMEOUT', 600))  # In seconds
+
+
+# Requests slower than this many seconds are profiled (with cProfile) into this directory; 0 turns profiling off.
+# Every request is profiled while it is on, which makes them slower
+REQUEST_PROFILE_THRESHOLD = float(os.environ.get('REQUEST_PROFILE_THRESHOLD', 0))
+REQUEST_PROFILE_DIR = os.environ.get('REQUEST_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+
+# Responses of the map endpoints are cached in this SQLite file, shared by the uWSGI processes
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH', os.path.join(BASE_DIR, 'response_cache.sqlite3'))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+# Metrics of all the processes are added up in this SQLite file (see `MetricsRegistry`), and served on /api/metrics/
+# to staff users, and to scrapers sending this token as "Authorization: Bearer ..." (if it is set)
+METRICS_PATH = os.environ.get('METRICS_PATH', os.path.join(BASE_DIR, 'metrics.sqlite3'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Seconds between the writes of the metrics of a process to the file (needs uWSGI's "enable-threads")
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+
+# Selections with at least this many recordings are clustered in a pool of this many processes, per process
+# serving requests: by default, the uWSGI workers (`processes` in uwsgi.ini) share the cores
+try:
+    import uwsgi
+    _WORKER_COUNT = uwsgi.numproc
+except ImportError:
+    _WORKER_COUNT = 1
+PARALLEL_CLUSTERING_MIN_ROWS = int(os.environ.get('PARALLEL_CLUSTERING_MIN_ROWS', 50000))
+PARALLEL_CLUSTERING_PROCESSES = int(os.environ.get('PARALLEL_CLUSTERING_PROCESSES',
+                                                   max((os.cpu_count() or 1) // _WORKER_COUNT, 1)))
+
+# The clusters of the recordings at these resolutions (in meters) are kept up to date on upload (see `RecordingCluster`)
+CLUSTER_STORE_RESOLUTIONS = (50, 100, 200)
+
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = int(
     os.environ.get('MAX_POST_PAYLOAD',